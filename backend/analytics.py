@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Rollups of contact and quote submissions for the sales analytics.
+
+Every submission increments two documents in ``analytics_rollups``: the hour
+and the day it falls in. Each document holds the submission total and, for
+quotes, counts per destination_country, product_category and urgency:
+
+    {"id": "quotes:day:2025-01-15T00", "collection": "quotes", "granularity": "day",
+     "bucket": 2025-01-15T00:00, "total": 42,
+     "destination_country": {"UAE": 17, ...}, "product_category": {...}, "urgency": {...}}
+
+Reading a range therefore touches one document per bucket, however many raw
+submissions there are. With ANALYTICS_FLUSH_SECONDS > 0 increments are
+buffered and written in micro-batches instead of one upsert per submission.
+
+The rollups can be rebuilt from the raw collections (and the archive, which
+holds submissions past their retention) with a vectorized pandas job:
+
+    python analytics.py backfill [--collection quotes] [--include-archive] [--until 2025-02-01]
+
+It rebuilds the buckets before --until (default: the start of today, UTC)
+and leaves later ones to the live writer.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from codec import codec_for
+from repositories import escape_key, unescape_key
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_DIMENSIONS: Dict[str, Tuple[str, ...]] = {
+    "quotes": ("destination_country", "product_category", "urgency"),
+    "contacts": (),
+}
+# granularity -> pandas frequency
+GRANULARITIES = {"hour": "h", "day": "D"}
+GRANULARITY_STEP = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+DEFAULT_SPAN = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+MAX_BUCKETS = 2000
+UNSPECIFIED = "unspecified"
+MAX_VALUE_LENGTH = 100
+
+Increments = Dict[str, Tuple[Dict[str, Any], Counter]]
+
+
+def dimension_value(value: Any) -> str:
+    if value is None:
+        return UNSPECIFIED
+    return str(value).strip()[:MAX_VALUE_LENGTH] or UNSPECIFIED
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    bucket = timestamp.replace(minute=0, second=0, microsecond=0)
+    return bucket.replace(hour=0) if granularity == "day" else bucket
+
+
+def rollup_id(collection: str, granularity: str, bucket: datetime) -> str:
+    return f"{collection}:{granularity}:{bucket:%Y-%m-%dT%H}"
+
+
+def _add(increments: Increments, collection: str, granularity: str, bucket: datetime, amounts: Dict[str, int]) -> None:
+    key = rollup_id(collection, granularity, bucket)
+    if key not in increments:
+        increments[key] = ({"collection": collection, "granularity": granularity, "bucket": bucket}, Counter())
+    increments[key][1].update(amounts)
+
+
+def increments_for(collection: str, doc: Dict[str, Any]) -> Increments:
+    amounts = {"total": 1}
+    for dimension in ROLLUP_DIMENSIONS[collection]:
+        amounts[f"{dimension}.{escape_key(dimension_value(doc.get(dimension)))}"] = 1
+    increments: Increments = {}
+    for granularity in GRANULARITIES:
+        _add(increments, collection, granularity, bucket_start(doc["created_at"], granularity), amounts)
+    return increments
+
+
+class RollupWriter:
+    """Applies submissions to the rollups, inline or in micro-batches."""
+
+    def __init__(self, flush_seconds: float = 0.0):
+        self.flush_seconds = flush_seconds
+        self._pending: Increments = {}
+
+    async def record(self, repository, collection: str, doc: Dict[str, Any]) -> None:
+        increments = increments_for(collection, doc)
+        if self.flush_seconds > 0:
+            self._merge(increments)
+            return
+        try:
+            await repository.apply({key: (fields, dict(amounts)) for key, (fields, amounts) in increments.items()})
+        except Exception:
+            # The submission itself is stored; a backfill repairs the rollup
+            logger.exception("Could not update %s rollups", collection)
+
+    def _merge(self, increments: Increments) -> None:
+        for key, (fields, amounts) in increments.items():
+            if key in self._pending:
+                self._pending[key][1].update(amounts)
+            else:
+                self._pending[key] = (fields, Counter(amounts))
+
+    async def flush(self, repository) -> int:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            await repository.apply({key: (fields, dict(amounts)) for key, (fields, amounts) in pending.items()})
+        except Exception:
+            self._merge(pending)
+            raise
+        return len(pending)
+
+    async def run_forever(self, repository) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush(repository)
+            except Exception:
+                logger.exception("Flushing rollups failed")
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def query_range(
+    granularity: str, start: Optional[datetime], end: Optional[datetime]
+) -> Tuple[datetime, datetime]:
+    """Resolve defaults and validate the bucket count; raises ValueError."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    end = _naive_utc(end) if end else datetime.utcnow()
+    start = _naive_utc(start) if start else end - DEFAULT_SPAN[granularity]
+    if start >= end:
+        raise ValueError("start must be before end")
+    if (end - start) / GRANULARITY_STEP[granularity] > MAX_BUCKETS:
+        raise ValueError(f"at most {MAX_BUCKETS} {granularity} buckets per query")
+    return bucket_start(start, granularity), end
+
+
+async def read_rollups(repository, collection: str, granularity: str, start: datetime, end: datetime) -> Dict[str, Any]:
+    dimensions = ROLLUP_DIMENSIONS[collection]
+    breakdown = {dimension: Counter() for dimension in dimensions}
+    series = []
+    for doc in await repository.list_range(collection, granularity, start, end):
+        entry = {"bucket": doc["bucket"], "total": doc.get("total", 0)}
+        for dimension in dimensions:
+            counts = {unescape_key(k): v for k, v in (doc.get(dimension) or {}).items()}
+            entry[dimension] = counts
+            breakdown[dimension].update(counts)
+        series.append(entry)
+    return {
+        "collection": collection,
+        "granularity": granularity,
+        "start": start,
+        "end": end,
+        "total": sum(entry["total"] for entry in series),
+        "series": series,
+        "breakdown": {dimension: dict(counts.most_common()) for dimension, counts in breakdown.items()},
+    }
+
+
+# Backfill
+def aggregate_frame(collection: str, frame) -> Counter:
+    """Counts by (granularity, bucket, path) for a DataFrame of submissions."""
+    import pandas as pd
+
+    counts: Counter = Counter()
+    if frame.empty:
+        return counts
+    created_at = pd.to_datetime(frame["created_at"], utc=True).dt.tz_localize(None)
+    for granularity, freq in GRANULARITIES.items():
+        buckets = created_at.dt.floor(freq)
+        for bucket, total in buckets.value_counts().items():
+            counts[(granularity, bucket.to_pydatetime(), "total")] += int(total)
+        for dimension in ROLLUP_DIMENSIONS[collection]:
+            values = (
+                frame[dimension].astype(object).where(frame[dimension].notna(), UNSPECIFIED)
+                .astype(str).str.strip().str[:MAX_VALUE_LENGTH].replace("", UNSPECIFIED)
+            )
+            grouped = pd.DataFrame({"bucket": buckets, "value": values}).groupby(["bucket", "value"]).size()
+            for (bucket, value), total in grouped.items():
+                counts[(granularity, bucket.to_pydatetime(), f"{dimension}.{escape_key(value)}")] += int(total)
+    return counts
+
+
+def rollup_documents(collection: str, counts: Counter, cutoffs: Dict[str, datetime]) -> List[Dict[str, Any]]:
+    docs: Dict[str, Dict[str, Any]] = {}
+    for (granularity, bucket, path), total in counts.items():
+        if bucket >= cutoffs[granularity]:
+            continue
+        key = rollup_id(collection, granularity, bucket)
+        doc = docs.setdefault(key, {"id": key, "collection": collection, "granularity": granularity, "bucket": bucket})
+        if path == "total":
+            doc["total"] = total
+        else:
+            dimension, _, value = path.partition(".")
+            doc.setdefault(dimension, {})[value] = total
+    return list(docs.values())
+
+
+async def backfill(
+    db,
+    repository,
+    collection: str,
+    until: datetime,
+    archive=None,
+    batch_size: int = 20000,
+    schema_mode: str = "legacy",
+) -> Dict[str, int]:
+    import pandas as pd
+
+    codec = codec_for(collection, schema_mode)
+    dimensions = ROLLUP_DIMENSIONS[collection]
+    columns = ["id", "created_at", *dimensions]
+    cutoffs = {granularity: bucket_start(until, granularity) for granularity in GRANULARITIES}
+    raw_until = cutoffs["hour"]
+    counts: Counter = Counter()
+    scanned = 0
+
+    if archive is not None:
+        # Streamed in batches like the collection below, never read whole
+        archived = archive.iter_read(collection, None, raw_until)
+        while True:
+            batch = await asyncio.to_thread(list, islice(archived, batch_size))
+            if not batch:
+                break
+            # Archived but not yet deleted when an archiver run stopped: the
+            # collection scan counts those
+            live = await db[collection].find(
+                codec.query({"id": {"$in": [doc["id"] for doc in batch]}}), {"_id": 0, "id": 1}
+            ).to_list(None)
+            live_ids = {codec.decode(doc)["id"] for doc in live}
+            frame = pd.DataFrame([doc for doc in batch if doc["id"] not in live_ids], columns=columns)
+            counts.update(aggregate_frame(collection, frame))
+            scanned += len(frame)
+
+    projection = {"_id": 0, **{column: 1 for column in columns}}
+    cursor = db[collection].find({"created_at": {"$lt": raw_until}}, projection).batch_size(batch_size)
+    while True:
+        batch = await cursor.to_list(batch_size)
+        if not batch:
+            break
+        frame = pd.DataFrame([codec.decode(doc) for doc in batch], columns=columns)
+        counts.update(aggregate_frame(collection, frame))
+        scanned += len(batch)
+
+    docs = rollup_documents(collection, counts, cutoffs)
+    for start in range(0, len(docs), 1000):
+        await repository.replace(docs[start:start + 1000])
+    produced = {doc["id"] for doc in docs}
+    stale: List[str] = []
+    for granularity, cutoff in cutoffs.items():
+        stale += [i for i in await repository.ids_before(collection, granularity, cutoff) if i not in produced]
+    removed = await repository.delete(stale) if stale else 0
+    return {"scanned": scanned, "rollups": len(docs), "removed": removed}
+
+
+def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from archive import archive_from_env
+    from repositories import create_motor_repositories
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="rebuild rollups from the raw submissions")
+    backfill_parser.add_argument("--collection", choices=sorted(ROLLUP_DIMENSIONS), action="append")
+    backfill_parser.add_argument("--include-archive", action="store_true", help="also count archived submissions")
+    backfill_parser.add_argument("--until", type=datetime.fromisoformat, help="rebuild buckets before this UTC time")
+    backfill_parser.add_argument("--batch-size", type=int, default=20000)
+    args = parser.parse_args()
+
+    until = _naive_utc(args.until) if args.until else bucket_start(datetime.utcnow(), "day")
+    archive = archive_from_env(root_dir) if args.include_archive else None
+
+    async def run():
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        schema_mode = os.environ.get("SCHEMA_MODE", "legacy")
+        repos = create_motor_repositories(db, schema_mode)
+        try:
+            await repos.ensure_indexes()
+            for collection in args.collection or sorted(ROLLUP_DIMENSIONS):
+                result = await backfill(db, repos.rollups, collection, until, archive, args.batch_size, schema_mode)
+                print(json.dumps({"collection": collection, "until": until.isoformat(), **result}))
+        finally:
+            client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Archiving of aged contact and quote submissions.
+
+Retention is opt-in: with CONTACT_RETENTION_DAYS / QUOTE_RETENTION_DAYS set,
+documents older than that are moved out of the hot collections into
+compressed files under ARCHIVE_DIR, partitioned by collection and UTC day.
+Every run writes its own segment files, so runs never append to each
+other's:
+
+    <ARCHIVE_DIR>/quotes/2025-01-15-<run>.ndjson.gz
+    <ARCHIVE_DIR>/quotes/2025-01-15-<run>-<batch>.parquet   (ARCHIVE_FORMAT=parquet)
+
+Each batch is written and fsynced before it is deleted from MongoDB, so a
+crash can at worst leave a document in both places; readers drop duplicates
+by id. A run only starts while holding the "archiver" lease, so of all the
+API workers (ARCHIVE_INTERVAL_MINUTES) and cron jobs one archives at a time:
+
+    python archive.py run
+    python archive.py read quotes --start 2025-01-01 --end 2025-02-01
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from itertools import groupby, islice
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_COLLECTIONS = ("contacts", "quotes")
+ARCHIVE_FORMATS = ("ndjson", "parquet")
+TIMESTAMP_FIELD = "created_at"
+LEASE_NAME = "archiver"
+# How long `archive.py run` may take before another process can take over
+CLI_LEASE_SECONDS = 3600
+
+
+def _partition_day(name: str) -> Optional[date]:
+    try:
+        return date.fromisoformat(name[:10])
+    except ValueError:
+        return None
+
+
+class Archive:
+    """Reads and writes the day-partitioned archive files of one directory."""
+
+    def __init__(self, root: Path, fmt: str = "ndjson"):
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"ARCHIVE_FORMAT must be one of {', '.join(ARCHIVE_FORMATS)}, got {fmt!r}")
+        if fmt == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ValueError("ARCHIVE_FORMAT=parquet requires pyarrow to be installed")
+        self.root = Path(root)
+        self.format = fmt
+
+    def write(self, collection: str, docs: List[Dict[str, Any]], segment: Optional[str] = None) -> None:
+        """Write ``docs`` to the ``segment`` files of their days; only one writer may use a segment."""
+        segment = segment or uuid.uuid4().hex[:12]
+        by_day: Dict[date, List[Dict[str, Any]]] = {}
+        for doc in docs:
+            by_day.setdefault(doc[TIMESTAMP_FIELD].date(), []).append(doc)
+        directory = self.root / collection
+        directory.mkdir(parents=True, exist_ok=True)
+        for day, day_docs in by_day.items():
+            if self.format == "parquet":
+                self._write_parquet(
+                    directory / f"{day.isoformat()}-{segment}-{uuid.uuid4().hex[:8]}.parquet", day_docs
+                )
+            else:
+                self._write_ndjson(directory / f"{day.isoformat()}-{segment}.ndjson.gz", day_docs)
+
+    @staticmethod
+    def _write_ndjson(path: Path, docs: List[Dict[str, Any]]) -> None:
+        # Appending starts a new gzip member; readers see one continuous stream
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc, default=_json_default).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    @staticmethod
+    def _write_parquet(path: Path, docs: List[Dict[str, Any]]) -> None:
+        import pandas as pd
+
+        tmp = path.with_suffix(".tmp")
+        pd.DataFrame(docs).to_parquet(tmp, compression="zstd", index=False)
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        tmp.rename(path)
+
+    def _files(self, collection: str, start: Optional[datetime], end: Optional[datetime]) -> List[Path]:
+        directory = self.root / collection
+        if not directory.is_dir():
+            return []
+        files = []
+        for path in sorted(directory.iterdir()):
+            if not path.name.endswith((".ndjson.gz", ".parquet")):
+                continue
+            day = _partition_day(path.name)
+            if day is None:
+                continue
+            if start is not None and day < start.date():
+                continue
+            if end is not None and day > end.date():
+                continue
+            files.append(path)
+        return files
+
+    def _read_file(self, path: Path) -> Iterator[Dict[str, Any]]:
+        if path.name.endswith(".parquet"):
+            import pandas as pd
+
+            for doc in pd.read_parquet(path).to_dict("records"):
+                yield {k: (v.to_pydatetime() if hasattr(v, "to_pydatetime") else v) for k, v in doc.items()}
+            return
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    doc = json.loads(line)
+                    doc[TIMESTAMP_FIELD] = datetime.fromisoformat(doc[TIMESTAMP_FIELD])
+                    yield doc
+
+    def iter_read(
+        self,
+        collection: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Archived documents with start <= created_at < end, oldest first.
+
+        Holds one day's partition in memory at a time. A document's day comes
+        from its created_at, so copies of it are always in the same partition.
+        """
+        start, end = _naive_utc(start), _naive_utc(end)
+        for _, paths in groupby(self._files(collection, start, end), key=lambda p: _partition_day(p.name)):
+            seen = set()
+            day_docs: List[Dict[str, Any]] = []
+            for path in paths:
+                for doc in self._read_file(path):
+                    ts = doc[TIMESTAMP_FIELD]
+                    if (start is not None and ts < start) or (end is not None and ts >= end):
+                        continue
+                    if doc["id"] in seen:
+                        continue
+                    seen.add(doc["id"])
+                    day_docs.append(doc)
+            day_docs.sort(key=lambda d: d[TIMESTAMP_FIELD])
+            yield from day_docs
+
+    def read(
+        self,
+        collection: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        # Stops reading files once ``limit`` documents are found
+        return list(islice(self.iter_read(collection, start, end), limit or None))
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Archived timestamps are naive UTC, like everything the models store
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class Archiver:
+    def __init__(self, repos, archive: Archive, retention_days: Dict[str, int], batch_size: int = 1000):
+        self.repos = repos
+        self.archive = archive
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.retention_days.get(name) for name in ARCHIVED_COLLECTIONS)
+
+    async def archive_collection(
+        self, collection: str, now: Optional[datetime] = None, segment: Optional[str] = None
+    ) -> int:
+        days = self.retention_days.get(collection)
+        if not days:
+            return 0
+        cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+        repository = getattr(self.repos, collection)
+        moved = 0
+        while True:
+            docs = await repository.list_created_before(cutoff, self.batch_size)
+            if not docs:
+                return moved
+            docs = [{k: v for k, v in doc.items() if k != "_id"} for doc in docs]
+            await asyncio.to_thread(self.archive.write, collection, docs, segment)
+            deleted = await repository.delete([doc["id"] for doc in docs])
+            if not deleted:
+                # Nothing we read could be removed; don't spin on the same batch
+                logger.warning("Archived %d %s but deleted none", len(docs), collection)
+                return moved
+            moved += deleted
+
+    async def run_once(self) -> Dict[str, int]:
+        segment = uuid.uuid4().hex[:12]
+        return {name: await self.archive_collection(name, segment=segment) for name in ARCHIVED_COLLECTIONS}
+
+    async def run_if_leader(self, lease_seconds: float) -> Optional[Dict[str, int]]:
+        """``run_once`` if this archiver holds (or can take) the lease; None otherwise."""
+        now = datetime.utcnow()
+        if not await self.repos.leases.acquire(LEASE_NAME, self.owner, now, now + timedelta(seconds=lease_seconds)):
+            return None
+        return await self.run_once()
+
+    async def release(self) -> None:
+        await self.repos.leases.release(LEASE_NAME, self.owner)
+
+    async def run_forever(self, interval_seconds: float) -> None:
+        # The leader keeps renewing; another worker takes over once a
+        # leader has missed a whole interval
+        try:
+            while True:
+                try:
+                    moved = await self.run_if_leader(interval_seconds * 2)
+                    if moved and any(moved.values()):
+                        logger.info("Archived %s", moved)
+                except Exception:
+                    logger.exception("Archiving failed")
+                await asyncio.sleep(interval_seconds)
+        finally:
+            try:
+                await asyncio.shield(self.release())
+            except Exception:
+                logger.exception("Could not release the archiver lease")
+
+
+def retention_from_env() -> Dict[str, int]:
+    return {
+        "contacts": int(os.environ.get("CONTACT_RETENTION_DAYS", "0")),
+        "quotes": int(os.environ.get("QUOTE_RETENTION_DAYS", "0")),
+    }
+
+
+def archive_from_env(root_dir: Path) -> Archive:
+    return Archive(
+        Path(os.environ.get("ARCHIVE_DIR", root_dir / "archive")),
+        os.environ.get("ARCHIVE_FORMAT", "ndjson"),
+    )
+
+
+def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from repositories import create_motor_repositories
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="archive everything past its retention now")
+    read = commands.add_parser("read", help="print archived documents as NDJSON")
+    read.add_argument("collection", choices=ARCHIVED_COLLECTIONS)
+    read.add_argument("--start", type=datetime.fromisoformat)
+    read.add_argument("--end", type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    archive = archive_from_env(root_dir)
+    if args.command == "read":
+        for doc in archive.read(args.collection, args.start, args.end):
+            print(json.dumps(doc, default=_json_default))
+        return
+
+    async def run():
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        repos = create_motor_repositories(client[os.environ['DB_NAME']], os.environ.get("SCHEMA_MODE", "legacy"))
+        archiver = Archiver(repos, archive, retention_from_env())
+        try:
+            await repos.ensure_indexes()
+            moved = await archiver.run_if_leader(CLI_LEASE_SECONDS)
+            if moved is None:
+                raise SystemExit("Another process holds the archiver lease")
+            print(json.dumps(moved))
+        finally:
+            await archiver.release()
+            client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
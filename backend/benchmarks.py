@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for individual backend subsystems.
+
+    python benchmarks.py compression [--file invoice.pdf --mime application/pdf]
+    python benchmarks.py logging [--requests 20000 --concurrency 50 --sink-delay-ms 0.2]
+    python benchmarks.py coldstart [--runs 5 --mongo]
+    python benchmarks.py passwords [--scheme bcrypt --target-ms 250]
+
+Each subcommand prints a JSON report. For end-to-end API throughput use
+loadtest.py instead.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MB = 1024 * 1024
+
+
+def timed(fn: Callable[[], Any], min_seconds: float = 0.2) -> Tuple[float, Any]:
+    """Best-of-runs seconds per call of ``fn`` and its last result."""
+    best = float("inf")
+    result = None
+    deadline = time.perf_counter() + min_seconds
+    runs = 0
+    while runs < 3 or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+        runs += 1
+    return best, result
+
+
+# Compression
+def sample_payloads() -> List[Tuple[str, str, bytes]]:
+    rng = random.Random(7)
+    products = ["Basmati rice 25kg", "Turmeric powder 10kg", "Cotton yarn 40s", "Cashew W320", "Black pepper 5kg"]
+    packing_list = "".join(
+        f"{i:05d}\t{rng.choice(products)}\tCarton {rng.randint(1, 400)}\t{rng.randint(5, 500)} kg\n"
+        for i in range(40000)
+    ).encode()
+    invoice = json.dumps([
+        {
+            "line": i,
+            "description": rng.choice(products),
+            "hs_code": f"{rng.randint(1000, 9999)}.{rng.randint(10, 99)}",
+            "quantity": rng.randint(1, 1000),
+            "unit_price": round(rng.uniform(1, 500), 2),
+            "currency": "USD",
+        }
+        for i in range(20000)
+    ]).encode()
+    # Text-heavy PDFs keep their content streams uncompressed more often than not
+    pdf = b"%PDF-1.4\n" + b"".join(
+        b"%d 0 obj\n<< /Length 120 >>\nstream\nBT /F1 10 Tf 72 %d Td (%s) Tj ET\nendstream\nendobj\n"
+        % (i, 700 - i % 600, rng.choice(products).encode())
+        for i in range(30000)
+    ) + b"%%EOF\n"
+    scan = rng.randbytes(2 * MB)
+    return [
+        ("packing_list", "text/plain", packing_list),
+        ("invoice_json", "application/json", invoice),
+        ("text_pdf", "application/pdf", pdf),
+        ("scanned_image", "image/jpeg", scan),
+        ("random_pdf", "application/pdf", scan),
+    ]
+
+
+def bench_compression(args) -> Dict[str, Any]:
+    import gzip
+
+    import compression
+
+    payloads = sample_payloads()
+    if args.file:
+        with open(args.file, "rb") as f:
+            payloads.append((os.path.basename(args.file), args.mime, f.read()))
+
+    codecs: List[Tuple[str, Callable[[bytes], bytes], Callable[[bytes], bytes]]] = [
+        ("gzip-1", lambda d: gzip.compress(d, 1, mtime=0), gzip.decompress),
+        ("gzip-6", lambda d: gzip.compress(d, 6, mtime=0), gzip.decompress),
+    ]
+    if compression.zstandard is not None:
+        zstd = compression.zstandard
+        for level in (1, 3, 9):
+            codecs.append((
+                f"zstd-{level}",
+                lambda d, level=level: zstd.ZstdCompressor(level=level).compress(d),
+                lambda d: zstd.ZstdDecompressor().decompress(d),
+            ))
+
+    report: Dict[str, Any] = {"zstandard_installed": compression.zstandard is not None, "payloads": {}}
+    for name, mime_type, data in payloads:
+        size_mb = len(data) / MB
+        choice_seconds, chosen = timed(lambda: compression.choose_codec(mime_type, data[:compression.SAMPLE_SIZE]))
+        entry: Dict[str, Any] = {
+            "mime_type": mime_type,
+            "bytes": len(data),
+            "stored_with": chosen,
+            "decision_ms": round(choice_seconds * 1000, 3),
+            "codecs": {},
+        }
+        for codec_name, compress, decompress in codecs:
+            compress_seconds, packed = timed(lambda: compress(data))
+            decompress_seconds, _ = timed(lambda: decompress(packed))
+            entry["codecs"][codec_name] = {
+                "stored_bytes": len(packed),
+                "ratio": round(len(packed) / len(data), 4),
+                "saved_bytes": len(data) - len(packed),
+                "compress_ms_per_mb": round(compress_seconds * 1000 / size_mb, 2),
+                "decompress_ms_per_mb": round(decompress_seconds * 1000 / size_mb, 2),
+            }
+        report["payloads"][name] = entry
+    return report
+
+
+# Logging
+class SlowSink:
+    """A file whose writes take ``delay`` seconds, like a busy disk or pipe."""
+
+    def __init__(self, f, delay: float):
+        self.f = f
+        self.delay = delay
+
+    def write(self, data: str) -> int:
+        if self.delay:
+            time.sleep(self.delay)
+        return self.f.write(data)
+
+    def flush(self) -> None:
+        self.f.flush()
+
+
+def bench_logging(args) -> Dict[str, Any]:
+    import asyncio
+    import logging
+    import tempfile
+
+    import logs
+
+    app_logger = logging.getLogger("benchmark.app")
+    root = logging.getLogger()
+
+    async def endpoint(scope, receive, send):
+        # One application record per request, as a typical handler would emit
+        app_logger.info("handled %s", scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    async def drive(app) -> Tuple[float, List[float]]:
+        latencies: List[float] = []
+        remaining = iter(range(args.requests))
+
+        async def worker():
+            for i in remaining:
+                scope = {"type": "http", "method": "GET", "path": f"/api/orders/{i}", "headers": []}
+                start = time.perf_counter()
+                await app(scope, receive, send)
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return time.perf_counter() - started, latencies
+
+    def reset_root() -> None:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+
+    report: Dict[str, Any] = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "sink_delay_ms": args.sink_delay_ms,
+        "variants": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for variant in ("none", "sync", "queue"):
+            reset_root()
+            listener = None
+            f = open(os.path.join(tmp, f"{variant}.log"), "w")
+            sink = SlowSink(f, args.sink_delay_ms / 1000)
+            if variant == "none":
+                root.setLevel(logging.CRITICAL)
+                app = endpoint
+            elif variant == "sync":
+                handler = logging.StreamHandler(sink)
+                handler.setFormatter(logs.JsonFormatter())
+                root.addHandler(handler)
+                root.setLevel(logging.INFO)
+                app = logs.AccessLogMiddleware(endpoint)
+            else:
+                listener = logs.setup_logging("INFO", "json", args.queue_size, stream=sink)
+                app = logs.AccessLogMiddleware(endpoint)
+
+            elapsed, latencies = asyncio.run(drive(app))
+            drain_started = time.perf_counter()
+            dropped = 0
+            if listener is not None:
+                listener.stop()
+                dropped = root.handlers[0].dropped
+            drain = time.perf_counter() - drain_started
+            f.close()
+            latencies.sort()
+            report["variants"][variant] = {
+                "us_per_request": round(elapsed / args.requests * 1e6, 2),
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+                "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+                "max_ms": round(latencies[-1] * 1000, 3),
+                "drain_ms": round(drain * 1000, 1),
+                "dropped_records": dropped,
+            }
+        reset_root()
+
+    baseline = report["variants"]["none"]["us_per_request"]
+    for entry in report["variants"].values():
+        entry["overhead_us_per_request"] = round(entry["us_per_request"] - baseline, 2)
+    return report
+
+
+# Cold start
+def coldstart_child() -> Dict[str, Any]:
+    """Start the app in this fresh process and time its first requests."""
+    import asyncio
+
+    spawned = float(os.environ["COLDSTART_SPAWNED"])
+
+    def since_spawn() -> float:
+        return round((time.time() - spawned) * 1000, 1)
+
+    import httpx
+
+    import server
+
+    result: Dict[str, Any] = {"imported_ms": since_spawn()}
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with server.app.router.lifespan_context(server.app):
+            result["started_ms"] = since_spawn()
+            async with httpx.AsyncClient(transport=transport, base_url="http://coldstart") as client:
+                email = f"coldstart-{os.getpid()}-{time.time_ns()}@example.com"
+                credentials = {"email": email, "password": "coldstart-password"}
+                started = time.perf_counter()
+                await client.post("/api/register", json={"name": "Cold Start", "company": "Benchmark", **credentials})
+                result["first_byte_ms"] = since_spawn()
+                result["first_request_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+                response = await client.post("/api/login", json=credentials)
+                headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+                for label in ("first_read_ms", "second_read_ms"):
+                    started = time.perf_counter()
+                    await client.get("/api/orders", headers=headers)
+                    result[label] = round((time.perf_counter() - started) * 1000, 2)
+
+    asyncio.run(run())
+    return result
+
+
+def bench_coldstart(args) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"storage_engine": "mongo" if args.mongo else "memory", "runs": args.runs, "variants": {}}
+    for label, warmup in (("without_warmup", "0"), ("with_warmup", "1")):
+        runs = []
+        for _ in range(args.runs):
+            env = {
+                **os.environ,
+                "WARMUP": warmup,
+                "LOG_LEVEL": "WARNING",
+                "ARCHIVE_INTERVAL_MINUTES": "0",
+                "COLDSTART_SPAWNED": repr(time.time()),
+            }
+            if not args.mongo:
+                env["STORAGE_ENGINE"] = "memory"
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "coldstart", "--child"],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output))
+        report["variants"][label] = {
+            key: statistics.median(run[key] for run in runs) for key in runs[0]
+        }
+    return report
+
+
+# Password hashing
+def bench_passwords(args) -> Dict[str, Any]:
+    """Time each cost of a scheme and pick the highest that fits ``--target-ms``."""
+    from passwords import ARGON2, PasswordHasher
+
+    if args.scheme == ARGON2:
+        env = "PASSWORD_ARGON2_TIME_COST"
+        costs = range(1, 21)
+
+        def hasher_for(cost):
+            return PasswordHasher(
+                ARGON2, argon2_time_cost=cost, argon2_memory_kib=args.memory_kib, argon2_parallelism=args.parallelism
+            )
+    else:
+        env = "PASSWORD_BCRYPT_ROUNDS"
+        costs = range(8, 21)  # each round doubles the time
+
+        def hasher_for(cost):
+            return PasswordHasher(bcrypt_rounds=cost)
+
+    timings = []
+    for cost in costs:
+        hasher = hasher_for(cost)
+        hasher.load_backend()
+        seconds, _ = timed(lambda: hasher.hash_sync("benchmark-password"), min_seconds=0)
+        timings.append({"cost": cost, "hash_ms": round(seconds * 1000, 1)})
+        if seconds * 1000 > args.target_ms:
+            break
+    within = [t for t in timings if t["hash_ms"] <= args.target_ms]
+    chosen = within[-1] if within else timings[0]
+    cpus = os.cpu_count() or 1
+    report: Dict[str, Any] = {
+        "scheme": args.scheme,
+        "target_ms": args.target_ms,
+        "timings": timings,
+        "recommended": {"PASSWORD_SCHEME": args.scheme, env: chosen["cost"]},
+        # Hashing releases the GIL, so logins scale with cores until the threadpool is full
+        "max_logins_per_second": round(cpus * 1000 / chosen["hash_ms"], 1),
+        "cpus": cpus,
+    }
+    if args.scheme == ARGON2:
+        report["recommended"].update({
+            "PASSWORD_ARGON2_MEMORY_KIB": args.memory_kib, "PASSWORD_ARGON2_PARALLELISM": args.parallelism,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compression_parser = commands.add_parser("compression", help="storage saved and CPU cost per MB")
+    compression_parser.add_argument("--file", help="also benchmark this file")
+    compression_parser.add_argument("--mime", default="application/octet-stream", help="mime type of --file")
+    compression_parser.set_defaults(run=bench_compression)
+
+    logging_parser = commands.add_parser("logging", help="event loop time spent on access and app logging")
+    logging_parser.add_argument("--requests", type=int, default=20000)
+    logging_parser.add_argument("--concurrency", type=int, default=50)
+    logging_parser.add_argument("--sink-delay-ms", type=float, default=0.0, help="simulate a slow log destination")
+    logging_parser.add_argument("--queue-size", type=int, default=10000)
+    logging_parser.set_defaults(run=bench_logging)
+
+    coldstart_parser = commands.add_parser("coldstart", help="process start to first byte, with and without warmup")
+    coldstart_parser.add_argument("--runs", type=int, default=5, help="fresh processes per variant (medians reported)")
+    coldstart_parser.add_argument("--mongo", action="store_true", help="use MONGO_URL from .env instead of memory storage")
+    coldstart_parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    coldstart_parser.set_defaults(run=lambda args: coldstart_child() if args.child else bench_coldstart(args))
+
+    passwords_parser = commands.add_parser("passwords", help="time per password hash by cost; recommends a cost")
+    passwords_parser.add_argument("--scheme", choices=["bcrypt", "argon2"], default="bcrypt")
+    passwords_parser.add_argument("--target-ms", type=float, default=250.0, help="budget for one hash on this host")
+    passwords_parser.add_argument("--memory-kib", type=int, default=64 * 1024, help="argon2 memory cost")
+    passwords_parser.add_argument("--parallelism", type=int, default=1, help="argon2 lanes")
+    passwords_parser.set_defaults(run=bench_passwords)
+
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
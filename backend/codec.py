@@ -0,0 +1,150 @@
+"""Codec between the API models and their stored MongoDB representation.
+
+The models always use string UUIDs and naive UTC datetimes. In the compact
+schema ids are stored as BSON binary UUIDs (16 bytes instead of a 36-byte
+string, in every document and every index) and datetimes are normalized to
+timezone-aware UTC before they are written.
+
+Datetimes are converted wherever they are nested (embedded documents and
+arrays); ids are only converted in the top-level fields named in
+``ID_FIELDS``.
+
+``SCHEMA_MODE`` selects the representation:
+
+* ``legacy``  - ids stay strings (default)
+* ``dual``    - writes use binary ids, reads and queries accept both; run the
+                app in this mode while ``migrate_compact.py`` converts data
+* ``compact`` - binary ids only, once the migration has finished
+"""
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson.binary import Binary, UuidRepresentation
+
+SCHEMA_MODES = ("legacy", "dual", "compact")
+
+# Fields holding a UUID, per collection
+ID_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "users": ("id",),
+    "orders": ("id", "user_id"),
+    "documents": ("id", "order_id", "user_id"),
+    "messages": ("id", "user_id", "order_id", "replied_to"),
+    "contacts": ("id",),
+    "quotes": ("id",),
+    "status_checks": ("id",),
+    "upload_sessions": ("id", "user_id", "order_id", "document_id"),
+    "user_summaries": ("id",),
+    "order_events": ("id", "order_id", "user_id"),
+}
+
+
+def uuid_to_binary(value: Any) -> Any:
+    """Return ``value`` as a binary UUID, or unchanged if it isn't a UUID string."""
+    if not isinstance(value, str):
+        return value
+    try:
+        return Binary.from_uuid(uuid.UUID(value), UuidRepresentation.STANDARD)
+    except ValueError:
+        return value
+
+
+def binary_to_uuid(value: Any) -> Any:
+    if isinstance(value, Binary) and value.subtype == 4:
+        return str(value.as_uuid(UuidRepresentation.STANDARD))
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def to_utc(value: datetime) -> datetime:
+    # Naive datetimes are UTC throughout the app (datetime.utcnow)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _encode_times(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return to_utc(value)
+    if isinstance(value, dict):
+        return {key: _encode_times(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_encode_times(item) for item in value]
+    return value
+
+
+def _decode_times(value: Any) -> Any:
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, dict):
+        return {key: _decode_times(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode_times(item) for item in value]
+    return value
+
+
+class DocumentCodec:
+    def __init__(self, id_fields: Iterable[str] = (), mode: str = "legacy"):
+        if mode not in SCHEMA_MODES:
+            raise ValueError(f"SCHEMA_MODE must be one of {', '.join(SCHEMA_MODES)}, got {mode!r}")
+        self.id_fields = frozenset(id_fields)
+        self.mode = mode
+
+    @property
+    def binary_ids(self) -> bool:
+        return self.mode != "legacy"
+
+    def encode(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Model dict -> stored document."""
+        encoded = {}
+        for key, value in doc.items():
+            if self.binary_ids and key in self.id_fields:
+                value = uuid_to_binary(value)
+            else:
+                value = _encode_times(value)
+            encoded[key] = value
+        return encoded
+
+    def decode(self, doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Stored document -> model dict (string ids, naive UTC datetimes)."""
+        if doc is None:
+            return None
+        decoded = {}
+        for key, value in doc.items():
+            if key in self.id_fields:
+                value = binary_to_uuid(value)
+            else:
+                value = _decode_times(value)
+            decoded[key] = value
+        return decoded
+
+    def query(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """Rewrite equality matches on id fields for the stored representation."""
+        if not self.binary_ids:
+            return query
+        encoded = {}
+        for key, value in query.items():
+            if key in self.id_fields:
+                if isinstance(value, str):
+                    matches = self._match_values([value])
+                    value = matches[0] if len(matches) == 1 else {"$in": matches}
+                elif isinstance(value, dict) and "$in" in value:
+                    value = {**value, "$in": self._match_values(value["$in"])}
+            encoded[key] = value
+        return encoded
+
+    def _match_values(self, values) -> List[Any]:
+        matches = []
+        for value in values:
+            binary = uuid_to_binary(value)
+            matches.append(binary)
+            if self.mode == "dual" and binary is not value:
+                matches.append(value)
+        return matches
+
+
+def codec_for(collection: str, mode: str = "legacy") -> DocumentCodec:
+    return DocumentCodec(ID_FIELDS.get(collection, ()), mode)
@@ -0,0 +1,272 @@
+"""Compression for stored documents and API responses.
+
+Documents are compressed at rest when their type is not already compressed
+and a sample actually shrinks; zstd is used when the optional ``zstandard``
+package is installed, gzip otherwise. ``CompressionMiddleware`` compresses
+large responses and keeps the compressed bytes of ETag-tagged responses in a
+small LRU so hot payloads are only compressed once per version.
+"""
+import asyncio
+import base64
+import binascii
+import gzip
+import zlib
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# Formats that are compressed already; trying again just burns CPU
+INCOMPRESSIBLE_TYPES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/heic",
+    "video/", "audio/",
+    "application/zip", "application/gzip", "application/x-gzip", "application/zstd",
+    "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/vnd.openxmlformats-officedocument.",
+)
+SAMPLE_SIZE = 256 * 1024
+FILE_READ_SIZE = 1024 * 1024
+# Store compressed only if the sample shrinks to at most this fraction
+MAX_RATIO = 0.9
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def default_codec() -> str:
+    return ZSTD if zstandard is not None else GZIP
+
+
+def is_compressible_type(mime_type: str) -> bool:
+    mime_type = (mime_type or "").lower()
+    return not mime_type.startswith(INCOMPRESSIBLE_TYPES)
+
+
+def compress_bytes(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def decompress_bytes(data: bytes, codec: Optional[str]) -> bytes:
+    if codec is None:
+        return data
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+
+def choose_codec(mime_type: str, sample: bytes) -> Optional[str]:
+    """Codec worth storing ``sample``'s document with, or None to store it raw."""
+    if not sample or not is_compressible_type(mime_type):
+        return None
+    codec = default_codec()
+    sample = sample[:SAMPLE_SIZE]
+    if len(compress_bytes(sample, codec)) > len(sample) * MAX_RATIO:
+        return None
+    return codec
+
+
+def pack_base64(file_data: str, mime_type: str) -> Tuple[str, Optional[str], int]:
+    """Compress base64 ``file_data`` for storage.
+
+    Returns the base64 to store, the codec used (None if stored as sent) and
+    the stored size in bytes.
+    """
+    try:
+        raw = base64.b64decode(file_data, validate=True)
+    except (binascii.Error, ValueError):
+        # Not valid base64; keep exactly what the client sent
+        return file_data, None, len(file_data)
+    codec = choose_codec(mime_type, raw[:SAMPLE_SIZE])
+    if codec is None:
+        return file_data, None, len(raw)
+    compressed = compress_bytes(raw, codec)
+    return base64.b64encode(compressed).decode(), codec, len(compressed)
+
+
+def unpack_base64(stored: str, codec: Optional[str]) -> str:
+    if codec is None:
+        return stored
+    return base64.b64encode(decompress_bytes(base64.b64decode(stored), codec)).decode()
+
+
+def _compressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _decompressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def decompress_file(source: str, target: str, codec: str) -> None:
+    """Decompress the file ``source`` into ``target`` without reading it whole."""
+    decompressor = _decompressor(codec)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        while True:
+            chunk = src.read(FILE_READ_SIZE)
+            if not chunk:
+                break
+            dst.write(decompressor.decompress(chunk))
+        if codec == GZIP:
+            dst.write(decompressor.flush())
+
+
+async def compress_stream(chunks: AsyncIterator[bytes], codec: str) -> AsyncIterator[bytes]:
+    compressor = _compressor(codec)
+    async for chunk in chunks:
+        out = await asyncio.to_thread(compressor.compress, chunk)
+        if out:
+            yield out
+    tail = compressor.flush()
+    if tail:
+        yield tail
+
+
+async def decompress_stream(chunks: AsyncIterator[bytes], codec: Optional[str]) -> AsyncIterator[bytes]:
+    if codec is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    decompressor = _decompressor(codec)
+    async for chunk in chunks:
+        out = await asyncio.to_thread(decompressor.decompress, chunk)
+        if out:
+            yield out
+    if codec == GZIP:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+class LRUBytesCache:
+    """An LRU of byte strings bounded by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._items: "OrderedDict[Tuple, bytes]" = OrderedDict()
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key: Tuple, value: bytes) -> None:
+        if len(value) > self.max_bytes // 8:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._items[key] = value
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._size -= len(evicted)
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into encoding -> q value."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def _accepted_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = accepted_encodings(accept_encoding)
+    if zstandard is not None and accepted.get(ZSTD, 0) > 0:
+        return ZSTD
+    if accepted.get(GZIP, 0) > 0:
+        return GZIP
+    return None
+
+
+class CompressionMiddleware:
+    """Compresses complete (non-streaming) responses above ``minimum_size``.
+
+    Responses carrying an ETag are cached compressed under (path, query,
+    ETag, encoding); the ETag changes with the data, so entries never go
+    stale.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, cache_bytes: int = 16 * 1024 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = LRUBytesCache(cache_bytes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        encoding = _accepted_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message: Dict = {}
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            response_headers = dict(start_message.get("headers", []))
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or b"content-encoding" in response_headers
+                or not is_compressible_type(response_headers.get(b"content-type", b"").decode("latin-1"))
+            ):
+                passthrough = True
+                await send(start_message)
+                return await send(message)
+
+            etag = response_headers.get(b"etag")
+            key = (scope["path"], scope.get("query_string", b""), etag, encoding) if etag else None
+            compressed = self.cache.get(key) if key else None
+            if compressed is None:
+                if len(body) > SAMPLE_SIZE:
+                    compressed = await asyncio.to_thread(compress_bytes, body, encoding)
+                else:
+                    compressed = compress_bytes(body, encoding)
+                if key:
+                    self.cache.put(key, compressed)
+
+            new_headers = [
+                (k, v) for k, v in start_message["headers"]
+                if k.lower() not in (b"content-length", b"vary")
+            ]
+            vary = response_headers.get(b"vary")
+            new_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"),
+            ]
+            await send({**start_message, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,221 @@
+"""Idempotency-Key support for retried POSTs.
+
+A client that retries a request with the same ``Idempotency-Key`` header gets
+the response of the first attempt replayed without the route running, so a
+retried order is not created twice and a retried upload is not decoded,
+validated and stored again. Keys are scoped to the authenticated user and
+route. The SHA-256 of the request body is stored with the key, and reusing a
+key with a different body is refused with 422 instead of replaying a
+response to another request.
+
+Completed responses live in the ``idempotency_keys`` collection (expired by a
+TTL index) with a small in-process LRU in front. While the first attempt is
+running its key is reserved: duplicates in the same process wait for it,
+duplicates in other workers poll the stored record. Only 2xx responses are
+kept; after any other outcome the key is released and a retry runs again.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+PENDING = "pending"
+COMPLETED = "completed"
+KEY_REUSED = "Idempotency-Key was already used with a different request body"
+# Response headers that describe this particular transmission, not the result
+_VOLATILE_HEADERS = {b"content-length", b"date", b"server", b"x-request-id"}
+
+
+class ResponseCache:
+    """An LRU of completed responses that also honours their expiry."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._items: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, response = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        self._items[key] = (time.monotonic() + self.ttl_seconds, response)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+
+async def _send_stored(send, response: Dict[str, Any]) -> None:
+    headers = [(bytes(k), bytes(v)) for k, v in response["headers"]]
+    body = bytes(response["body"])
+    headers += [
+        (b"content-length", str(len(body)).encode()),
+        (b"idempotent-replayed", b"true"),
+    ]
+    await send({"type": "http.response.start", "status": response["status_code"], "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive) -> bytes:
+    parts = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        parts.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(parts)
+
+
+def _replay_body(body: bytes, receive):
+    """A ``receive`` that hands the app ``body`` again, then defers to the client."""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+def _conflicts(stored: Optional[str], fingerprint: str) -> bool:
+    # Records from before fingerprints were stored have none
+    return stored is not None and stored != fingerprint
+
+
+async def _send_error(send, status_code: int, detail: str) -> None:
+    body = ('{"detail":"%s"}' % detail).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    def __init__(
+        self,
+        app,
+        principal: Callable[[str], Optional[str]],
+        routes: Set[Tuple[str, str]],
+        ttl_seconds: float = 24 * 3600,
+        cache_size: int = 1024,
+        wait_seconds: float = 30.0,
+        lock_seconds: float = 120.0,
+    ):
+        """``principal`` maps an Authorization header to the user it identifies."""
+        self.app = app
+        self.principal = principal
+        self.routes = routes
+        self.cache = ResponseCache(cache_size, ttl_seconds)
+        self.wait_seconds = wait_seconds
+        self.lock_seconds = lock_seconds
+        self._inflight: Dict[str, "asyncio.Future[bool]"] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(IDEMPOTENCY_HEADER)
+        subject = self.principal(headers.get(b"authorization", b"").decode("latin-1"))
+        if idempotency_key is None or subject is None:
+            # Unauthenticated requests are rejected by the route itself
+            return await self.app(scope, receive, send)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return await _send_error(send, 400, f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+
+        key = hashlib.sha256(
+            b"\n".join([subject.encode(), scope["method"].encode(), scope["path"].encode(), idempotency_key])
+        ).hexdigest()
+        repository = scope["app"].state.repositories.idempotency_keys
+        body = await _read_body(receive)
+        receive = _replay_body(body, receive)
+        fingerprint = hashlib.sha256(body).hexdigest()
+        deadline = time.monotonic() + self.wait_seconds
+
+        while True:
+            response = self.cache.get(key)
+            if response is not None:
+                if _conflicts(response.get("fingerprint"), fingerprint):
+                    return await _send_error(send, 422, KEY_REUSED)
+                return await _send_stored(send, response)
+
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                # Same process: wait for the first attempt instead of racing it
+                try:
+                    await asyncio.wait_for(asyncio.shield(inflight), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    return await _send_error(send, 409, "A request with this Idempotency-Key is in progress")
+                continue
+
+            record = await repository.get(key)
+            if record is not None and _conflicts(record.get("fingerprint"), fingerprint):
+                return await _send_error(send, 422, KEY_REUSED)
+            if record is not None and record["status"] == COMPLETED:
+                self.cache.put(key, record["response"])
+                continue
+            now = datetime.utcnow()
+            if record is not None:
+                # Another worker has it; take over only if that attempt is abandoned
+                stale_before = now - timedelta(seconds=self.lock_seconds)
+                if not await repository.take_over(key, stale_before, now):
+                    if time.monotonic() >= deadline:
+                        return await _send_error(send, 409, "A request with this Idempotency-Key is in progress")
+                    await asyncio.sleep(0.2)
+                    continue
+            elif not await repository.reserve(key, subject, now, fingerprint):
+                continue
+            return await self._run(key, fingerprint, repository, scope, receive, send)
+
+    async def _run(self, key: str, fingerprint: str, repository, scope, receive, send) -> None:
+        done = asyncio.get_running_loop().create_future()
+        self._inflight[key] = done
+        captured: Dict[str, Any] = {"status_code": 500, "headers": [], "body": b"", "fingerprint": fingerprint}
+        body_parts = []
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                captured["status_code"] = message["status"]
+                captured["headers"] = [
+                    [k, v] for k, v in message.get("headers", []) if k.lower() not in _VOLATILE_HEADERS
+                ]
+            elif message["type"] == "http.response.body":
+                body_parts.append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, receive, send_wrapper)
+            if 200 <= captured["status_code"] < 300:
+                captured["body"] = b"".join(body_parts)
+                await repository.complete(key, captured)
+                self.cache.put(key, captured)
+                stored = True
+        finally:
+            if not stored:
+                try:
+                    await repository.release(key)
+                except Exception:
+                    logger.exception("Could not release idempotency key")
+            del self._inflight[key]
+            done.set_result(stored)
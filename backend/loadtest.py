@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Load-testing and regression benchmark harness for the portal API.
+
+Drives the FastAPI app in-process through an ASGI transport (backed by the
+memory storage engine, with the app's lifespan running as in production) or
+a running server via --url, runs a weighted mix of scenarios and reports
+throughput and latency percentiles per route as JSON.
+
+    python loadtest.py --duration 10 --concurrency 32 --output result.json
+    python loadtest.py --baseline baseline.json --threshold 0.15
+    python loadtest.py --url http://127.0.0.1:8001 --mix dashboard=5,orders=1
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+DEFAULT_MIX = {
+    "login": 1,
+    "dashboard": 4,
+    "orders": 2,
+    "documents": 1,
+    "messages": 4,
+}
+PASSWORD = "LoadTest123!"
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, route: str, seconds: float, ok: bool):
+        self.latencies[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        routes = {}
+        all_latencies: List[float] = []
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            all_latencies.extend(values)
+            routes[route] = self._stats(values, self.errors[route], elapsed)
+        total = self._stats(sorted(all_latencies), sum(self.errors.values()), elapsed)
+        return {"elapsed_s": round(elapsed, 3), "total": total, "routes": routes}
+
+    @staticmethod
+    def _stats(values: List[float], errors: int, elapsed: float) -> Dict[str, Any]:
+        ms = 1000.0
+        return {
+            "count": len(values),
+            "errors": errors,
+            "rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms": round(sum(values) / len(values) * ms, 3) if values else 0.0,
+            "p50_ms": round(percentile(values, 50) * ms, 3),
+            "p95_ms": round(percentile(values, 95) * ms, 3),
+            "p99_ms": round(percentile(values, 99) * ms, 3),
+            "max_ms": round(values[-1] * ms, 3) if values else 0.0,
+        }
+
+
+class VirtualUser:
+    """A registered portal user with a token and some orders to work on."""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+        self.email = f"load-{uuid.uuid4().hex[:12]}@loadtest.example.com"
+        self.headers: Dict[str, str] = {}
+        self.order_ids: List[str] = []
+        self.document_ids: List[str] = []
+        self.etags: Dict[str, str] = {}
+
+    async def call(self, route: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.recorder.record(route, time.perf_counter() - start, response.status_code < 400)
+        return response
+
+    async def poll(self, route: str, url: str) -> httpx.Response:
+        """GET ``url`` conditionally, like a client with an HTTP cache."""
+        headers = dict(self.headers)
+        if url in self.etags:
+            headers["If-None-Match"] = self.etags[url]
+        response = await self.call(route, "GET", url, headers=headers)
+        if "etag" in response.headers:
+            self.etags[url] = response.headers["etag"]
+        return response
+
+    async def setup(self):
+        await self.call("POST /api/register", "POST", "/api/register", json={
+            "name": "Load Test",
+            "email": self.email,
+            "company": "Load Test Exports",
+            "password": PASSWORD,
+        })
+        await self.login()
+        await self.create_order()
+
+    async def login(self):
+        response = await self.call("POST /api/login", "POST", "/api/login", json={
+            "email": self.email,
+            "password": PASSWORD,
+        })
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def create_order(self):
+        response = await self.call("POST /api/orders", "POST", "/api/orders", headers=self.headers, json={
+            "product_category": "Rice",
+            "product_description": "Basmati rice, 25kg bags",
+            "quantity": "500 bags",
+            "destination_country": random.choice(["UAE", "India", "Germany", "Kenya"]),
+            "notes": "load test",
+        })
+        if response.status_code == 200:
+            self.order_ids.append(response.json()["id"])
+
+
+async def scenario_login(user: VirtualUser):
+    await user.login()
+
+
+async def scenario_dashboard(user: VirtualUser):
+    await user.call("GET /api/dashboard/stats", "GET", "/api/dashboard/stats", headers=user.headers)
+    await user.call("GET /api/orders", "GET", "/api/orders", headers=user.headers)
+    if user.order_ids:
+        order_id = random.choice(user.order_ids)
+        await user.call("GET /api/orders/{order_id}", "GET", f"/api/orders/{order_id}", headers=user.headers)
+
+
+async def scenario_orders(user: VirtualUser):
+    await user.create_order()
+
+
+DOCUMENT_PAYLOAD = base64.b64encode(b"Packing list line item, 25kg bags, basmati rice\n" * 2000).decode()
+
+
+async def scenario_documents(user: VirtualUser):
+    if not user.order_ids:
+        return
+    order_id = random.choice(user.order_ids)
+    response = await user.call("POST /api/documents", "POST", "/api/documents", headers=user.headers, json={
+        "order_id": order_id,
+        "document_type": "packing_list",
+        "filename": "packing_list.txt",
+        "file_data": DOCUMENT_PAYLOAD,
+        "file_size": len(DOCUMENT_PAYLOAD) * 3 // 4,
+        "mime_type": "text/plain",
+    })
+    if response.status_code == 200:
+        user.document_ids.append(response.json()["id"])
+    await user.call(
+        "GET /api/orders/{order_id}/documents", "GET", f"/api/orders/{order_id}/documents", headers=user.headers
+    )
+    if user.document_ids:
+        document_id = random.choice(user.document_ids)
+        await user.call("GET /api/documents/{document_id}", "GET", f"/api/documents/{document_id}", headers=user.headers)
+
+
+async def scenario_messages(user: VirtualUser):
+    await user.poll("GET /api/messages", "/api/messages")
+    if random.random() < 0.1:
+        await user.call("POST /api/messages", "POST", "/api/messages", headers=user.headers, json={
+            "subject": "Shipment query",
+            "content": "When will the container leave port?",
+        })
+
+
+SCENARIOS: Dict[str, Callable[[VirtualUser], Any]] = {
+    "login": scenario_login,
+    "dashboard": scenario_dashboard,
+    "orders": scenario_orders,
+    "documents": scenario_documents,
+    "messages": scenario_messages,
+}
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+@asynccontextmanager
+async def connect(url: Optional[str]) -> AsyncIterator[httpx.AsyncClient]:
+    if url:
+        async with httpx.AsyncClient(base_url=url.rstrip("/"), timeout=30) as client:
+            yield client
+        return
+    # In-process: default to the memory engine so no Mongo server is needed
+    os.environ.setdefault("STORAGE_ENGINE", "memory")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from server import app
+
+    # Indexes, warmup and the background writers are part of what's measured
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=30) as client:
+            yield client
+
+
+async def run(args) -> Dict[str, Any]:
+    random.seed(args.seed)
+    async with connect(args.url) as client:
+        setup_recorder = Recorder()
+        users = [VirtualUser(client, setup_recorder) for _ in range(args.users)]
+        await asyncio.gather(*(user.setup() for user in users))
+
+        recorder = Recorder()
+        for user in users:
+            user.recorder = recorder
+        names = list(args.mix)
+        weights = [args.mix[name] for name in names]
+        deadline = time.perf_counter() + args.duration
+        remaining = [args.iterations] if args.iterations else None
+
+        async def worker(worker_id: int):
+            rng = random.Random(args.seed + worker_id)
+            while time.perf_counter() < deadline:
+                if remaining is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                user = users[rng.randrange(len(users))]
+                await SCENARIOS[rng.choices(names, weights)[0]](user)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    report = recorder.summary(elapsed)
+    report["config"] = {
+        "target": args.url or "in-process",
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "iterations": args.iterations,
+        "mix": args.mix,
+        "seed": args.seed,
+    }
+    return report
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Return a description of every metric that regressed beyond threshold."""
+    regressions = []
+    base_rps = baseline["total"]["rps"]
+    if base_rps and report["total"]["rps"] < base_rps * (1 - threshold):
+        regressions.append(f"total: rps {report['total']['rps']} < baseline {base_rps}")
+    for route, base in baseline["routes"].items():
+        current = report["routes"].get(route)
+        if current is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if base[metric] and current[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{route}: {metric} {current[metric]} > baseline {base[metric]}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running server (default: in-process ASGI)")
+    parser.add_argument("--users", type=int, default=20, help="virtual users to register")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent workers")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--iterations", type=int, default=0, help="stop after this many scenarios (0: no limit)")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="scenario weights, e.g. login=1,dashboard=4")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="fail if this stored report is regressed beyond --threshold")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    parser.add_argument("--save-baseline", help="also store the report as the new baseline")
+    args = parser.parse_args(argv)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print("REGRESSIONS:", file=sys.stderr)
+            for line in regressions:
+                print(f"  - {line}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""Structured, non-blocking logging.
+
+``setup_logging`` points the root logger at a ``QueueHandler``; a
+``QueueListener`` thread formats the records as JSON lines and writes them,
+so code on the event loop only pays for putting a record on a queue. If the
+queue fills up (the sink is stuck) records are dropped and counted instead
+of blocking.
+
+``AccessLogMiddleware`` gives every request a context (request id, user id,
+time spent in repository calls) that is attached to each record logged while
+handling it, and writes one access record per request. Repository time is
+only known when the repositories are instrumented (LOG_DB_TIMING or
+profiling), and ``db_timing`` says whether to report it. Routes named in
+LOG_SAMPLE_RATES are only logged for a fraction of requests; errors and slow
+requests are always logged.
+"""
+import json
+import logging
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+access_logger = logging.getLogger("access")
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class RequestContext:
+    __slots__ = ("request_id", "user_id", "db_ms", "db_calls")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.user_id: Optional[str] = None
+        self.db_ms = 0.0
+        self.db_calls = 0
+
+
+_context: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+
+def current_context() -> Optional[RequestContext]:
+    return _context.get()
+
+
+def set_user(user_id: str) -> None:
+    context = _context.get()
+    if context is not None:
+        context.user_id = user_id
+
+
+def add_db_time(seconds: float) -> None:
+    context = _context.get()
+    if context is not None:
+        context.db_ms += seconds * 1000
+        context.db_calls += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ContextQueueHandler(QueueHandler):
+    """Queues records without formatting them on the caller's thread.
+
+    Only the request context (which lives in contextvars, so is invisible to
+    the listener thread) and the merged message are captured here.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        context = _context.get()
+        if context is not None:
+            record.request_id = context.request_id
+            if context.user_id is not None:
+                record.user_id = context.user_id
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RestartableQueueListener(QueueListener):
+    """A ``QueueListener`` whose start and stop may be called repeatedly.
+
+    The app starts it at import and stops it at the end of every lifespan;
+    an app started again in the same process (tests, reloads) restarts it.
+    """
+
+    def start(self) -> None:
+        if self._thread is None:
+            super().start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(
+    level: str = "INFO",
+    fmt: str = "json",
+    queue_size: int = 10000,
+    stream=None,
+) -> RestartableQueueListener:
+    """Route all logging through a queue; returns the started listener."""
+    sink = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "json":
+        sink.setFormatter(JsonFormatter())
+    else:
+        sink.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    handler = ContextQueueHandler(queue.Queue(queue_size))
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    # uvicorn's own loggers go through the queue too; its access log is
+    # replaced by AccessLogMiddleware
+    for name in ("uvicorn", "uvicorn.error"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    logging.getLogger("uvicorn.access").disabled = True
+
+    listener = RestartableQueueListener(handler.queue, sink, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """Parse ``"get_status_checks=0.01,root=0.1"`` into route name -> rate."""
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class AccessLogMiddleware:
+    def __init__(
+        self,
+        app,
+        sample_rates: Optional[Dict[str, float]] = None,
+        slow_ms: float = 1000.0,
+        db_timing: bool = False,
+    ):
+        self.app = app
+        self.sample_rates = sample_rates or {}
+        self.slow_ms = slow_ms
+        self.db_timing = db_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for key, value in scope["headers"]:
+            if key == REQUEST_ID_HEADER:
+                request_id = value.decode("latin-1")[:64]
+                break
+        context = RequestContext(request_id or uuid.uuid4().hex)
+        token = _context.set(context)
+        started = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                message = {
+                    **message,
+                    "headers": list(message.get("headers", [])) + [(REQUEST_ID_HEADER, context.request_id.encode("latin-1"))],
+                }
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            self._log(scope, context, response, duration_ms)
+            _context.reset(token)
+
+    def _log(self, scope, context: RequestContext, response: Dict[str, int], duration_ms: float) -> None:
+        route = scope.get("route")
+        name = getattr(route, "name", None)
+        rate = self.sample_rates.get(name, 1.0) if name else 1.0
+        if (
+            rate < 1.0
+            and response["status"] < 500
+            and duration_ms < self.slow_ms
+            and random.random() >= rate
+        ):
+            return
+        access_logger.info(
+            "%s %s %d",
+            scope["method"],
+            scope["path"],
+            response["status"],
+            extra={
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": getattr(route, "path", None),
+                "status": response["status"],
+                "duration_ms": round(duration_ms, 3),
+                "response_bytes": response["bytes"],
+                "db_ms": round(context.db_ms, 3) if self.db_timing else None,
+                "db_calls": context.db_calls if self.db_timing else None,
+                "sample_rate": rate if rate < 1.0 else None,
+            },
+        )
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Online, resumable migration to the compact storage schema.
+
+Converts string UUIDs in every id field to BSON binary UUIDs (see codec.py).
+Stored BSON dates are already UTC, so datetimes need no rewrite; the codec
+normalizes them on every write from now on.
+
+Run the API with SCHEMA_MODE=dual while this runs so reads and queries match
+both representations, then switch to SCHEMA_MODE=compact.
+
+Documents are processed in _id order in small batches. Each update is
+conditional on the id fields still holding the values that were read, so
+concurrent writers are never overwritten, and progress is checkpointed in
+the ``schema_migrations`` collection so an interrupted run picks up where it
+stopped.
+
+    python migrate_compact.py                  # migrate all collections
+    python migrate_compact.py --report-only    # just print storage stats
+    python migrate_compact.py orders --reset   # restart one collection
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from codec import ID_FIELDS, uuid_to_binary
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+CHECKPOINTS = "schema_migrations"
+MIGRATION = "compact_ids"
+
+
+async def collection_stats(db, name: str) -> Dict[str, Any]:
+    try:
+        stats = await db.command("collStats", name)
+    except OperationFailure:
+        return {"count": 0, "size": 0, "storageSize": 0, "totalIndexSize": 0, "indexSizes": {}}
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "storageSize": stats.get("storageSize", 0),
+        "totalIndexSize": stats.get("totalIndexSize", 0),
+        "indexSizes": stats.get("indexSizes", {}),
+    }
+
+
+def converted_fields(doc: Dict[str, Any], fields) -> Dict[str, Any]:
+    changes = {}
+    for field in fields:
+        value = doc.get(field)
+        if isinstance(value, str):
+            binary = uuid_to_binary(value)
+            if binary is not value:
+                changes[field] = binary
+    return changes
+
+
+async def migrate_collection(db, name: str, batch_size: int, reset: bool) -> Dict[str, Any]:
+    checkpoint_id = f"{MIGRATION}:{name}"
+    if reset:
+        await db[CHECKPOINTS].delete_one({"_id": checkpoint_id})
+    checkpoint = await db[CHECKPOINTS].find_one({"_id": checkpoint_id}) or {}
+    if checkpoint.get("done"):
+        return {"converted": checkpoint.get("converted", 0), "skipped": checkpoint.get("skipped", 0), "resumed": True}
+
+    fields = ID_FIELDS[name]
+    last_id = checkpoint.get("last_id")
+    converted = checkpoint.get("converted", 0)
+    skipped = checkpoint.get("skipped", 0)
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = await db[name].find(query, {f: 1 for f in fields}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        ops = []
+        for doc in batch:
+            changes = converted_fields(doc, fields)
+            if not changes:
+                continue
+            # Only apply if nobody rewrote these fields since we read them
+            match = {"_id": doc["_id"], **{f: doc[f] for f in changes}}
+            ops.append(UpdateOne(match, {"$set": changes}))
+        if ops:
+            result = await db[name].bulk_write(ops, ordered=False)
+            converted += result.modified_count
+            skipped += len(ops) - result.matched_count
+
+        last_id = batch[-1]["_id"]
+        await db[CHECKPOINTS].update_one(
+            {"_id": checkpoint_id},
+            {"$set": {
+                "last_id": last_id,
+                "converted": converted,
+                "skipped": skipped,
+                "updated_at": datetime.utcnow(),
+            }},
+            upsert=True,
+        )
+
+    await db[CHECKPOINTS].update_one(
+        {"_id": checkpoint_id},
+        {"$set": {"done": True, "converted": converted, "skipped": skipped, "updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    return {"converted": converted, "skipped": skipped, "resumed": bool(checkpoint)}
+
+
+def savings(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        key: before[key] - after[key]
+        for key in ("size", "storageSize", "totalIndexSize")
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    names = args.collections or list(ID_FIELDS)
+    report: Dict[str, Any] = {"collections": {}}
+    try:
+        for name in names:
+            before = await collection_stats(db, name)
+            entry: Dict[str, Any] = {"before": before}
+            if not args.report_only:
+                entry["migration"] = await migrate_collection(db, name, args.batch_size, args.reset)
+                after = await collection_stats(db, name)
+                entry["after"] = after
+                entry["saved_bytes"] = savings(before, after)
+            report["collections"][name] = entry
+    finally:
+        client.close()
+
+    if not args.report_only:
+        report["total_saved_bytes"] = {
+            key: sum(c["saved_bytes"][key] for c in report["collections"].values())
+            for key in ("size", "storageSize", "totalIndexSize")
+        }
+        # WiredTiger only returns freed space to the OS after a compact, so
+        # storageSize usually lags until then.
+        report["note"] = "run the 'compact' command per collection to reclaim storageSize on disk"
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("collections", nargs="*", help="collections to migrate (default: all)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--reset", action="store_true", help="ignore saved checkpoints and start over")
+    parser.add_argument("--report-only", action="store_true", help="print storage stats without migrating")
+    args = parser.parse_args()
+    unknown = set(args.collections) - set(ID_FIELDS)
+    if unknown:
+        parser.error(f"unknown collections: {', '.join(sorted(unknown))}")
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Password hashing with a configurable scheme and cost.
+
+New hashes use the configured scheme: bcrypt with ``bcrypt_rounds``, or
+argon2id (needs the optional ``argon2-cffi`` package) with its time cost,
+memory and parallelism. Hashes made under another scheme or cost still
+verify, and ``needs_rehash`` reports the weaker ones (another scheme, or a
+lower cost) so login can replace them once the user's password is known.
+Hashes stronger than the configured cost are kept, so lowering it only
+affects new hashes.
+
+Hashing takes tens to hundreds of milliseconds of CPU by design, so the
+async methods run it in a worker thread instead of on the event loop.
+``python benchmarks.py passwords`` times each cost on the host and picks one
+for a target time per hash.
+"""
+import asyncio
+from typing import Any, Dict, List
+
+from passlib.context import CryptContext
+from passlib.hash import argon2
+
+from profiling import phase
+
+BCRYPT = "bcrypt"
+ARGON2 = "argon2"
+SCHEMES = (BCRYPT, ARGON2)
+
+
+def argon2_available() -> bool:
+    return argon2.has_backend()
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        scheme: str = BCRYPT,
+        bcrypt_rounds: int = 12,
+        argon2_time_cost: int = 3,
+        argon2_memory_kib: int = 64 * 1024,
+        argon2_parallelism: int = 1,
+    ):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown password scheme {scheme!r}; expected one of {', '.join(SCHEMES)}")
+        if scheme == ARGON2 and not argon2_available():
+            raise RuntimeError("The argon2 password scheme needs the argon2-cffi package")
+        self.scheme = scheme
+        self.bcrypt_rounds = bcrypt_rounds
+        self.argon2_time_cost = argon2_time_cost
+        self.argon2_memory_kib = argon2_memory_kib
+        self.argon2_parallelism = argon2_parallelism
+
+        # Without its backend passlib cannot even parse argon2 hashes
+        schemes: List[str] = [scheme] + [s for s in SCHEMES if s != scheme and (s != ARGON2 or argon2_available())]
+        # A minimum but no maximum: stronger hashes than configured are kept.
+        # (passlib's plain ``rounds`` would pin the maximum too)
+        settings: Dict[str, Any] = {
+            "bcrypt__default_rounds": bcrypt_rounds,
+            "bcrypt__min_rounds": bcrypt_rounds,
+        }
+        if ARGON2 in schemes:
+            settings.update({
+                "argon2__default_rounds": argon2_time_cost,
+                "argon2__min_rounds": argon2_time_cost,
+                "argon2__memory_cost": argon2_memory_kib,
+                "argon2__parallelism": argon2_parallelism,
+            })
+        # Every scheme but the first is deprecated, so its hashes get replaced
+        self.context = CryptContext(schemes=schemes, default=scheme, deprecated="auto", **settings)
+
+    def describe(self) -> Dict[str, Any]:
+        if self.scheme == BCRYPT:
+            return {"scheme": BCRYPT, "rounds": self.bcrypt_rounds}
+        return {
+            "scheme": ARGON2,
+            "time_cost": self.argon2_time_cost,
+            "memory_kib": self.argon2_memory_kib,
+            "parallelism": self.argon2_parallelism,
+        }
+
+    def hash_sync(self, password: str) -> str:
+        return self.context.hash(password)
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Whether ``hashed_password`` uses another scheme or a lower cost than configured."""
+        if self.context.identify(hashed_password) != self.scheme:
+            return True
+        if self.scheme == ARGON2:
+            # passlib flags any memory cost but the configured one; only a lower one is weaker
+            stored = argon2.from_string(hashed_password)
+            return stored.rounds < self.argon2_time_cost or stored.memory_cost < self.argon2_memory_kib
+        return self.context.needs_update(hashed_password)
+
+    def load_backend(self) -> None:
+        """Load and self-test the scheme's backend without hashing anything real."""
+        self.context.handler().get_backend()
+
+    async def hash(self, password: str) -> str:
+        with phase("hashing"):
+            return await asyncio.to_thread(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        with phase("hashing"):
+            return await asyncio.to_thread(self.context.verify, password, hashed_password)
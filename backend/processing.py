@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Background processing of uploaded documents.
+
+Uploads are stored as sent, with the size and mime type the client claimed.
+Each new document gets a job in ``document_jobs`` (keyed by the document id,
+so queueing twice is harmless) and a worker then, off the request path:
+
+* decodes the stored data and verifies its size against ``file_size``
+* detects the real mime type from its leading magic bytes
+* computes its SHA-256 (filling ``checksum`` for inline uploads, checking it
+  for upload sessions)
+* counts the pages of PDFs
+
+and records the outcome on the document (``processing_status`` and
+``processing``). The decoding and inspection are CPU bound and run in a
+bounded process pool, so they neither block the event loop nor hold the GIL;
+how many jobs are in flight per API process is capped separately. Failed jobs
+are retried with exponential backoff, and jobs whose worker died are picked
+up again once their lock expires.
+
+The API server runs a worker (PROCESSING_WORKERS > 0). Workers can also run
+on their own, and documents uploaded before this existed can be queued:
+
+    python processing.py run
+    python processing.py enqueue [--include-failed]
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import codecs
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Optional, Set
+
+from compression import decompress_bytes, decompress_file
+
+logger = logging.getLogger(__name__)
+
+# Document processing_status values
+PENDING = "pending"
+COMPLETED = "completed"
+FAILED = "failed"
+# Finished job statuses (queued and running jobs are in progress)
+DONE = "done"
+
+HEAD_SIZE = 8192
+PDF = "application/pdf"
+OCTET_STREAM = "application/octet-stream"
+OLE_STORAGE = "application/x-ole-storage"
+
+# (offset, signature, mime type); the first match wins
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftypheic", "image/heic"),
+    (4, b"ftypmif1", "image/heic"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", OLE_STORAGE),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"PK\x05\x06", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/x-rar-compressed"),
+    (0, b"{\\rtf", "application/rtf"),
+)
+# Zip based formats, told apart by the directories they contain
+OFFICE_DIRECTORIES = (
+    ("word/", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    ("xl/", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ("ppt/", "application/vnd.openxmlformats-officedocument.presentationml.presentation"),
+)
+# Declared types that are fine for a detected type
+COMPATIBLE_TYPES = {
+    "image/jpeg": {"image/jpg", "image/pjpeg"},
+    "application/zip": {"application/x-zip-compressed"},
+    "application/gzip": {"application/x-gzip"},
+    "application/rtf": {"text/rtf"},
+    OLE_STORAGE: {
+        "application/msword", "application/vnd.ms-excel", "application/vnd.ms-powerpoint",
+        "application/vnd.ms-outlook",
+    },
+}
+TEXT_TYPES = {"application/json", "application/xml", "application/csv", "application/javascript"}
+
+_PAGES_NODE = re.compile(rb"/Type\s*/Pages\b")
+_PAGE_LEAF = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+_COUNT = re.compile(rb"/Count\s+(\d+)")
+
+
+class InvalidDocument(Exception):
+    """The stored data itself is unusable; retrying won't help."""
+
+
+# Inspection (runs in the process pool)
+def detect_mime_type(head: bytes, fileobj=None) -> str:
+    """Mime type from the leading bytes; ``fileobj`` lets zips be looked into."""
+    if b"%PDF-" in head[:1024]:
+        return PDF
+    for offset, signature, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(signature)] == signature:
+            if mime_type == "application/zip" and fileobj is not None:
+                return _zip_type(fileobj)
+            return mime_type
+    if b"\x00" in head:
+        return OCTET_STREAM
+    try:
+        text = codecs.getincrementaldecoder("utf-8-sig")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return OCTET_STREAM
+    if text.lstrip().startswith("<?xml"):
+        return "application/xml"
+    return "text/plain"
+
+
+def _zip_type(fileobj) -> str:
+    try:
+        with zipfile.ZipFile(fileobj) as archive:
+            names = archive.namelist()
+            if "mimetype" in names:
+                # OpenDocument stores its type uncompressed as the first entry
+                declared = archive.read("mimetype")[:100].decode("ascii", "replace").strip()
+                if declared.startswith("application/vnd.oasis.opendocument."):
+                    return declared
+    except (zipfile.BadZipFile, OSError, ValueError):
+        return "application/zip"
+    for directory, mime_type in OFFICE_DIRECTORIES:
+        if any(name.startswith(directory) for name in names):
+            return mime_type
+    return "application/zip"
+
+
+def pdf_page_count(data) -> Optional[int]:
+    """Pages of a PDF, from its page tree; None if it can't be found.
+
+    The root /Pages node has the largest /Count. PDFs that keep their page
+    tree in compressed object streams don't expose it, and give None.
+    """
+    counts = []
+    for match in _PAGES_NODE.finditer(data):
+        start = data.rfind(b"obj", 0, match.start())
+        end = data.find(b"endobj", match.end())
+        count = _COUNT.search(data, max(start, 0), end if end != -1 else len(data))
+        if count:
+            counts.append(int(count.group(1)))
+    if counts:
+        return max(counts)
+    return len(_PAGE_LEAF.findall(data)) or None
+
+
+def _inspect(data, fileobj) -> Dict[str, Any]:
+    mime_type = detect_mime_type(bytes(data[:HEAD_SIZE]), fileobj)
+    return {
+        "verified_size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "detected_mime_type": mime_type,
+        "page_count": pdf_page_count(data) if mime_type == PDF else None,
+    }
+
+
+def inspect_base64(stored: str, compression: Optional[str]) -> Dict[str, Any]:
+    """Inspect a document stored inline as (possibly compressed) base64."""
+    try:
+        data = base64.b64decode(stored, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidDocument("file_data is not valid base64")
+    try:
+        data = decompress_bytes(data, compression)
+    except Exception as e:
+        raise InvalidDocument(f"stored data could not be decompressed: {e}")
+    return _inspect(data, io.BytesIO(data))
+
+
+def inspect_file(path: str, compression: Optional[str]) -> Dict[str, Any]:
+    """Inspect a document spooled from the blob store to ``path``."""
+    raw_path = path
+    if compression:
+        raw_path = path + ".raw"
+        try:
+            decompress_file(path, raw_path, compression)
+        except Exception as e:
+            Path(raw_path).unlink(missing_ok=True)
+            raise InvalidDocument(f"stored data could not be decompressed: {e}")
+    try:
+        with open(raw_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return _inspect(b"", f)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _inspect(data, f)
+    finally:
+        if raw_path != path:
+            Path(raw_path).unlink(missing_ok=True)
+
+
+def mime_type_matches(declared: str, detected: str) -> bool:
+    declared = (declared or "").split(";")[0].strip().lower()
+    if declared == detected:
+        return True
+    if detected == "text/plain":
+        return declared.startswith("text/") or declared in TEXT_TYPES
+    if detected == "application/xml":
+        return declared == "text/xml" or declared.endswith("+xml")
+    return declared in COMPATIBLE_TYPES.get(detected, ())
+
+
+# Worker
+class DocumentProcessor:
+    """Claims document jobs and runs them on a process pool."""
+
+    def __init__(
+        self,
+        workers: int = 2,
+        concurrency: int = 2,
+        max_attempts: int = 3,
+        retry_seconds: float = 30.0,
+        lock_seconds: float = 600.0,
+        poll_seconds: float = 5.0,
+        tmp_dir: Optional[Path] = None,
+    ):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.tmp_dir = Path(tmp_dir or Path(tempfile.gettempdir()) / "oneexim-processing")
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    async def enqueue(self, jobs, document_id: str) -> None:
+        try:
+            await jobs.enqueue(document_id, datetime.utcnow())
+        except Exception:
+            # The document stays pending; `processing.py enqueue` queues it
+            logger.exception("Could not queue processing of document %s", document_id)
+            return
+        if self._wake is not None:
+            self._wake.set()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Not fork: the API process has threads (log listener, Motor) to not copy
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def run_forever(self, repositories) -> None:
+        self._wake = asyncio.Event()
+        self._executor = self._new_executor()
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        slots = asyncio.Semaphore(self.concurrency)
+        running: Set[asyncio.Task] = set()
+        try:
+            while True:
+                await slots.acquire()
+                now = datetime.utcnow()
+                try:
+                    job = await repositories.document_jobs.claim(now, now + timedelta(seconds=self.lock_seconds))
+                except Exception:
+                    logger.exception("Claiming a document job failed")
+                    job = None
+                if job is None:
+                    slots.release()
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                task = asyncio.create_task(self._run(repositories, job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+                task.add_done_callback(lambda _: slots.release())
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, repositories, job: Dict[str, Any]) -> None:
+        jobs = repositories.document_jobs
+        document_id = job["document_id"]
+        if job["attempts"] > self.max_attempts:
+            # Its worker kept dying (or timing out) on it
+            return await self._fail(repositories, job, f"gave up after {self.max_attempts} attempts")
+        try:
+            document = await repositories.documents.get_by_id(document_id)
+            if document is None:
+                return await jobs.finish(job["id"], FAILED, datetime.utcnow(), "document not found")
+            result = await self._inspect(repositories, job, document)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without waiting for its lock
+            await asyncio.shield(jobs.retry(job["id"], datetime.utcnow(), "interrupted"))
+            raise
+        except InvalidDocument as e:
+            return await self._fail(repositories, job, str(e))
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker process died (e.g. killed for memory); start a new pool
+                self._executor = self._new_executor()
+            if job["attempts"] >= self.max_attempts:
+                return await self._fail(repositories, job, f"{e.__class__.__name__}: {e}")
+            delay = self.retry_seconds * 2 ** (job["attempts"] - 1)
+            logger.warning("Processing document %s failed, retrying in %.0fs", document_id, delay, exc_info=True)
+            return await jobs.retry(job["id"], datetime.utcnow() + timedelta(seconds=delay), f"{e.__class__.__name__}: {e}")
+
+        now = datetime.utcnow()
+        processing = {
+            **result,
+            "size_matches": result["verified_size"] == document["file_size"],
+            "mime_type_matches": mime_type_matches(document["mime_type"], result["detected_mime_type"]),
+            "attempts": job["attempts"],
+            "processed_at": now,
+        }
+        values: Dict[str, Any] = {"processing_status": COMPLETED, "processing": processing}
+        if not document.get("checksum"):
+            values["checksum"] = result["sha256"]
+        elif document["checksum"] != result["sha256"]:
+            processing["error"] = "stored data does not match the checksum taken on upload"
+            values["processing_status"] = FAILED
+        await repositories.documents.update(document_id, values)
+        job_status = DONE if values["processing_status"] == COMPLETED else FAILED
+        await jobs.finish(job["id"], job_status, now, processing.get("error"))
+
+    async def _inspect(self, repositories, job: Dict[str, Any], document: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        compression = document.get("compression")
+        if not document.get("blob_id"):
+            return await loop.run_in_executor(self._executor, inspect_base64, document.get("file_data") or "", compression)
+        path = self.tmp_dir / f"{job['id']}.blob"
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            try:
+                async for chunk in repositories.blobs.open(document["blob_id"]):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+            return await loop.run_in_executor(self._executor, inspect_file, str(path), compression)
+        finally:
+            await asyncio.to_thread(path.unlink, True)
+
+    async def _fail(self, repositories, job: Dict[str, Any], error: str) -> None:
+        now = datetime.utcnow()
+        logger.warning("Processing document %s failed: %s", job["document_id"], error)
+        await repositories.documents.update(job["document_id"], {
+            "processing_status": FAILED,
+            "processing": {"error": error, "attempts": job["attempts"], "processed_at": now},
+        })
+        await repositories.document_jobs.finish(job["id"], FAILED, now, error)
+
+
+def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from codec import codec_for
+    from repositories import create_motor_repositories
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="process queued documents until interrupted")
+    enqueue_parser = commands.add_parser("enqueue", help="queue every document that was never processed")
+    enqueue_parser.add_argument("--include-failed", action="store_true", help="also retry failed documents")
+    args = parser.parse_args()
+
+    async def run():
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        schema_mode = os.environ.get("SCHEMA_MODE", "legacy")
+        repos = create_motor_repositories(db, schema_mode)
+        try:
+            await repos.ensure_indexes()
+            if args.command == "run":
+                workers = int(os.environ.get("PROCESSING_WORKERS", "2")) or 1
+                processor = DocumentProcessor(
+                    workers=workers,
+                    concurrency=int(os.environ.get("PROCESSING_CONCURRENCY", str(workers))),
+                    max_attempts=int(os.environ.get("PROCESSING_MAX_ATTEMPTS", "3")),
+                    retry_seconds=float(os.environ.get("PROCESSING_RETRY_SECONDS", "30")),
+                )
+                await processor.run_forever(repos)
+                return
+            statuses = [COMPLETED, FAILED] if not args.include_failed else [COMPLETED]
+            codec = codec_for("documents", schema_mode)
+            cursor = db.documents.find({"processing_status": {"$nin": statuses}}, {"_id": 0, "id": 1})
+            queued = requeued = 0
+            async for doc in cursor:
+                document_id = codec.decode(doc)["id"]
+                now = datetime.utcnow()
+                if await repos.document_jobs.enqueue(document_id, now):
+                    queued += 1
+                elif await repos.document_jobs.requeue(document_id, now):
+                    requeued += 1
+                else:
+                    continue
+                await repos.documents.update(document_id, {"processing_status": PENDING})
+            print(f"Queued {queued} documents, requeued {requeued}")
+        finally:
+            client.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
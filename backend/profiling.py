@@ -0,0 +1,284 @@
+"""Opt-in request profiling.
+
+``ProfilingMiddleware`` profiles a random fraction of requests
+(PROFILE_SAMPLE_RATE) and any request whose ``X-Debug-Profile`` header
+matches PROFILE_DEBUG_TOKEN. For each profiled request it writes two files
+to PROFILE_DIR:
+
+* ``<name>.folded`` - wall-clock samples of the event loop thread in the
+  collapsed-stack format read by flamegraph.pl, speedscope and inferno
+* ``<name>.json``   - total time and a per-phase breakdown (auth, db,
+  hashing, models, serialization, other)
+
+The sampler sees the whole event loop thread, so under concurrency the
+flamegraph also contains other requests' work; the phase breakdown is exact
+for the profiled request. Only one request is profiled at a time. When
+neither setting is configured the middleware and route class are not
+installed and the only cost left is a context variable lookup in ``phase``.
+"""
+import asyncio
+import functools
+import hmac
+import itertools
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+from logs import add_db_time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-debug-profile"
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Exclusive time per phase: time in a nested phase is not counted twice."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self._stack: List[List[Any]] = []
+        self.endpoint_done: Optional[float] = None
+
+    def enter(self, name: str) -> None:
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.phases[outer[0]] = self.phases.get(outer[0], 0.0) + now - outer[1]
+        self._stack.append([name, now])
+
+    def exit(self) -> None:
+        now = time.perf_counter()
+        name, since = self._stack.pop()
+        self.phases[name] = self.phases.get(name, 0.0) + now - since
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+
+class _Phase:
+    __slots__ = ("profile", "name")
+
+    def __init__(self, profile: RequestProfile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profile.exit()
+
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name: str):
+    """Attribute the enclosed code to ``name`` if this request is being profiled."""
+    profile = _current.get()
+    if profile is None:
+        return _NO_PHASE
+    return _Phase(profile, name)
+
+
+class _InstrumentedRepository:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with phase("db"):
+                    return await attr(*args, **kwargs)
+            finally:
+                add_db_time(time.perf_counter() - started)
+
+        return call
+
+
+def instrument_repositories(repos):
+    """Wrap every repository so its awaited calls are timed as database work.
+
+    The time goes to the ``db`` phase of a profiled request and to the
+    request's log context.
+    """
+    for name in repos.__dataclass_fields__:
+        value = getattr(repos, name)
+        if hasattr(value, "__dict__") and not isinstance(value, _InstrumentedRepository) and name != "db":
+            setattr(repos, name, _InstrumentedRepository(value))
+    return repos
+
+
+class ProfiledRoute(APIRoute):
+    """Route class that times the endpoint body as the ``models`` phase.
+
+    Whatever the endpoint awaits in another phase (db, hashing) is excluded,
+    which leaves request handling and model building; the time from the
+    endpoint returning to the response starting is serialization.
+    """
+
+    def get_route_handler(self):
+        call = self.dependant.call
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def profiled_call(**values):
+                with phase("models"):
+                    result = await call(**values)
+                profile = _current.get()
+                if profile is not None:
+                    profile.endpoint_done = time.perf_counter()
+                return result
+
+            self.dependant.call = profiled_call
+        return super().get_route_handler()
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> Counter:
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+
+class ProfileWriter:
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._counter = itertools.count()
+
+    def write(self, name: str, samples: Counter, summary: Dict[str, Any]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        folded = "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        (self.directory / f"{name}.folded").write_text(folded)
+        (self.directory / f"{name}.json").write_text(json.dumps(summary, indent=2))
+        self.rotate()
+
+    def rotate(self) -> None:
+        files = sorted(
+            (p for p in self.directory.iterdir() if p.suffix in (".folded", ".json")),
+            key=lambda p: p.stat().st_mtime,
+        )
+        total = sum(p.stat().st_size for p in files)
+        while files and total > self.max_bytes:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    def name_for(self, method: str, path: str) -> str:
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_")[:60] or "root"
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return f"{stamp}-{next(self._counter)}-{method}-{slug}"
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self,
+        app,
+        writer: ProfileWriter,
+        sample_rate: float = 0.0,
+        debug_token: Optional[str] = None,
+        interval: float = 0.001,
+    ):
+        self.app = app
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.debug_token = debug_token.encode() if debug_token else None
+        self.interval = interval
+        self._busy = False
+
+    def _wanted(self, scope) -> bool:
+        if self.debug_token is not None:
+            for key, value in scope["headers"]:
+                if key == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.debug_token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._busy or not self._wanted(scope):
+            return await self.app(scope, receive, send)
+
+        self._busy = True
+        profile = RequestProfile()
+        token = _current.set(profile)
+        name = self.writer.name_for(scope["method"], scope["path"])
+        response_status = [None]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response_status[0] = message["status"]
+                if profile.endpoint_done is not None:
+                    profile.add("serialization", time.perf_counter() - profile.endpoint_done)
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-profile-id", name.encode())]}
+            await send(message)
+
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            total = time.perf_counter() - profile.started
+            samples = sampler.stop()
+            _current.reset(token)
+            self._busy = False
+            phases = {k: round(v * 1000, 3) for k, v in profile.phases.items()}
+            phases["other"] = round(max(0.0, total * 1000 - sum(phases.values())), 3)
+            summary = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": response_status[0],
+                "total_ms": round(total * 1000, 3),
+                "phases_ms": phases,
+                "samples": sum(samples.values()),
+                "sample_interval_ms": self.interval * 1000,
+            }
+            try:
+                await asyncio.to_thread(self.writer.write, name, samples, summary)
+            except OSError:
+                logger.exception("Could not write profile %s", name)
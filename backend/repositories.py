@@ -0,0 +1,1037 @@
+"""Storage layer for the portal API.
+
+Route handlers talk to the repositories defined here instead of using Motor
+directly. Two engines are provided with the same indexes and semantics:
+``mongo`` (Motor) for deployments and ``memory`` for offline tests,
+benchmarks and profiling without a MongoDB server.
+"""
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from codec import DocumentCodec, codec_for
+
+# Server error codes for an index that exists with different options
+INDEX_OPTIONS_CONFLICT = (85, 86)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    keys: Tuple[str, ...]
+    unique: bool = False
+    # Expire documents on this (single, date) field when a TTL is configured
+    ttl: bool = False
+
+
+# Indexes shared by both engines. The memory engine uses them for lookups and
+# to enforce uniqueness, the Motor engine creates them on startup.
+INDEXES: Dict[str, List[IndexSpec]] = {
+    "users": [IndexSpec(("id",), unique=True), IndexSpec(("email",), unique=True)],
+    "orders": [IndexSpec(("id",), unique=True), IndexSpec(("user_id", "created_at"))],
+    # The trailing keys make the timeline query a covered index scan
+    "order_events": [IndexSpec(("id",), unique=True), IndexSpec(("order_id", "ts", "type", "status"))],
+    "documents": [
+        IndexSpec(("id",), unique=True),
+        IndexSpec(("order_id",)),
+        IndexSpec(("user_id",)),
+    ],
+    "messages": [
+        IndexSpec(("id",), unique=True),
+        IndexSpec(("user_id", "created_at")),
+        IndexSpec(("user_id", "is_read")),
+    ],
+    "contacts": [IndexSpec(("id",), unique=True), IndexSpec(("created_at",))],
+    "quotes": [IndexSpec(("id",), unique=True), IndexSpec(("created_at",))],
+    "status_checks": [IndexSpec(("id",), unique=True), IndexSpec(("timestamp",), ttl=True)],
+    "upload_sessions": [
+        IndexSpec(("id",), unique=True),
+        IndexSpec(("user_id",)),
+        IndexSpec(("updated_at",), ttl=True),
+    ],
+    "idempotency_keys": [IndexSpec(("id",), unique=True), IndexSpec(("created_at",), ttl=True)],
+    "analytics_rollups": [
+        IndexSpec(("id",), unique=True),
+        IndexSpec(("collection", "granularity", "bucket")),
+    ],
+    "user_summaries": [IndexSpec(("id",), unique=True)],
+    # One document per named background task; see archive.Archiver
+    "leases": [IndexSpec(("id",), unique=True)],
+    "document_jobs": [
+        IndexSpec(("id",), unique=True),
+        IndexSpec(("status", "run_after")),
+        # Only finished jobs have it, so queued ones never expire
+        IndexSpec(("finished_at",), ttl=True),
+    ],
+}
+
+BLOB_CHUNK_SIZE = 255 * 1024  # GridFS default chunk size
+
+ACTIVE_ORDER_STATUSES = ["pending", "processing", "shipped"]
+
+
+def escape_key(value: str) -> str:
+    """Make user data usable as a field name ('.' and '$' are not allowed)."""
+    return value.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def unescape_key(key: str) -> str:
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+# In-memory engine
+def _matches(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$lt" in condition and (value is None or not value < condition["$lt"]):
+                return False
+            if "$lte" in condition and (value is None or not value <= condition["$lte"]):
+                return False
+            if "$gte" in condition and (value is None or not value >= condition["$gte"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class MemoryCollection:
+    """A dict-backed collection with hash indexes mirroring ``INDEXES``.
+
+    Unique indexes map the full key to a document; the other indexes hash on
+    their leading field, which is the equality prefix every query here uses.
+    Documents are copied on the way in and out, like a round trip to Mongo.
+    A TTL index expires documents lazily on read, at most once per second,
+    much like the server's background TTL monitor.
+    """
+
+    def __init__(self, name: str, indexes: Sequence[IndexSpec], ttl_seconds: Optional[int] = None):
+        self.name = name
+        self._ttl_field = next((s.keys[0] for s in indexes if s.ttl), None) if ttl_seconds else None
+        self._ttl_seconds = ttl_seconds
+        self._next_expiry = 0.0
+        self._docs: Dict[int, Dict[str, Any]] = {}
+        self._next_id = 0
+        self._unique: Dict[Tuple[str, ...], Dict[tuple, int]] = {
+            spec.keys: {} for spec in indexes if spec.unique
+        }
+        self._lookup: Dict[str, Dict[Any, set]] = {
+            spec.keys[0]: defaultdict(set) for spec in indexes if not spec.unique
+        }
+
+    def _index(self, doc_id: int, doc: Dict[str, Any]) -> None:
+        for keys, index in self._unique.items():
+            index[tuple(doc.get(k) for k in keys)] = doc_id
+        for key, index in self._lookup.items():
+            index[doc.get(key)].add(doc_id)
+
+    def _unindex(self, doc_id: int, doc: Dict[str, Any]) -> None:
+        for keys, index in self._unique.items():
+            index.pop(tuple(doc.get(k) for k in keys), None)
+        for key, index in self._lookup.items():
+            ids = index.get(doc.get(key))
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del index[doc.get(key)]
+
+    def _check_unique(self, doc: Dict[str, Any], ignore: Optional[int] = None) -> None:
+        for keys, index in self._unique.items():
+            existing = index.get(tuple(doc.get(k) for k in keys))
+            if existing is not None and existing != ignore:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} index: {'_'.join(keys)}"
+                )
+
+    def _candidates(self, query: Dict[str, Any]):
+        for keys, index in self._unique.items():
+            if all(k in query and not isinstance(query[k], dict) for k in keys):
+                doc_id = index.get(tuple(query[k] for k in keys))
+                return [] if doc_id is None else [doc_id]
+        for key, index in self._lookup.items():
+            if key in query and not isinstance(query[key], dict):
+                return list(index.get(query[key], ()))
+        return list(self._docs)
+
+    def _find_ids(self, query: Dict[str, Any]) -> List[int]:
+        self._expire()
+        return [i for i in self._candidates(query) if _matches(self._docs[i], query)]
+
+    def _expire(self) -> None:
+        if self._ttl_field is None or time.monotonic() < self._next_expiry:
+            return
+        self._next_expiry = time.monotonic() + 1
+        cutoff = datetime.utcnow() - timedelta(seconds=self._ttl_seconds)
+        expired = [
+            i for i, doc in self._docs.items()
+            if isinstance(doc.get(self._ttl_field), datetime) and doc[self._ttl_field] < cutoff
+        ]
+        for doc_id in expired:
+            self._unindex(doc_id, self._docs.pop(doc_id))
+
+    def insert_one(self, doc: Dict[str, Any]) -> None:
+        self._check_unique(doc)
+        doc_id = self._next_id
+        self._next_id += 1
+        self._docs[doc_id] = dict(doc)
+        self._index(doc_id, self._docs[doc_id])
+
+    def find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        ids = self._find_ids(query)
+        return dict(self._docs[min(ids)]) if ids else None
+
+    def find(
+        self,
+        query: Dict[str, Any],
+        sort: Optional[Tuple[str, int]] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        ids = sorted(self._find_ids(query))
+        docs = [self._docs[i] for i in ids]
+        if sort is not None:
+            sort_key, direction = sort
+            docs.sort(key=lambda d: d.get(sort_key), reverse=direction < 0)
+        if limit:
+            docs = docs[:limit]
+        return [dict(d) for d in docs]
+
+    def count_documents(self, query: Dict[str, Any]) -> int:
+        return len(self._find_ids(query))
+
+    def update_one(self, query: Dict[str, Any], values: Dict[str, Any]) -> bool:
+        ids = self._find_ids(query)
+        if not ids:
+            return False
+        doc_id = min(ids)
+        updated = {**self._docs[doc_id], **values}
+        self._check_unique(updated, ignore=doc_id)
+        self._unindex(doc_id, self._docs[doc_id])
+        self._docs[doc_id] = updated
+        self._index(doc_id, updated)
+        return True
+
+    def increment(self, query: Dict[str, Any], amounts: Dict[str, Any]) -> bool:
+        """Like ``$inc``; dotted paths address nested documents."""
+        ids = self._find_ids(query)
+        if not ids:
+            return False
+        doc = self._docs[min(ids)]
+        for path, amount in amounts.items():
+            *parents, leaf = path.split(".")
+            target = doc
+            for key in parents:
+                target[key] = dict(target.get(key) or {})
+                target = target[key]
+            target[leaf] = target.get(leaf, 0) + amount
+        return True
+
+    def delete_many(self, query: Dict[str, Any]) -> int:
+        ids = self._find_ids(query)
+        for doc_id in ids:
+            self._unindex(doc_id, self._docs.pop(doc_id))
+        return len(ids)
+
+
+class MemoryUserRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def get_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"email": email})
+
+    async def get_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": user_id})
+
+    async def insert(self, user: Dict[str, Any]) -> None:
+        self._c.insert_one(user)
+
+    async def update(self, user_id: str, values: Dict[str, Any]) -> None:
+        self._c.update_one({"id": user_id}, values)
+
+    async def replace_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        return self._c.update_one({"id": user_id, "hashed_password": old_hash}, {"hashed_password": new_hash})
+
+    async def bump_versions(self, user_id: str, *scopes: str) -> None:
+        self._c.increment({"id": user_id}, {f"data_versions.{scope}": 1 for scope in scopes})
+
+
+class MemoryOrderRepository:
+    def __init__(self, collection: MemoryCollection, events: MemoryCollection):
+        self._c = collection
+        self._events = events
+
+    async def insert(self, order: Dict[str, Any]) -> None:
+        self._c.insert_one(order)
+
+    async def get_for_user(self, order_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": order_id, "user_id": user_id})
+
+    async def list_for_user(self, user_id: str, limit: Optional[int] = 100) -> List[Dict[str, Any]]:
+        return self._c.find({"user_id": user_id}, sort=("created_at", -1), limit=limit)
+
+    async def count_for_user(self, user_id: str, statuses: Optional[List[str]] = None) -> int:
+        query: Dict[str, Any] = {"user_id": user_id}
+        if statuses is not None:
+            query["status"] = {"$in": statuses}
+        return self._c.count_documents(query)
+
+    async def update(self, order_id: str, values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply ``values``; returns the order as it was before, or None if missing."""
+        before = self._c.find_one({"id": order_id})
+        if before is not None:
+            self._c.update_one({"id": order_id}, values)
+        return before
+
+    async def get_for_user_with_events(self, order_id: str, user_id: str, limit: int) -> Optional[Dict[str, Any]]:
+        """The order with its last ``limit`` events under ``events``, oldest first."""
+        order = self._c.find_one({"id": order_id, "user_id": user_id})
+        if order is not None:
+            order["events"] = self._events.find({"order_id": order_id}, sort=("ts", -1), limit=limit)[::-1]
+        return order
+
+
+class MemoryDocumentRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def insert(self, document: Dict[str, Any]) -> None:
+        self._c.insert_one(document)
+
+    async def get_for_user(self, document_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": document_id, "user_id": user_id})
+
+    async def list_for_order(self, order_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return self._c.find({"order_id": order_id}, limit=limit)
+
+    async def get_by_id(self, document_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": document_id})
+
+    async def update(self, document_id: str, values: Dict[str, Any]) -> None:
+        self._c.update_one({"id": document_id}, values)
+
+    async def delete(self, document_id: str) -> None:
+        self._c.delete_many({"id": document_id})
+
+
+class MemoryMessageRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def insert(self, message: Dict[str, Any]) -> None:
+        self._c.insert_one(message)
+
+    async def list_for_user(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return self._c.find({"user_id": user_id}, sort=("created_at", -1), limit=limit)
+
+    async def mark_read(self, message_id: str, user_id: str) -> bool:
+        return self._c.update_one({"id": message_id, "user_id": user_id, "is_read": False}, {"is_read": True})
+
+    async def count_unread(self, user_id: str) -> int:
+        return self._c.count_documents({"user_id": user_id, "is_read": False})
+
+
+class MemoryInsertOnlyRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def insert(self, doc: Dict[str, Any]) -> None:
+        self._c.insert_one(doc)
+
+
+class MemoryArchivableRepository(MemoryInsertOnlyRepository):
+    async def list_created_before(self, cutoff: datetime, limit: int) -> List[Dict[str, Any]]:
+        return self._c.find({"created_at": {"$lt": cutoff}}, sort=("created_at", 1), limit=limit)
+
+    async def delete(self, ids: List[str]) -> int:
+        return self._c.delete_many({"id": {"$in": ids}})
+
+
+class MemoryOrderEventRepository(MemoryInsertOnlyRepository):
+    async def timeline(self, order_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """The latest ``limit`` events of the order, oldest first."""
+        events = self._c.find({"order_id": order_id}, sort=("ts", -1), limit=limit)[::-1]
+        return [{"ts": e["ts"], "type": e["type"], "status": e.get("status")} for e in events]
+
+
+class MemoryStatusCheckRepository(MemoryInsertOnlyRepository):
+    async def list(self, limit: int = 1000) -> List[Dict[str, Any]]:
+        return self._c.find({}, limit=limit)
+
+
+class MemoryUploadSessionRepository(MemoryInsertOnlyRepository):
+    async def get_for_user(self, session_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": session_id, "user_id": user_id})
+
+    async def advance(self, session_id: str, expected: int, received: int, now: datetime) -> bool:
+        return self._c.update_one(
+            {"id": session_id, "status": "open", "received": expected},
+            {"received": received, "updated_at": now}
+        )
+
+    async def transition(self, session_id: str, expected: str, values: Dict[str, Any]) -> bool:
+        return self._c.update_one({"id": session_id, "status": expected}, values)
+
+
+class MemoryIdempotencyRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": key})
+
+    async def reserve(self, key: str, user: str, now: datetime, fingerprint: Optional[str] = None) -> bool:
+        try:
+            self._c.insert_one(
+                {"id": key, "user": user, "status": "pending", "fingerprint": fingerprint, "created_at": now}
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def take_over(self, key: str, stale_before: datetime, now: datetime) -> bool:
+        return self._c.update_one(
+            {"id": key, "status": "pending", "created_at": {"$lt": stale_before}},
+            {"created_at": now}
+        )
+
+    async def complete(self, key: str, response: Dict[str, Any]) -> None:
+        self._c.update_one({"id": key}, {"status": "completed", "response": response})
+
+    async def release(self, key: str) -> None:
+        self._c.delete_many({"id": key})
+
+
+class MemoryRollupRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def apply(self, increments: Dict[str, Tuple[Dict[str, Any], Dict[str, int]]]) -> None:
+        """``increments`` maps rollup id -> (identifying fields, amounts by path)."""
+        for rollup_id, (fields, amounts) in increments.items():
+            if not self._c.increment({"id": rollup_id}, amounts):
+                try:
+                    self._c.insert_one({"id": rollup_id, **fields})
+                except DuplicateKeyError:
+                    pass
+                self._c.increment({"id": rollup_id}, amounts)
+
+    async def list_range(self, collection: str, granularity: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        return self._c.find(
+            {"collection": collection, "granularity": granularity, "bucket": {"$gte": start, "$lt": end}},
+            sort=("bucket", 1)
+        )
+
+    async def ids_before(self, collection: str, granularity: str, cutoff: datetime) -> List[str]:
+        query = {"collection": collection, "granularity": granularity, "bucket": {"$lt": cutoff}}
+        return [doc["id"] for doc in self._c.find(query)]
+
+    async def replace(self, docs: List[Dict[str, Any]]) -> None:
+        for doc in docs:
+            self._c.delete_many({"id": doc["id"]})
+            self._c.insert_one(doc)
+
+    async def delete(self, ids: List[str]) -> int:
+        return self._c.delete_many({"id": {"$in": ids}})
+
+
+class MemorySummaryRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return self._c.find_one({"id": user_id})
+
+    async def get_many(self, user_ids: List[str]) -> List[Dict[str, Any]]:
+        return self._c.find({"id": {"$in": user_ids}})
+
+    async def apply(
+        self, user_id: str, amounts: Dict[str, Any], last_order_at: Optional[datetime], now: datetime
+    ) -> bool:
+        created = False
+        if self._c.find_one({"id": user_id}) is None:
+            try:
+                self._c.insert_one({"id": user_id})
+                created = True
+            except DuplicateKeyError:
+                pass
+        self._c.increment({"id": user_id}, amounts)
+        values: Dict[str, Any] = {"updated_at": now}
+        current = self._c.find_one({"id": user_id})
+        if last_order_at is not None and (current.get("last_order_at") is None or current["last_order_at"] < last_order_at):
+            values["last_order_at"] = last_order_at
+        self._c.update_one({"id": user_id}, values)
+        return created
+
+    async def replace(self, docs: List[Dict[str, Any]]) -> None:
+        for doc in docs:
+            self._c.delete_many({"id": doc["id"]})
+            self._c.insert_one(doc)
+
+    async def delete(self, user_ids: List[str]) -> int:
+        return self._c.delete_many({"id": {"$in": user_ids}})
+
+
+class MemoryJobRepository:
+    """Document processing jobs; a job's id is the id of its document."""
+
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def enqueue(self, document_id: str, now: datetime) -> bool:
+        try:
+            self._c.insert_one({
+                "id": document_id, "document_id": document_id, "status": "queued", "attempts": 0,
+                "run_after": now, "created_at": now, "updated_at": now,
+            })
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def requeue(self, job_id: str, now: datetime) -> bool:
+        return self._c.update_one(
+            {"id": job_id, "status": "failed"},
+            {"status": "queued", "attempts": 0, "run_after": now, "updated_at": now, "finished_at": None}
+        )
+
+    async def claim(self, now: datetime, lock_until: datetime) -> Optional[Dict[str, Any]]:
+        jobs = self._c.find({"status": "queued", "run_after": {"$lte": now}}, sort=("run_after", 1), limit=1)
+        if not jobs:
+            # Running past its lock: the worker that had it is gone
+            jobs = self._c.find({"status": "running", "locked_until": {"$lt": now}}, limit=1)
+        if not jobs:
+            return None
+        job = jobs[0]
+        job.update(status="running", attempts=job["attempts"] + 1, locked_until=lock_until, updated_at=now)
+        self._c.update_one({"id": job["id"]}, job)
+        return job
+
+    async def retry(self, job_id: str, run_after: datetime, error: str) -> None:
+        self._c.update_one(
+            {"id": job_id},
+            {"status": "queued", "run_after": run_after, "locked_until": None, "error": error, "updated_at": datetime.utcnow()}
+        )
+
+    async def finish(self, job_id: str, status: str, now: datetime, error: Optional[str] = None) -> None:
+        self._c.update_one(
+            {"id": job_id},
+            {"status": status, "locked_until": None, "error": error, "updated_at": now, "finished_at": now}
+        )
+
+
+class MemoryLeaseRepository:
+    def __init__(self, collection: MemoryCollection):
+        self._c = collection
+
+    async def acquire(self, name: str, owner: str, now: datetime, expires_at: datetime) -> bool:
+        lease = self._c.find_one({"id": name})
+        if lease is None:
+            self._c.insert_one({"id": name, "owner": owner, "expires_at": expires_at})
+            return True
+        if lease["owner"] != owner and lease["expires_at"] > now:
+            return False
+        return self._c.update_one({"id": name}, {"owner": owner, "expires_at": expires_at})
+
+    async def release(self, name: str, owner: str) -> None:
+        self._c.delete_many({"id": name, "owner": owner})
+
+
+class MemoryBlobStore:
+    def __init__(self):
+        self._blobs: Dict[str, bytes] = {}
+
+    async def put(self, blob_id: str, chunks: AsyncIterator[bytes], filename: str, metadata: Dict[str, Any]) -> int:
+        data = b"".join([chunk async for chunk in chunks])
+        self._blobs[blob_id] = data
+        return len(data)
+
+    async def open(self, blob_id: str) -> AsyncIterator[bytes]:
+        data = self._blobs[blob_id]
+        for start in range(0, len(data), BLOB_CHUNK_SIZE):
+            yield data[start:start + BLOB_CHUNK_SIZE]
+
+    async def delete(self, blob_id: str) -> None:
+        self._blobs.pop(blob_id, None)
+
+
+# Motor engine
+class MotorRepository:
+    def __init__(self, collection, codec: Optional[DocumentCodec] = None):
+        self._c = collection
+        self._codec = codec or codec_for(collection.name)
+
+    async def _find_one(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self._codec.decode(await self._c.find_one(self._codec.query(query)))
+
+    async def _find(self, query: Dict[str, Any], limit: Optional[int], sort: Optional[Tuple[str, int]] = None):
+        cursor = self._c.find(self._codec.query(query))
+        if sort is not None:
+            cursor = cursor.sort(*sort)
+        return [self._codec.decode(doc) for doc in await cursor.to_list(limit)]
+
+    async def _count(self, query: Dict[str, Any]) -> int:
+        return await self._c.count_documents(self._codec.query(query))
+
+    async def _update_one(self, query: Dict[str, Any], values: Dict[str, Any]) -> bool:
+        result = await self._c.update_one(self._codec.query(query), {"$set": self._codec.encode(values)})
+        return result.modified_count > 0
+
+    async def insert(self, doc: Dict[str, Any]) -> None:
+        await self._c.insert_one(self._codec.encode(doc))
+
+
+class MotorUserRepository(MotorRepository):
+    async def get_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"email": email})
+
+    async def get_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": user_id})
+
+    async def update(self, user_id: str, values: Dict[str, Any]) -> None:
+        await self._update_one({"id": user_id}, values)
+
+    async def replace_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        """Swap in ``new_hash`` unless the password changed since ``old_hash`` was read."""
+        return await self._update_one({"id": user_id, "hashed_password": old_hash}, {"hashed_password": new_hash})
+
+    async def bump_versions(self, user_id: str, *scopes: str) -> None:
+        await self._c.update_one(
+            self._codec.query({"id": user_id}),
+            {"$inc": {f"data_versions.{scope}": 1 for scope in scopes}}
+        )
+
+
+class MotorOrderRepository(MotorRepository):
+    def __init__(self, collection, codec: Optional[DocumentCodec] = None, events_codec: Optional[DocumentCodec] = None):
+        super().__init__(collection, codec)
+        self._events_codec = events_codec or codec_for("order_events")
+
+    async def get_for_user(self, order_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": order_id, "user_id": user_id})
+
+    async def list_for_user(self, user_id: str, limit: Optional[int] = 100) -> List[Dict[str, Any]]:
+        return await self._find({"user_id": user_id}, limit, sort=("created_at", -1))
+
+    async def count_for_user(self, user_id: str, statuses: Optional[List[str]] = None) -> int:
+        query: Dict[str, Any] = {"user_id": user_id}
+        if statuses is not None:
+            query["status"] = {"$in": statuses}
+        return await self._count(query)
+
+    async def update(self, order_id: str, values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # The previous version comes back from the same atomic write, so the
+        # caller can tell exactly what changed even under concurrent updates
+        before = await self._c.find_one_and_update(
+            self._codec.query({"id": order_id}),
+            {"$set": self._codec.encode(values)},
+            return_document=ReturnDocument.BEFORE,
+        )
+        return self._codec.decode(before)
+
+    async def get_for_user_with_events(self, order_id: str, user_id: str, limit: int) -> Optional[Dict[str, Any]]:
+        # One round trip: the events come from a $lookup subquery on the
+        # order_events (order_id, ts, ...) index, newest first, limited there
+        pipeline = [
+            {"$match": self._codec.query({"id": order_id, "user_id": user_id})},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "order_events",
+                "pipeline": [
+                    {"$match": self._events_codec.query({"order_id": order_id})},
+                    {"$sort": {"ts": -1}},
+                    {"$limit": limit},
+                    {"$project": {"_id": 0}},
+                ],
+                "as": "events",
+            }},
+        ]
+        docs = await self._c.aggregate(pipeline).to_list(1)
+        if not docs:
+            return None
+        order = self._codec.decode(docs[0])
+        order["events"] = [self._events_codec.decode(event) for event in reversed(docs[0]["events"])]
+        return order
+
+
+class MotorDocumentRepository(MotorRepository):
+    async def get_for_user(self, document_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": document_id, "user_id": user_id})
+
+    async def list_for_order(self, order_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self._find({"order_id": order_id}, limit)
+
+    async def get_by_id(self, document_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": document_id})
+
+    async def update(self, document_id: str, values: Dict[str, Any]) -> None:
+        await self._update_one({"id": document_id}, values)
+
+    async def delete(self, document_id: str) -> None:
+        await self._c.delete_one(self._codec.query({"id": document_id}))
+
+
+class MotorMessageRepository(MotorRepository):
+    async def list_for_user(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self._find({"user_id": user_id}, limit, sort=("created_at", -1))
+
+    async def mark_read(self, message_id: str, user_id: str) -> bool:
+        return await self._update_one({"id": message_id, "user_id": user_id, "is_read": False}, {"is_read": True})
+
+    async def count_unread(self, user_id: str) -> int:
+        return await self._count({"user_id": user_id, "is_read": False})
+
+
+class MotorInsertOnlyRepository(MotorRepository):
+    pass
+
+
+class MotorArchivableRepository(MotorRepository):
+    async def list_created_before(self, cutoff: datetime, limit: int) -> List[Dict[str, Any]]:
+        return await self._find({"created_at": {"$lt": cutoff}}, limit, sort=("created_at", 1))
+
+    async def delete(self, ids: List[str]) -> int:
+        result = await self._c.delete_many(self._codec.query({"id": {"$in": ids}}))
+        return result.deleted_count
+
+
+class MotorOrderEventRepository(MotorRepository):
+    async def timeline(self, order_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """The latest ``limit`` events of the order, oldest first."""
+        # Only indexed fields and no _id, so the index alone answers it; read
+        # newest first so the server stops after ``limit`` index entries
+        cursor = self._c.find(
+            self._codec.query({"order_id": order_id}), {"_id": 0, "ts": 1, "type": 1, "status": 1}
+        ).sort("ts", DESCENDING).limit(limit)
+        return [self._codec.decode(event) for event in await cursor.to_list(limit)][::-1]
+
+
+class MotorStatusCheckRepository(MotorRepository):
+    async def list(self, limit: int = 1000) -> List[Dict[str, Any]]:
+        return await self._find({}, limit)
+
+
+class MotorUploadSessionRepository(MotorRepository):
+    async def get_for_user(self, session_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": session_id, "user_id": user_id})
+
+    async def advance(self, session_id: str, expected: int, received: int, now: datetime) -> bool:
+        # Conditional on the offset we started from, so concurrent or
+        # replayed chunks can't both be accepted
+        return await self._update_one(
+            {"id": session_id, "status": "open", "received": expected},
+            {"received": received, "updated_at": now}
+        )
+
+    async def transition(self, session_id: str, expected: str, values: Dict[str, Any]) -> bool:
+        return await self._update_one({"id": session_id, "status": expected}, values)
+
+
+class MotorIdempotencyRepository(MotorRepository):
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": key})
+
+    async def reserve(self, key: str, user: str, now: datetime, fingerprint: Optional[str] = None) -> bool:
+        try:
+            await self.insert(
+                {"id": key, "user": user, "status": "pending", "fingerprint": fingerprint, "created_at": now}
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def take_over(self, key: str, stale_before: datetime, now: datetime) -> bool:
+        return await self._update_one(
+            {"id": key, "status": "pending", "created_at": {"$lt": stale_before}},
+            {"created_at": now}
+        )
+
+    async def complete(self, key: str, response: Dict[str, Any]) -> None:
+        await self._update_one({"id": key}, {"status": "completed", "response": response})
+
+    async def release(self, key: str) -> None:
+        await self._c.delete_one(self._codec.query({"id": key}))
+
+
+class MotorRollupRepository(MotorRepository):
+    async def apply(self, increments: Dict[str, Tuple[Dict[str, Any], Dict[str, int]]]) -> None:
+        if not increments:
+            return
+        await self._c.bulk_write([
+            UpdateOne(
+                {"id": rollup_id},
+                {"$inc": amounts, "$setOnInsert": self._codec.encode(fields)},
+                upsert=True,
+            )
+            for rollup_id, (fields, amounts) in increments.items()
+        ], ordered=False)
+
+    async def list_range(self, collection: str, granularity: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        query = {"collection": collection, "granularity": granularity, "bucket": {"$gte": start, "$lt": end}}
+        # A range query on the compound index; at most one document per bucket
+        return await self._find(query, None, sort=("bucket", 1))
+
+    async def ids_before(self, collection: str, granularity: str, cutoff: datetime) -> List[str]:
+        query = {"collection": collection, "granularity": granularity, "bucket": {"$lt": cutoff}}
+        cursor = self._c.find(query, {"id": 1, "_id": 0})
+        return [doc["id"] async for doc in cursor]
+
+    async def replace(self, docs: List[Dict[str, Any]]) -> None:
+        if docs:
+            await self._c.bulk_write(
+                [ReplaceOne({"id": doc["id"]}, self._codec.encode(doc), upsert=True) for doc in docs],
+                ordered=False,
+            )
+
+    async def delete(self, ids: List[str]) -> int:
+        result = await self._c.delete_many({"id": {"$in": ids}})
+        return result.deleted_count
+
+
+class MotorSummaryRepository(MotorRepository):
+    async def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._find_one({"id": user_id})
+
+    async def get_many(self, user_ids: List[str]) -> List[Dict[str, Any]]:
+        return await self._find({"id": {"$in": user_ids}}, None)
+
+    async def apply(
+        self, user_id: str, amounts: Dict[str, Any], last_order_at: Optional[datetime], now: datetime
+    ) -> bool:
+        """One atomic upsert, so concurrent order writes never lose an increment.
+
+        Returns whether it created the summary, which then only holds ``amounts``.
+        """
+        update: Dict[str, Any] = {
+            "$inc": amounts,
+            "$set": self._codec.encode({"updated_at": now}),
+            # In dual mode the filter is an $in, which an upsert doesn't copy into the new document
+            "$setOnInsert": self._codec.encode({"id": user_id}),
+        }
+        if last_order_at is not None:
+            update["$max"] = self._codec.encode({"last_order_at": last_order_at})
+        result = await self._c.update_one(self._codec.query({"id": user_id}), update, upsert=True)
+        return result.upserted_id is not None
+
+    async def replace(self, docs: List[Dict[str, Any]]) -> None:
+        if docs:
+            await self._c.bulk_write([
+                ReplaceOne(self._codec.query({"id": doc["id"]}), self._codec.encode(doc), upsert=True)
+                for doc in docs
+            ], ordered=False)
+
+    async def delete(self, user_ids: List[str]) -> int:
+        result = await self._c.delete_many(self._codec.query({"id": {"$in": user_ids}}))
+        return result.deleted_count
+
+
+class MotorJobRepository(MotorRepository):
+    async def enqueue(self, document_id: str, now: datetime) -> bool:
+        try:
+            await self.insert({
+                "id": document_id, "document_id": document_id, "status": "queued", "attempts": 0,
+                "run_after": now, "created_at": now, "updated_at": now,
+            })
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def requeue(self, job_id: str, now: datetime) -> bool:
+        return await self._update_one(
+            {"id": job_id, "status": "failed"},
+            {"status": "queued", "attempts": 0, "run_after": now, "updated_at": now, "finished_at": None}
+        )
+
+    async def claim(self, now: datetime, lock_until: datetime) -> Optional[Dict[str, Any]]:
+        # Atomic, so each job goes to exactly one worker across processes
+        job = await self._c.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lt": now}},
+            ]},
+            {
+                "$set": self._codec.encode({"status": "running", "locked_until": lock_until, "updated_at": now}),
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_after", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return self._codec.decode(job)
+
+    async def retry(self, job_id: str, run_after: datetime, error: str) -> None:
+        await self._update_one(
+            {"id": job_id},
+            {"status": "queued", "run_after": run_after, "locked_until": None, "error": error, "updated_at": datetime.utcnow()}
+        )
+
+    async def finish(self, job_id: str, status: str, now: datetime, error: Optional[str] = None) -> None:
+        await self._update_one(
+            {"id": job_id},
+            {"status": status, "locked_until": None, "error": error, "updated_at": now, "finished_at": now}
+        )
+
+
+class MotorLeaseRepository(MotorRepository):
+    async def acquire(self, name: str, owner: str, now: datetime, expires_at: datetime) -> bool:
+        """Take or renew the lease ``name`` unless another owner holds it unexpired."""
+        try:
+            await self._c.update_one(
+                {"id": name, "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": self._codec.encode({"owner": owner, "expires_at": expires_at})},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The filter missed an existing lease, so the upsert collided with it
+            return False
+        return True
+
+    async def release(self, name: str, owner: str) -> None:
+        await self._c.delete_one({"id": name, "owner": owner})
+
+
+class GridFSBlobStore:
+    def __init__(self, db, bucket_name: str = "document_blobs"):
+        self._bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=BLOB_CHUNK_SIZE)
+
+    async def put(self, blob_id: str, chunks: AsyncIterator[bytes], filename: str, metadata: Dict[str, Any]) -> int:
+        stream = self._bucket.open_upload_stream_with_id(blob_id, filename, metadata=metadata)
+        try:
+            async for chunk in chunks:
+                await stream.write(chunk)
+        except BaseException:
+            await stream.abort()
+            raise
+        await stream.close()
+        return stream.length
+
+    async def open(self, blob_id: str) -> AsyncIterator[bytes]:
+        stream = await self._bucket.open_download_stream(blob_id)
+        while True:
+            chunk = await stream.readchunk()
+            if not chunk:
+                return
+            yield chunk
+
+    async def delete(self, blob_id: str) -> None:
+        await self._bucket.delete(blob_id)
+
+
+@dataclass
+class Repositories:
+    users: Any
+    orders: Any
+    order_events: Any
+    documents: Any
+    messages: Any
+    contacts: Any
+    quotes: Any
+    status_checks: Any
+    upload_sessions: Any
+    idempotency_keys: Any
+    rollups: Any
+    user_summaries: Any
+    document_jobs: Any
+    leases: Any
+    blobs: Any
+    engine: str = "memory"
+    db: Any = None
+    # collection -> seconds after which TTL indexes expire documents
+    ttl_seconds: Dict[str, int] = field(default_factory=dict)
+
+    async def ensure_indexes(self) -> None:
+        if self.db is None:
+            return
+        for name, specs in INDEXES.items():
+            for spec in specs:
+                await self._ensure_index(name, spec)
+
+    async def _ensure_index(self, name: str, spec: IndexSpec) -> None:
+        keys = [(key, ASCENDING) for key in spec.keys]
+        options: Dict[str, Any] = {"unique": spec.unique}
+        ttl = self.ttl_seconds.get(name) if spec.ttl else None
+        if ttl:
+            options["expireAfterSeconds"] = ttl
+        elif spec.ttl:
+            await self._drop_ttl_index(name, spec)
+        try:
+            await self.db[name].create_indexes([IndexModel(keys, **options)])
+        except OperationFailure as e:
+            if e.code in INDEX_OPTIONS_CONFLICT and spec.ttl and ttl:
+                # Same keys, different expiry: adjust the existing index in place
+                await self.db.command(
+                    "collMod", name, index={"keyPattern": dict(keys), "expireAfterSeconds": ttl}
+                )
+                return
+            # Existing data can violate a new unique index; keep serving.
+            logger.warning("Could not create index %s on %s: %s", spec.keys, name, e)
+
+    async def _drop_ttl_index(self, name: str, spec: IndexSpec) -> None:
+        """Drop a TTL index on ``spec``'s keys left from when retention was on."""
+        for index_name, index in (await self.db[name].index_information()).items():
+            if "expireAfterSeconds" in index and [key for key, _ in index["key"]] == list(spec.keys):
+                # The plain index is created in its place
+                await self.db[name].drop_index(index_name)
+                logger.info("Retention is off for %s; dropped its TTL index %s", name, index_name)
+
+
+def create_memory_repositories(ttl_seconds: Optional[Dict[str, int]] = None) -> Repositories:
+    ttl_seconds = ttl_seconds or {}
+    c = {
+        name: MemoryCollection(name, specs, ttl_seconds.get(name))
+        for name, specs in INDEXES.items()
+    }
+    return Repositories(
+        users=MemoryUserRepository(c["users"]),
+        orders=MemoryOrderRepository(c["orders"], c["order_events"]),
+        order_events=MemoryOrderEventRepository(c["order_events"]),
+        documents=MemoryDocumentRepository(c["documents"]),
+        messages=MemoryMessageRepository(c["messages"]),
+        contacts=MemoryArchivableRepository(c["contacts"]),
+        quotes=MemoryArchivableRepository(c["quotes"]),
+        status_checks=MemoryStatusCheckRepository(c["status_checks"]),
+        upload_sessions=MemoryUploadSessionRepository(c["upload_sessions"]),
+        idempotency_keys=MemoryIdempotencyRepository(c["idempotency_keys"]),
+        rollups=MemoryRollupRepository(c["analytics_rollups"]),
+        user_summaries=MemorySummaryRepository(c["user_summaries"]),
+        document_jobs=MemoryJobRepository(c["document_jobs"]),
+        leases=MemoryLeaseRepository(c["leases"]),
+        blobs=MemoryBlobStore(),
+        engine="memory",
+        ttl_seconds=ttl_seconds,
+    )
+
+
+def create_motor_repositories(
+    db, schema_mode: str = "legacy", ttl_seconds: Optional[Dict[str, int]] = None
+) -> Repositories:
+    def codec(name: str) -> DocumentCodec:
+        return codec_for(name, schema_mode)
+
+    return Repositories(
+        users=MotorUserRepository(db.users, codec("users")),
+        orders=MotorOrderRepository(db.orders, codec("orders"), codec("order_events")),
+        order_events=MotorOrderEventRepository(db.order_events, codec("order_events")),
+        documents=MotorDocumentRepository(db.documents, codec("documents")),
+        messages=MotorMessageRepository(db.messages, codec("messages")),
+        contacts=MotorArchivableRepository(db.contacts, codec("contacts")),
+        quotes=MotorArchivableRepository(db.quotes, codec("quotes")),
+        status_checks=MotorStatusCheckRepository(db.status_checks, codec("status_checks")),
+        upload_sessions=MotorUploadSessionRepository(db.upload_sessions, codec("upload_sessions")),
+        idempotency_keys=MotorIdempotencyRepository(db.idempotency_keys, codec("idempotency_keys")),
+        rollups=MotorRollupRepository(db.analytics_rollups, codec("analytics_rollups")),
+        user_summaries=MotorSummaryRepository(db.user_summaries, codec("user_summaries")),
+        document_jobs=MotorJobRepository(db.document_jobs, codec("document_jobs")),
+        leases=MotorLeaseRepository(db.leases, codec("leases")),
+        blobs=GridFSBlobStore(db),
+        engine="mongo",
+        db=db,
+        ttl_seconds=ttl_seconds or {},
+    )
@@ -1,5 +1,8 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Depends, Request, Response, status, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -7,35 +10,173 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Union
 import uuid
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 import jwt
 from enum import Enum
 import base64
+import asyncio
+import hashlib
+import tempfile
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+from pymongo.errors import DuplicateKeyError
+from analytics import ROLLUP_DIMENSIONS, RollupWriter, query_range, read_rollups
+from archive import ARCHIVED_COLLECTIONS, Archiver, archive_from_env, retention_from_env
+from idempotency import IdempotencyMiddleware
+from logs import AccessLogMiddleware, parse_sample_rates, set_user, setup_logging
+from static_site import StaticSite
+from passwords import PasswordHasher
+from summaries import order_contribution, present_summary, rebuild_for_user, summary_delta
+from warmup import Warmup
+from profiling import ProfiledRoute, ProfileWriter, ProfilingMiddleware, instrument_repositories, phase
+from processing import DocumentProcessor
+from uploads import READ_SIZE, ChunkTooLarge, UploadFiles, session_lock
+from compression import (
+    CompressionMiddleware,
+    choose_codec,
+    compress_stream,
+    decompress_bytes,
+    decompress_stream,
+    pack_base64,
+    unpack_base64,
+)
+from repositories import (
+    ACTIVE_ORDER_STATUSES,
+    Repositories,
+    create_memory_repositories,
+    create_motor_repositories,
+)
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Storage engine: "mongo" (default) or "memory" for offline runs
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "mongo")
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "5"))
+
+# Startup warmup; /readyz reports unready until it is done
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_TIMEOUT_SECONDS = float(os.environ.get("WARMUP_TIMEOUT_SECONDS", "10"))
+
+# Resumable uploads
+UPLOAD_SESSION_TTL_SECONDS = int(float(os.environ.get("UPLOAD_SESSION_TTL_HOURS", "24")) * 3600)
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_MAX_CHUNK_BYTES = int(os.environ.get("UPLOAD_MAX_CHUNK_BYTES", str(16 * 1024 * 1024)))
+upload_files = UploadFiles(Path(os.environ.get("UPLOAD_TMP_DIR", Path(tempfile.gettempdir()) / "oneexim-uploads")))
+
+# Compression of stored documents and of responses
+DOCUMENT_COMPRESSION = os.environ.get("DOCUMENT_COMPRESSION", "1") == "1"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_CACHE_BYTES = int(float(os.environ.get("RESPONSE_CACHE_MB", "16")) * 1024 * 1024)
+
+# Request profiling (off unless a sample rate or debug token is set)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DEBUG_TOKEN = os.environ.get("PROFILE_DEBUG_TOKEN") or None
+PROFILING_ENABLED = PROFILE_SAMPLE_RATE > 0 or PROFILE_DEBUG_TOKEN is not None
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", ROOT_DIR / "profiles"))
+PROFILE_MAX_BYTES = int(float(os.environ.get("PROFILE_MAX_MB", "100")) * 1024 * 1024)
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "1"))
+
+# Logging
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Access log sampling per route name, e.g. "get_status_checks=0.1,root=0.01"
+LOG_SAMPLE_RATES = parse_sample_rates(
+    os.environ.get("LOG_SAMPLE_RATES", "get_status_checks=0.1,healthz=0.01,readyz=0.01")
+)
+LOG_SLOW_MS = float(os.environ.get("LOG_SLOW_MS", "1000"))
+# Time repository calls for db_ms/db_calls in the access log; costs a proxy
+# hop per call, so off unless asked for (profiling turns it on as well)
+LOG_DB_TIMING = os.environ.get("LOG_DB_TIMING", "0") == "1"
+
+# Built React app, served from / when present (SERVE_FRONTEND=0 to disable)
+SERVE_FRONTEND = os.environ.get("SERVE_FRONTEND", "1") == "1"
+FRONTEND_BUILD_DIR = Path(os.environ.get("FRONTEND_BUILD_DIR", ROOT_DIR.parent / "frontend" / "build"))
+
+# Password hashing; `python benchmarks.py passwords` suggests a cost for this host.
+# Stored hashes made under another scheme or cost are replaced on login.
+PASSWORD_SCHEME = os.environ.get("PASSWORD_SCHEME", "bcrypt")  # or argon2 (needs argon2-cffi)
+PASSWORD_BCRYPT_ROUNDS = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", "12"))
+PASSWORD_ARGON2_TIME_COST = int(os.environ.get("PASSWORD_ARGON2_TIME_COST", "3"))
+PASSWORD_ARGON2_MEMORY_KIB = int(os.environ.get("PASSWORD_ARGON2_MEMORY_KIB", str(64 * 1024)))
+PASSWORD_ARGON2_PARALLELISM = int(os.environ.get("PASSWORD_ARGON2_PARALLELISM", "1"))
+
+# Order timelines: events returned by /orders/{id}/timeline and embedded
+# in GET /orders/{id}?events=N
+ORDER_TIMELINE_LIMIT = int(os.environ.get("ORDER_TIMELINE_LIMIT", "200"))
+ORDER_EMBEDDED_EVENTS_MAX = int(os.environ.get("ORDER_EMBEDDED_EVENTS_MAX", "50"))
+
+# Idempotency-Key handling for retried creates
+IDEMPOTENCY_TTL_SECONDS = int(float(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24")) * 3600)
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "1024"))
+IDEMPOTENT_ROUTES = {("POST", "/api/orders"), ("POST", "/api/documents")}
+
+# Retention; expiring status checks is opt-in, like archiving (0: keep forever)
+TTL_SECONDS = {
+    "status_checks": int(os.environ.get("STATUS_CHECK_TTL_DAYS", "0")) * 86400,
+    "upload_sessions": UPLOAD_SESSION_TTL_SECONDS,
+    "idempotency_keys": IDEMPOTENCY_TTL_SECONDS,
+    # Finished jobs only; the results live on the documents
+    "document_jobs": int(os.environ.get("PROCESSING_JOB_TTL_DAYS", "7")) * 86400,
+}
+ARCHIVE_INTERVAL_MINUTES = float(os.environ.get("ARCHIVE_INTERVAL_MINUTES", "60"))
+archive = archive_from_env(ROOT_DIR)
+
+# Post-upload document processing; PROCESSING_WORKERS=0 leaves the queued
+# jobs to a separate `python processing.py run`
+PROCESSING_WORKERS = int(os.environ.get("PROCESSING_WORKERS", "2"))
+PROCESSING_CONCURRENCY = int(os.environ.get("PROCESSING_CONCURRENCY", str(max(1, PROCESSING_WORKERS))))
+document_processor = DocumentProcessor(
+    workers=max(1, PROCESSING_WORKERS),
+    concurrency=PROCESSING_CONCURRENCY,
+    max_attempts=int(os.environ.get("PROCESSING_MAX_ATTEMPTS", "3")),
+    retry_seconds=float(os.environ.get("PROCESSING_RETRY_SECONDS", "30")),
+    tmp_dir=os.environ.get("PROCESSING_TMP_DIR") or None,
+)
+
+# Contact/quote rollups; 0 updates them on every submission, >0 batches
+ANALYTICS_FLUSH_SECONDS = float(os.environ.get("ANALYTICS_FLUSH_SECONDS", "0"))
+rollup_writer = RollupWriter(ANALYTICS_FLUSH_SECONDS)
 
 # Create the main app without a prefix
 app = FastAPI()
 
+if STORAGE_ENGINE == "memory":
+    client = None
+    app.state.repositories = create_memory_repositories(TTL_SECONDS)
+else:
+    # MongoDB connection
+    mongo_url = os.environ['MONGO_URL']
+    client = AsyncIOMotorClient(mongo_url, minPoolSize=MONGO_MIN_POOL_SIZE)
+    db = client[os.environ['DB_NAME']]
+    app.state.repositories = create_motor_repositories(
+        db, os.environ.get("SCHEMA_MODE", "legacy"), TTL_SECONDS
+    )
+
+if LOG_DB_TIMING or PROFILING_ENABLED:
+    # Times repository calls for the access log and the profiler's db phase
+    instrument_repositories(app.state.repositories)
+
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", route_class=ProfiledRoute if PROFILING_ENABLED else APIRoute)
 
 # Security
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+passwords = PasswordHasher(
+    PASSWORD_SCHEME,
+    bcrypt_rounds=PASSWORD_BCRYPT_ROUNDS,
+    argon2_time_cost=PASSWORD_ARGON2_TIME_COST,
+    argon2_memory_kib=PASSWORD_ARGON2_MEMORY_KIB,
+    argon2_parallelism=PASSWORD_ARGON2_PARALLELISM,
+)
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
 
 # Enums
 class OrderStatus(str, Enum):
@@ -45,6 +186,11 @@ class OrderStatus(str, Enum):
     DELIVERED = "delivered"
     CANCELLED = "cancelled"
 
+class OrderEventType(str, Enum):
+    CREATED = "created"
+    STATUS_CHANGED = "status_changed"
+    UPDATED = "updated"
+
 class DocumentType(str, Enum):
     INVOICE = "invoice"
     PACKING_LIST = "packing_list"
@@ -57,6 +203,16 @@ class MessageType(str, Enum):
     USER = "user"
     ADMIN = "admin"
 
+class ProcessingStatus(str, Enum):
+    PENDING = "pending"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+class UploadStatus(str, Enum):
+    OPEN = "open"
+    COMPLETING = "completing"
+    COMPLETED = "completed"
+
 
 # Define Models
 class StatusCheck(BaseModel):
@@ -78,6 +234,8 @@ class User(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
     hashed_password: str
+    # Per-scope counters bumped on every write, used for ETags
+    data_versions: Dict[str, int] = Field(default_factory=dict)
 
 class UserCreate(BaseModel):
     name: str
@@ -138,18 +296,61 @@ class OrderUpdate(BaseModel):
     notes: Optional[str] = None
     total_amount: Optional[float] = None
 
+class OrderEvent(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    order_id: str
+    user_id: str
+    type: OrderEventType
+    status: OrderStatus  # Status after the event
+    from_status: Optional[OrderStatus] = None
+    changes: Dict[str, Any] = Field(default_factory=dict)  # Fields set by the event
+    actor: Optional[str] = None  # User id of whoever made the change
+    ts: datetime = Field(default_factory=datetime.utcnow)
+
+class OrderTimelineEntry(BaseModel):
+    ts: datetime
+    type: OrderEventType
+    status: OrderStatus
+
+class OrderWithEvents(Order):
+    events: List[OrderEvent] = Field(default_factory=list)  # Latest events, oldest first
+
+class OrderSummary(BaseModel):
+    order_count: int = 0
+    last_order_at: Optional[datetime] = None
+    status_counts: Dict[str, int] = Field(default_factory=dict)
+    totals: Dict[str, float] = Field(default_factory=dict)  # total_amount by currency, cancelled orders excluded
+    country_counts: Dict[str, int] = Field(default_factory=dict)
+
 # Document Models
+class DocumentProcessing(BaseModel):
+    detected_mime_type: Optional[str] = None  # From the file's magic bytes
+    mime_type_matches: Optional[bool] = None
+    verified_size: Optional[int] = None  # Decoded size in bytes
+    size_matches: Optional[bool] = None
+    sha256: Optional[str] = None
+    page_count: Optional[int] = None  # PDFs only
+    error: Optional[str] = None
+    attempts: int = 0
+    processed_at: Optional[datetime] = None
+
 class Document(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     order_id: str
     user_id: str
     document_type: DocumentType
     filename: str
-    file_data: str  # Base64 encoded file data
+    file_data: Optional[str] = None  # Base64 encoded file data, unless stored as a blob
+    blob_id: Optional[str] = None  # Blob store id for documents from upload sessions
     file_size: int
     mime_type: str
+    checksum: Optional[str] = None  # SHA-256 hex digest, computed by the server
+    compression: Optional[str] = None  # Codec the stored data is compressed with
+    stored_size: Optional[int] = None  # Bytes at rest after compression
     uploaded_at: datetime = Field(default_factory=datetime.utcnow)
     description: Optional[str] = None
+    processing_status: Optional[ProcessingStatus] = ProcessingStatus.PENDING  # None: uploaded before processing existed
+    processing: Optional[DocumentProcessing] = None
 
 class DocumentCreate(BaseModel):
     order_id: str
@@ -167,8 +368,48 @@ class DocumentResponse(BaseModel):
     filename: str
     file_size: int
     mime_type: str
+    checksum: Optional[str] = None
     uploaded_at: datetime
     description: Optional[str] = None
+    processing_status: Optional[ProcessingStatus] = None
+    processing: Optional[DocumentProcessing] = None
+
+# Upload Session Models
+class UploadSession(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    order_id: str
+    document_type: DocumentType
+    filename: str
+    mime_type: str
+    total_size: Optional[int] = None
+    description: Optional[str] = None
+    received: int = 0
+    status: UploadStatus = UploadStatus.OPEN
+    document_id: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class UploadSessionCreate(BaseModel):
+    order_id: str
+    document_type: DocumentType
+    filename: str
+    mime_type: str
+    total_size: Optional[int] = None
+    description: Optional[str] = None
+
+class UploadSessionResponse(BaseModel):
+    id: str
+    order_id: str
+    document_type: DocumentType
+    filename: str
+    mime_type: str
+    total_size: Optional[int] = None
+    received: int
+    status: UploadStatus
+    document_id: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
 
 # Message Models
 class Message(BaseModel):
@@ -251,12 +492,18 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     email: Optional[str] = None
 
-# Utility functions
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+# Dependencies
+def get_repositories(request: Request) -> Repositories:
+    return request.app.state.repositories
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+# Utility functions
+async def rehash_password(repos: Repositories, user_id: str, password: str, old_hash: str) -> None:
+    try:
+        new_hash = await passwords.hash(password)
+        await repos.users.replace_password_hash(user_id, old_hash, new_hash)
+    except Exception:
+        # The old hash still works; the next login tries again
+        logger.exception("Could not rehash the password of user %s", user_id)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -268,37 +515,74 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    repos: Repositories = Depends(get_repositories)
+):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+    with phase("auth"):
+        try:
+            payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+            token_data = TokenData(email=email)
+        except jwt.PyJWTError:
+            raise credentials_exception
+        
+        user = await repos.users.get_by_email(email)
+        if user is None:
             raise credentials_exception
-        token_data = TokenData(email=email)
+        set_user(user["id"])
+        return User(**user)
+
+def token_subject(authorization: str) -> Optional[str]:
+    """The email a valid Bearer token was issued to, without a database lookup."""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
     except jwt.PyJWTError:
-        raise credentials_exception
-    
-    user = await db.users.find_one({"email": email})
-    if user is None:
-        raise credentials_exception
-    return User(**user)
+        return None
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+def entity_tag(user: User, scope: str, variant: str = "") -> str:
+    """Weak ETag of ``user``'s data in ``scope``; ``variant`` tells apart representations of it."""
+    suffix = f".{variant}" if variant else ""
+    return f'W/"{user.id}.{scope}.{user.data_versions.get(scope, 0)}{suffix}"'
+
+def check_not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Set the ETag on ``response``; return a 304 if the client already has it."""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    response.headers.update(headers)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Weak comparison, as required for If-None-Match
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
+
+async def get_current_admin_user(current_user: User = Depends(get_current_active_user)):
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
 # API Routes
 
 # Authentication Routes
 @api_router.post("/register", response_model=UserResponse)
-async def register(user: UserCreate):
+async def register(user: UserCreate, repos: Repositories = Depends(get_repositories)):
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": user.email})
+    existing_user = await repos.users.get_by_email(user.email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -306,25 +590,41 @@ async def register(user: UserCreate):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await passwords.hash(user.password)
     user_dict = user.dict()
     user_dict.pop("password")
     user_dict["hashed_password"] = hashed_password
     
     new_user = User(**user_dict)
-    await db.users.insert_one(new_user.dict())
+    try:
+        await repos.users.insert(new_user.dict())
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
     
     return UserResponse(**new_user.dict())
 
 @api_router.post("/login", response_model=Token)
-async def login(user_credentials: UserLogin):
-    user = await db.users.find_one({"email": user_credentials.email})
-    if not user or not verify_password(user_credentials.password, user["hashed_password"]):
+async def login(
+    user_credentials: UserLogin,
+    background_tasks: BackgroundTasks,
+    repos: Repositories = Depends(get_repositories)
+):
+    user = await repos.users.get_by_email(user_credentials.email)
+    if not user or not await passwords.verify(user_credentials.password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if passwords.needs_rehash(user["hashed_password"]):
+        # After the response, so the login doesn't pay for a second hash
+        background_tasks.add_task(
+            rehash_password, repos, user["id"], user_credentials.password, user["hashed_password"]
+        )
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -334,32 +634,54 @@ async def login(user_credentials: UserLogin):
 
 # User Profile Routes
 @api_router.get("/profile", response_model=UserResponse)
-async def get_profile(current_user: User = Depends(get_current_active_user)):
+async def get_profile(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user)
+):
+    not_modified = check_not_modified(request, response, entity_tag(current_user, "profile"))
+    if not_modified:
+        return not_modified
     return UserResponse(**current_user.dict())
 
 @api_router.put("/profile", response_model=UserResponse)
 async def update_profile(
     user_update: UserUpdate,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
     update_data = user_update.dict(exclude_unset=True)
     if update_data:
-        await db.users.update_one(
-            {"id": current_user.id},
-            {"$set": update_data}
-        )
+        await repos.users.update(current_user.id, update_data)
+        await repos.users.bump_versions(current_user.id, "profile")
     
-    updated_user = await db.users.find_one({"id": current_user.id})
+    updated_user = await repos.users.get_by_id(current_user.id)
     return UserResponse(**updated_user)
 
 # Order Routes
+async def append_order_event(repos: Repositories, event: OrderEvent) -> None:
+    try:
+        await repos.order_events.insert(event.dict())
+    except Exception:
+        # The order write already happened; the timeline just misses this entry
+        logger.exception("Could not record the %s event of order %s", event.type.value, event.order_id)
+
+async def update_summary(
+    repos: Repositories, user_id: str, amounts: Dict[str, Any], last_order_at: Optional[datetime], now: datetime
+) -> None:
+    if await repos.user_summaries.apply(user_id, amounts, last_order_at, now):
+        # The summary is new and only holds this write; the user can have
+        # orders from before summaries existed, so count them all
+        await rebuild_for_user(repos, user_id, now)
+
 @api_router.post("/orders", response_model=Order)
 async def create_order(
     order: OrderCreate,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
     # Generate order number
-    order_count = await db.orders.count_documents({"user_id": current_user.id})
+    order_count = await repos.orders.count_for_user(current_user.id)
     order_number = f"ORD-{current_user.id[:8]}-{order_count + 1:04d}"
     
     order_dict = order.dict()
@@ -367,132 +689,411 @@ async def create_order(
     order_dict["order_number"] = order_number
     
     new_order = Order(**order_dict)
-    await db.orders.insert_one(new_order.dict())
+    await repos.orders.insert(new_order.dict())
+    try:
+        await update_summary(
+            repos, current_user.id, order_contribution(new_order.dict()), new_order.created_at, datetime.utcnow()
+        )
+    except Exception:
+        # The order is stored; failing now would only invite a duplicate retry
+        logger.exception("Could not update the order summary of user %s", current_user.id)
+    await append_order_event(repos, OrderEvent(
+        order_id=new_order.id,
+        user_id=current_user.id,
+        type=OrderEventType.CREATED,
+        status=new_order.status,
+        actor=current_user.id,
+        ts=new_order.created_at,
+    ))
+    await repos.users.bump_versions(current_user.id, "orders")
     
     return new_order
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_active_user)):
-    orders = await db.orders.find({"user_id": current_user.id}).sort("created_at", -1).to_list(100)
+async def get_orders(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    not_modified = check_not_modified(request, response, entity_tag(current_user, "orders"))
+    if not_modified:
+        return not_modified
+    orders = await repos.orders.list_for_user(current_user.id)
     return [Order(**order) for order in orders]
 
-@api_router.get("/orders/{order_id}", response_model=Order)
+@api_router.get("/orders/{order_id}", response_model=Union[OrderWithEvents, Order])
 async def get_order(
     order_id: str,
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    response: Response,
+    events: int = 0,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
-    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
+    events = max(0, min(events, ORDER_EMBEDDED_EVENTS_MAX))
+    # The orders version covers every order of the user, so a matching tag
+    # is answered without looking the order up. The tag names the order: a
+    # client only holds it from a 200 for this order, and orders are never
+    # deleted or moved to another user
+    etag = entity_tag(current_user, "orders", f"{order_id}.events{events}" if events else order_id)
+    not_modified = check_not_modified(request, response, etag)
+    if not_modified:
+        return not_modified
+    if events:
+        # Order and its latest events in one query
+        order = await repos.orders.get_for_user_with_events(order_id, current_user.id, events)
+    else:
+        order = await repos.orders.get_for_user(order_id, current_user.id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    return Order(**order)
+    return OrderWithEvents(**order) if events else Order(**order)
+
+@api_router.get("/orders/{order_id}/timeline", response_model=List[OrderTimelineEntry])
+async def get_order_timeline(
+    order_id: str,
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Events are only written along with a bump of the orders version
+    etag = entity_tag(current_user, "orders", f"{order_id}.timeline")
+    not_modified = check_not_modified(request, response, etag)
+    if not_modified:
+        return not_modified
+    if not await repos.orders.get_for_user(order_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Order not found")
+    timeline = await repos.order_events.timeline(order_id, ORDER_TIMELINE_LIMIT)
+    return [OrderTimelineEntry(**entry) for entry in timeline]
+
+@api_router.get("/dashboard/summary", response_model=OrderSummary)
+async def get_order_summary(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Maintained on every order write, so it shares the orders version
+    not_modified = check_not_modified(request, response, entity_tag(current_user, "orders"))
+    if not_modified:
+        return not_modified
+    summary = await repos.user_summaries.get(current_user.id)
+    return OrderSummary(**present_summary(summary))
 
 # Document Routes
 @api_router.post("/documents", response_model=DocumentResponse)
 async def upload_document(
     document: DocumentCreate,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
     # Verify order belongs to user
-    order = await db.orders.find_one({"id": document.order_id, "user_id": current_user.id})
+    order = await repos.orders.get_for_user(document.order_id, current_user.id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
     doc_dict = document.dict()
     doc_dict["user_id"] = current_user.id
+    if DOCUMENT_COMPRESSION:
+        doc_dict["file_data"], doc_dict["compression"], doc_dict["stored_size"] = await asyncio.to_thread(
+            pack_base64, document.file_data, document.mime_type
+        )
     
     new_document = Document(**doc_dict)
-    await db.documents.insert_one(new_document.dict())
+    await repos.documents.insert(new_document.dict())
+    await document_processor.enqueue(repos.document_jobs, new_document.id)
     
     return DocumentResponse(**new_document.dict())
 
 @api_router.get("/orders/{order_id}/documents", response_model=List[DocumentResponse])
 async def get_order_documents(
     order_id: str,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
     # Verify order belongs to user
-    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
+    order = await repos.orders.get_for_user(order_id, current_user.id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    documents = await db.documents.find({"order_id": order_id}).to_list(100)
+    documents = await repos.documents.list_for_order(order_id)
     return [DocumentResponse(**doc) for doc in documents]
 
 @api_router.get("/documents/{document_id}")
 async def download_document(
     document_id: str,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
-    document = await db.documents.find_one({"id": document_id, "user_id": current_user.id})
+    document = await repos.documents.get_for_user(document_id, current_user.id)
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
+    compression = document.get("compression")
+    if document.get("blob_id"):
+        chunks = decompress_stream(repos.blobs.open(document["blob_id"]), compression)
+        content = b"".join([chunk async for chunk in chunks])
+        file_data = base64.b64encode(content).decode()
+    else:
+        file_data = await asyncio.to_thread(unpack_base64, document["file_data"], compression)
+    
     return {
         "filename": document["filename"],
-        "file_data": document["file_data"],
+        "file_data": file_data,
         "mime_type": document["mime_type"]
     }
 
+@api_router.get("/documents/{document_id}/content")
+async def download_document_content(
+    document_id: str,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    document = await repos.documents.get_for_user(document_id, current_user.id)
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    compression = document.get("compression")
+    if document.get("blob_id"):
+        body = decompress_stream(repos.blobs.open(document["blob_id"]), compression)
+    else:
+        content = await asyncio.to_thread(decompress_bytes, base64.b64decode(document["file_data"]), compression)
+        body = iter([content])
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(document['filename'])}"}
+    if document.get("checksum"):
+        headers["ETag"] = f'"{document["checksum"]}"'
+    return StreamingResponse(body, media_type=document["mime_type"], headers=headers)
+
+# Upload Session Routes
+async def get_upload_session(
+    session_id: str,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+) -> UploadSession:
+    session = await repos.upload_sessions.get_for_user(session_id, current_user.id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return UploadSession(**session)
+
+@api_router.post("/uploads", response_model=UploadSessionResponse)
+async def create_upload_session(
+    upload: UploadSessionCreate,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Verify order belongs to user
+    order = await repos.orders.get_for_user(upload.order_id, current_user.id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    if upload.total_size is not None and not 0 < upload.total_size <= UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {UPLOAD_MAX_BYTES} bytes")
+    
+    session = UploadSession(user_id=current_user.id, **upload.dict())
+    await asyncio.to_thread(upload_files.create, session.id)
+    await repos.upload_sessions.insert(session.dict())
+    return UploadSessionResponse(**session.dict())
+
+@api_router.get("/uploads/{session_id}", response_model=UploadSessionResponse)
+async def get_upload_session_status(session: UploadSession = Depends(get_upload_session)):
+    return UploadSessionResponse(**session.dict())
+
+@api_router.put("/uploads/{session_id}", response_model=UploadSessionResponse)
+async def upload_chunk(
+    request: Request,
+    offset: int,
+    session: UploadSession = Depends(get_upload_session),
+    repos: Repositories = Depends(get_repositories)
+):
+    """Append the raw request body to the upload at ``offset``.
+
+    ``offset`` must equal the session's ``received`` count; on a 409 the
+    client re-reads the session and resumes from the offset reported there.
+    """
+    async with session_lock(session.id):
+        # Re-read under the lock: another chunk may have just been accepted
+        current = await repos.upload_sessions.get_for_user(session.id, session.user_id)
+        session = UploadSession(**current) if current else session
+        if session.status != UploadStatus.OPEN:
+            raise HTTPException(status_code=409, detail="Upload session is not open")
+        if offset != session.received:
+            raise HTTPException(status_code=409, detail=f"Expected offset {session.received}")
+        if not upload_files.exists(session.id):
+            raise HTTPException(status_code=404, detail="Upload session expired")
+        
+        limit = UPLOAD_MAX_BYTES if session.total_size is None else session.total_size
+        max_bytes = min(UPLOAD_MAX_CHUNK_BYTES, limit - offset)
+        try:
+            written = await upload_files.write_chunk(session.id, offset, request.stream(), max_bytes)
+        except ChunkTooLarge:
+            raise HTTPException(status_code=413, detail=f"Chunks are limited to {max_bytes} bytes here")
+        
+        now = datetime.utcnow()
+        if not await repos.upload_sessions.advance(session.id, offset, offset + written, now):
+            raise HTTPException(status_code=409, detail="Upload session changed, re-read the offset")
+        session.received = offset + written
+        session.updated_at = now
+    return UploadSessionResponse(**session.dict())
+
+async def abandon_completion(
+    repos: Repositories, session_id: str, blob_id: str, document_id: Optional[str]
+) -> None:
+    """Undo a failed completion and reopen the session, so the client can retry it."""
+    steps = [
+        lambda: repos.upload_sessions.transition(session_id, UploadStatus.COMPLETING, {"status": UploadStatus.OPEN}),
+        # The chunk files are only removed after success; the sweeper never sees the blob
+        lambda: repos.blobs.delete(blob_id),
+    ]
+    if document_id is not None:
+        steps.append(lambda: repos.documents.delete(document_id))
+    for step in steps:
+        try:
+            await step()
+        except Exception:
+            # e.g. a blob that was never created
+            logger.warning("Cleanup after failed completion of upload %s failed", session_id, exc_info=True)
+
+@api_router.post("/uploads/{session_id}/complete", response_model=DocumentResponse)
+async def complete_upload(
+    session: UploadSession = Depends(get_upload_session),
+    repos: Repositories = Depends(get_repositories)
+):
+    async with session_lock(session.id):
+        # Re-read under the lock, so no chunk of this process is accepted after it
+        current = await repos.upload_sessions.get_for_user(session.id, session.user_id)
+        session = UploadSession(**current) if current else session
+        if session.status == UploadStatus.COMPLETED:
+            # Retried completion: hand back the document we already created
+            document = await repos.documents.get_for_user(session.document_id, session.user_id)
+            if document:
+                return DocumentResponse(**document)
+        if session.status != UploadStatus.OPEN:
+            raise HTTPException(status_code=409, detail="Upload is already being completed")
+        if session.received == 0:
+            raise HTTPException(status_code=400, detail="No data uploaded")
+        if session.total_size is not None and session.received != session.total_size:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Received {session.received} of {session.total_size} bytes"
+            )
+        if not await repos.upload_sessions.transition(
+            session.id, UploadStatus.OPEN, {"status": UploadStatus.COMPLETING, "updated_at": datetime.utcnow()}
+        ):
+            raise HTTPException(status_code=409, detail="Upload is already being completed")
+    
+    blob_id = str(uuid.uuid4())
+    new_document = None
+    try:
+        digest = hashlib.sha256()
+        stats = {"size": 0}
+        # The lock is per process; reading only the accepted bytes also keeps
+        # out a chunk another worker is still writing
+        content = upload_files.stream(session.id, session.received, digest, stats)
+        compression = None
+        if DOCUMENT_COMPRESSION:
+            sample = await asyncio.to_thread(upload_files.read_head, session.id, min(READ_SIZE, session.received))
+            compression = await asyncio.to_thread(choose_codec, session.mime_type, sample)
+            if compression:
+                content = compress_stream(content, compression)
+        stored_size = await repos.blobs.put(
+            blob_id,
+            content,
+            session.filename,
+            {"user_id": session.user_id, "order_id": session.order_id, "compression": compression},
+        )
+        new_document = Document(
+            order_id=session.order_id,
+            user_id=session.user_id,
+            document_type=session.document_type,
+            filename=session.filename,
+            blob_id=blob_id,
+            file_size=stats["size"],
+            mime_type=session.mime_type,
+            checksum=digest.hexdigest(),
+            compression=compression,
+            stored_size=stored_size,
+            description=session.description,
+        )
+        await repos.documents.insert(new_document.dict())
+        await repos.upload_sessions.transition(
+            session.id,
+            UploadStatus.COMPLETING,
+            {"status": UploadStatus.COMPLETED, "document_id": new_document.id, "updated_at": datetime.utcnow()}
+        )
+    except BaseException:
+        await abandon_completion(repos, session.id, blob_id, new_document.id if new_document else None)
+        raise
+    
+    await asyncio.to_thread(upload_files.remove, session.id)
+    # Doesn't raise; a document it fails to queue is picked up by `processing.py enqueue`
+    await document_processor.enqueue(repos.document_jobs, new_document.id)
+    return DocumentResponse(**new_document.dict())
+
 # Message Routes
 @api_router.post("/messages", response_model=MessageResponse)
 async def create_message(
     message: MessageCreate,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
     msg_dict = message.dict()
     msg_dict["user_id"] = current_user.id
     
     new_message = Message(**msg_dict)
-    await db.messages.insert_one(new_message.dict())
+    await repos.messages.insert(new_message.dict())
+    await repos.users.bump_versions(current_user.id, "messages")
     
     return MessageResponse(**new_message.dict())
 
 @api_router.get("/messages", response_model=List[MessageResponse])
-async def get_messages(current_user: User = Depends(get_current_active_user)):
-    messages = await db.messages.find({"user_id": current_user.id}).sort("created_at", -1).to_list(100)
+async def get_messages(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    not_modified = check_not_modified(request, response, entity_tag(current_user, "messages"))
+    if not_modified:
+        return not_modified
+    messages = await repos.messages.list_for_user(current_user.id)
     return [MessageResponse(**msg) for msg in messages]
 
 @api_router.put("/messages/{message_id}/read")
 async def mark_message_read(
     message_id: str,
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
 ):
-    await db.messages.update_one(
-        {"id": message_id, "user_id": current_user.id},
-        {"$set": {"is_read": True}}
-    )
+    if await repos.messages.mark_read(message_id, current_user.id):
+        await repos.users.bump_versions(current_user.id, "messages")
     return {"message": "Message marked as read"}
 
 # Contact Form Route
 @api_router.post("/contact", response_model=ContactForm)
-async def create_contact(contact: ContactFormCreate):
+async def create_contact(contact: ContactFormCreate, repos: Repositories = Depends(get_repositories)):
     new_contact = ContactForm(**contact.dict())
-    await db.contacts.insert_one(new_contact.dict())
+    await repos.contacts.insert(new_contact.dict())
+    await rollup_writer.record(repos.rollups, "contacts", new_contact.dict())
     return new_contact
 
 # Quote Form Route
 @api_router.post("/quote", response_model=QuoteForm)
-async def create_quote(quote: QuoteFormCreate):
+async def create_quote(quote: QuoteFormCreate, repos: Repositories = Depends(get_repositories)):
     new_quote = QuoteForm(**quote.dict())
-    await db.quotes.insert_one(new_quote.dict())
+    await repos.quotes.insert(new_quote.dict())
+    await rollup_writer.record(repos.rollups, "quotes", new_quote.dict())
     return new_quote
 
 # Dashboard Stats Route
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_active_user)):
-    total_orders = await db.orders.count_documents({"user_id": current_user.id})
-    active_orders = await db.orders.count_documents({
-        "user_id": current_user.id,
-        "status": {"$in": ["pending", "processing", "shipped"]}
-    })
-    completed_orders = await db.orders.count_documents({
-        "user_id": current_user.id,
-        "status": "delivered"
-    })
-    unread_messages = await db.messages.count_documents({
-        "user_id": current_user.id,
-        "is_read": False
-    })
+async def get_dashboard_stats(
+    current_user: User = Depends(get_current_active_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    total_orders = await repos.orders.count_for_user(current_user.id)
+    active_orders = await repos.orders.count_for_user(current_user.id, ACTIVE_ORDER_STATUSES)
+    completed_orders = await repos.orders.count_for_user(current_user.id, ["delivered"])
+    unread_messages = await repos.messages.count_unread(current_user.id)
     
     return {
         "total_orders": total_orders,
@@ -501,26 +1102,129 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_active_us
         "unread_messages": unread_messages
     }
 
+# Admin Routes
+@api_router.get("/admin/archive/{collection}")
+async def read_archive(
+    collection: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 1000,
+    current_user: User = Depends(get_current_admin_user)
+):
+    if collection not in ARCHIVED_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="Unknown archive")
+    return await asyncio.to_thread(archive.read, collection, start, end, limit)
+
+@api_router.put("/admin/orders/{order_id}", response_model=Order)
+async def update_order(
+    order_id: str,
+    order_update: OrderUpdate,
+    current_user: User = Depends(get_current_admin_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    values = order_update.dict(exclude_unset=True)
+    if "status" in values and values["status"] is None:
+        raise HTTPException(status_code=400, detail="status cannot be cleared")
+    now = datetime.utcnow()
+    values["updated_at"] = now
+    before = await repos.orders.update(order_id, values)
+    if before is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    after = {**before, **values}
+    
+    changes = summary_delta(before, after)
+    if changes:
+        try:
+            await update_summary(repos, before["user_id"], changes, None, now)
+        except Exception:
+            logger.exception("Could not update the order summary of user %s", before["user_id"])
+    
+    changed = {k: v for k, v in values.items() if k != "updated_at" and before.get(k) != v}
+    if changed:
+        await append_order_event(repos, OrderEvent(
+            order_id=order_id,
+            user_id=before["user_id"],
+            type=OrderEventType.STATUS_CHANGED if "status" in changed else OrderEventType.UPDATED,
+            status=after["status"],
+            from_status=before.get("status"),
+            changes=changed,
+            actor=current_user.id,
+            ts=now,
+        ))
+    await repos.users.bump_versions(before["user_id"], "orders")
+    return Order(**after)
+
+@api_router.get("/admin/analytics/{collection}")
+async def read_analytics(
+    collection: str,
+    granularity: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_admin_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    if collection not in ROLLUP_DIMENSIONS:
+        raise HTTPException(status_code=404, detail="Unknown analytics collection")
+    try:
+        start, end = query_range(granularity, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await read_rollups(repos.rollups, collection, granularity, start, end)
+
 # Original routes
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
 
 @api_router.post("/status", response_model=StatusCheck)
-async def create_status_check(input: StatusCheckCreate):
+async def create_status_check(input: StatusCheckCreate, repos: Repositories = Depends(get_repositories)):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    await repos.status_checks.insert(status_obj.dict())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+async def get_status_checks(repos: Repositories = Depends(get_repositories)):
+    status_checks = await repos.status_checks.list()
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+# Health Routes (unprefixed, for the load balancer)
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz(request: Request):
+    warmup = getattr(request.app.state, "warmup", None)
+    if warmup is None:
+        return JSONResponse({"ready": False}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return JSONResponse(
+        warmup.status(),
+        status_code=status.HTTP_200_OK if warmup.ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Mounted last: it answers every path no route above matched
+if SERVE_FRONTEND and (FRONTEND_BUILD_DIR / "index.html").is_file():
+    app.mount("/", StaticSite(FRONTEND_BUILD_DIR), name="frontend")
+
+# Innermost, so replays store and return the uncompressed response
+app.add_middleware(
+    IdempotencyMiddleware,
+    principal=token_subject,
+    routes=IDEMPOTENT_ROUTES,
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS,
+    cache_size=IDEMPOTENCY_CACHE_SIZE,
+)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=RESPONSE_COMPRESSION_MIN_BYTES,
+    cache_bytes=RESPONSE_CACHE_BYTES,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -529,13 +1233,78 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+app.add_middleware(
+    AccessLogMiddleware,
+    sample_rates=LOG_SAMPLE_RATES,
+    slow_ms=LOG_SLOW_MS,
+    db_timing=LOG_DB_TIMING or PROFILING_ENABLED,
 )
+
+if PROFILING_ENABLED:
+    # Outermost, so the profile covers every other middleware too
+    app.add_middleware(
+        ProfilingMiddleware,
+        writer=ProfileWriter(PROFILE_DIR, PROFILE_MAX_BYTES),
+        sample_rate=PROFILE_SAMPLE_RATE,
+        debug_token=PROFILE_DEBUG_TOKEN,
+        interval=PROFILE_INTERVAL_MS / 1000,
+    )
+
+# Configure logging
+log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Stopped at the end of the previous lifespan if the app is started again
+    log_listener.start()
+    await app.state.repositories.ensure_indexes()
+
+    app.state.warmup = Warmup(app, client, passwords, MONGO_MIN_POOL_SIZE)
+    warmup_task = None
+    if WARMUP:
+        warmup_task = await app.state.warmup.start(WARMUP_TIMEOUT_SECONDS)
+    else:
+        app.state.warmup.skip()
+
+    archiver_task = None
+    archiver = Archiver(app.state.repositories, archive, retention_from_env())
+    if ARCHIVE_INTERVAL_MINUTES > 0 and archiver.enabled:
+        archiver_task = asyncio.create_task(archiver.run_forever(ARCHIVE_INTERVAL_MINUTES * 60))
+
+    # Sessions themselves expire through the TTL index on updated_at
+    upload_sweeper_task = asyncio.create_task(
+        upload_files.sweep_forever(UPLOAD_SESSION_TTL_SECONDS, 15 * 60)
+    )
+
+    processing_task = None
+    if PROCESSING_WORKERS > 0:
+        processing_task = asyncio.create_task(document_processor.run_forever(app.state.repositories))
+
+    rollup_task = None
+    if ANALYTICS_FLUSH_SECONDS > 0:
+        rollup_task = asyncio.create_task(rollup_writer.run_forever(app.state.repositories.rollups))
+
+    yield
+
+    app.state.warmup.draining = True
+    for task in (warmup_task, upload_sweeper_task, rollup_task):
+        if task is not None:
+            task.cancel()
+    # Awaited, so in-flight jobs are handed back and the archiver lease is
+    # released before the client closes
+    draining = [task for task in (processing_task, archiver_task) if task is not None]
+    for task in draining:
+        task.cancel()
+    await asyncio.gather(*draining, return_exceptions=True)
+    try:
+        await rollup_writer.flush(app.state.repositories.rollups)
+    except Exception:
+        logger.exception("Could not flush rollups on shutdown")
+    if client is not None:
+        client.close()
+    # Flushes whatever is still queued
+    log_listener.stop()
+
+# Defined last because it starts everything above
+app.router.lifespan_context = lifespan
@@ -0,0 +1,129 @@
+"""Serving the built React frontend.
+
+The build directory is indexed once at startup: for every file the index
+keeps its stat result, ETag, content type, whether its name is fingerprinted
+and which precompressed variants (``.br``/``.gz``, written by
+``frontend/scripts/precompress.js``) sit next to it. Requests are answered
+from the index alone, so a static hit never stats or lists the filesystem
+before the file itself is opened.
+
+Fingerprinted files (``main.2b21e188.js``) never change under the same name
+and are cached as immutable; everything else, notably ``index.html``, is
+revalidated. Paths that match no file and have no extension are client-side
+routes and get ``index.html``.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from starlette.websockets import WebSocketClose
+
+from compression import accepted_encodings
+
+FINGERPRINT = re.compile(r"\.[0-9a-f]{8,}\.")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# Preferred first
+VARIANTS = (("br", ".br"), ("gzip", ".gz"))
+# Never served on their own, only as variants of the file they belong to
+_VARIANT_SUFFIXES = tuple(suffix for _, suffix in VARIANTS)
+
+
+@dataclass
+class StaticFile:
+    path: Path
+    stat: os.stat_result
+    media_type: str
+    etag: str
+    cache_control: str
+    variants: Dict[str, Tuple[Path, os.stat_result]] = field(default_factory=dict)
+
+
+class StaticIndex:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.files: Dict[str, StaticFile] = {}
+        for path in sorted(self.root.rglob("*")):
+            if not path.is_file() or path.name.endswith(_VARIANT_SUFFIXES):
+                continue
+            stat = path.stat()
+            url = "/" + path.relative_to(self.root).as_posix()
+            variants = {}
+            for encoding, suffix in VARIANTS:
+                variant = path.with_name(path.name + suffix)
+                # react-scripts empties the build directory, so variants are never stale
+                if variant.is_file():
+                    variants[encoding] = (variant, variant.stat())
+            tag = hashlib.md5(f"{url}:{stat.st_mtime_ns}:{stat.st_size}".encode(), usedforsecurity=False)
+            self.files[url] = StaticFile(
+                path=path,
+                stat=stat,
+                media_type=mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+                # Weak, since the br, gzip and identity bodies all share it
+                etag=f'W/"{tag.hexdigest()}"',
+                cache_control=IMMUTABLE if FINGERPRINT.search(path.name) else REVALIDATE,
+                variants=variants,
+            )
+
+    def lookup(self, url_path: str) -> Optional[StaticFile]:
+        if url_path.endswith("/"):
+            url_path += "index.html"
+        return self.files.get(url_path)
+
+
+class StaticSite:
+    """ASGI app serving a ``StaticIndex`` with an SPA fallback to index.html."""
+
+    def __init__(self, directory: Path, excluded_prefixes: Tuple[str, ...] = ("/api/",)):
+        self.index = StaticIndex(directory)
+        self.excluded_prefixes = excluded_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            # Nothing here speaks websocket; refuse the handshake
+            await WebSocketClose()(scope, receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        response = self.respond(scope)
+        await response(scope, receive, send)
+
+    def respond(self, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        path = scope["path"]
+        static_file = self.index.lookup(path)
+        if static_file is None:
+            last_segment = path.rsplit("/", 1)[-1]
+            if path.startswith(self.excluded_prefixes) or "." in last_segment:
+                return JSONResponse({"detail": "Not Found"}, status_code=404)
+            static_file = self.index.lookup("/index.html")
+            if static_file is None:
+                return JSONResponse({"detail": "Not Found"}, status_code=404)
+
+        headers = dict(scope["headers"])
+        response_headers = {"ETag": static_file.etag, "Cache-Control": static_file.cache_control}
+        if static_file.variants:
+            response_headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = headers.get(b"if-none-match")
+        if if_none_match is not None:
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.decode("latin-1").split(",")}
+            if "*" in candidates or static_file.etag.removeprefix("W/") in candidates:
+                return Response(status_code=304, headers=response_headers)
+
+        file_path, stat = static_file.path, static_file.stat
+        if static_file.variants:
+            accepted = accepted_encodings(headers.get(b"accept-encoding", b"").decode("latin-1"))
+            for encoding, _ in VARIANTS:
+                if encoding in static_file.variants and accepted.get(encoding, 0) > 0:
+                    file_path, stat = static_file.variants[encoding]
+                    response_headers["Content-Encoding"] = encoding
+                    break
+
+        return FileResponse(file_path, headers=response_headers, media_type=static_file.media_type, stat_result=stat)
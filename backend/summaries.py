@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Per-user order summaries.
+
+``user_summaries`` holds one document per user with what the portal shows
+about their orders as a whole, so reading it is a single lookup by id:
+
+    {"id": <user id>, "order_count": 12, "last_order_at": 2025-01-15T09:30,
+     "status_counts": {"pending": 2, "shipped": 1, ...},
+     "totals": {"USD": 15400.0, "EUR": 800.0},
+     "country_counts": {"UAE": 7, "India": 5}}
+
+``totals`` sums ``total_amount`` by currency over orders that are not
+cancelled. Currency and country keys are escaped with ``escape_key``.
+
+The API keeps it current with one atomic update per order write: creating an
+order increments the counts and moves ``last_order_at`` forward, and an
+update applies the difference between the order before and after it. A user
+without a summary yet (a new user, or one whose orders predate summaries)
+gets it computed from all their orders by the write that creates it, so a
+difference is never applied to nothing. The order write and the summary
+update are not one transaction, so a crash in between can leave a summary
+behind its orders; ``check`` finds such summaries and ``rebuild`` recomputes
+them from the orders with a streaming aggregation:
+
+    python summaries.py check [--repair]
+    python summaries.py rebuild [--user <user id>]
+
+Run ``rebuild`` once when deploying summaries to a database that already has
+orders, so existing users see theirs before their next order write. Writes
+that land while a user is rebuilt can be overwritten, so rebuild in a quiet
+period (or re-check afterwards).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from codec import binary_to_uuid, codec_for
+from repositories import escape_key, unescape_key
+
+# Orders in this status don't count towards the totals
+EXCLUDED_FROM_TOTALS = "cancelled"
+UNSPECIFIED = "unspecified"
+COUNT_FIELDS = ("status_counts", "country_counts")
+BATCH_SIZE = 500
+
+
+def _value(value: Any) -> str:
+    value = getattr(value, "value", value)  # enums
+    return str(value).strip() if value is not None else ""
+
+
+def order_contribution(order: Dict[str, Any]) -> Dict[str, Any]:
+    """What one order adds to its user's summary, as ``$inc`` amounts by path."""
+    status = _value(order.get("status")) or "pending"
+    amounts: Dict[str, Any] = {
+        "order_count": 1,
+        f"status_counts.{escape_key(status)}": 1,
+        f"country_counts.{escape_key(_value(order.get('destination_country')) or UNSPECIFIED)}": 1,
+    }
+    if status != EXCLUDED_FROM_TOTALS and order.get("total_amount"):
+        currency = _value(order.get("currency")) or UNSPECIFIED
+        amounts[f"totals.{escape_key(currency)}"] = float(order["total_amount"])
+    return amounts
+
+
+def summary_delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """The ``$inc`` amounts turning ``before``'s contribution into ``after``'s."""
+    amounts: Counter = Counter(order_contribution(after))
+    amounts.subtract(order_contribution(before))
+    return {path: amount for path, amount in amounts.items() if amount != 0}
+
+
+def present_summary(summary: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """A stored summary with its keys unescaped and emptied entries dropped."""
+    summary = summary or {}
+    # Counts below zero only exist between a summary's creation and its rebuild
+    return {
+        "order_count": max(summary.get("order_count", 0), 0),
+        "last_order_at": summary.get("last_order_at"),
+        "status_counts": {unescape_key(k): v for k, v in (summary.get("status_counts") or {}).items() if v > 0},
+        "totals": {
+            unescape_key(k): round(v, 2) for k, v in (summary.get("totals") or {}).items() if abs(v) >= 0.005
+        },
+        "country_counts": {unescape_key(k): v for k, v in (summary.get("country_counts") or {}).items() if v > 0},
+    }
+
+
+def _empty_summary(user_id: str, last_order_at: Optional[datetime]) -> Dict[str, Any]:
+    return {
+        "id": user_id,
+        "order_count": 0,
+        "last_order_at": last_order_at,
+        "status_counts": {},
+        "totals": {},
+        "country_counts": {},
+    }
+
+
+def _add(summary: Dict[str, Any], amounts: Dict[str, Any], scale: int = 1) -> None:
+    for path, amount in amounts.items():
+        name, _, key = path.partition(".")
+        # Totals are already summed over the orders
+        amount = amount if name == "totals" else amount * scale
+        if key:
+            summary[name][key] = summary[name].get(key, 0) + amount
+        else:
+            summary[name] += amount
+
+
+def summary_from_orders(user_id: str, orders: List[Dict[str, Any]]) -> Dict[str, Any]:
+    summary = _empty_summary(user_id, max((o["created_at"] for o in orders), default=None))
+    for order in orders:
+        _add(summary, order_contribution(order))
+    return summary
+
+
+async def rebuild_for_user(repos, user_id: str, now: datetime) -> Dict[str, Any]:
+    """Recompute one user's summary from their orders through the repositories."""
+    summary = summary_from_orders(user_id, await repos.orders.list_for_user(user_id, limit=None))
+    summary["updated_at"] = now
+    await repos.user_summaries.replace([summary])
+    return summary
+
+
+# Rebuilding and checking
+def _pipeline(user_filter: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    counted_amount = {"$cond": [
+        {"$ne": ["$status", EXCLUDED_FROM_TOTALS]}, {"$ifNull": ["$total_amount", 0]}, 0
+    ]}
+    return [
+        *([{"$match": user_filter}] if user_filter else []),
+        {"$group": {
+            "_id": {"user": "$user_id", "status": "$status", "country": "$destination_country", "currency": "$currency"},
+            "orders": {"$sum": 1},
+            "amount": {"$sum": counted_amount},
+            "last_order_at": {"$max": "$created_at"},
+        }},
+        # One document per user; a user has few distinct status/country/currency combinations
+        {"$group": {
+            "_id": "$_id.user",
+            "groups": {"$push": {
+                "status": "$_id.status", "country": "$_id.country", "currency": "$_id.currency",
+                "orders": "$orders", "amount": "$amount",
+            }},
+            "last_order_at": {"$max": "$last_order_at"},
+        }},
+    ]
+
+
+def summary_from_groups(user_id: str, groups: List[Dict[str, Any]], last_order_at: Optional[datetime]) -> Dict[str, Any]:
+    summary = _empty_summary(user_id, last_order_at)
+    for group in groups:
+        # Same paths as the live updates, so both agree on keys
+        _add(summary, order_contribution({
+            "status": group.get("status"),
+            "destination_country": group.get("country"),
+            "currency": group.get("currency"),
+            "total_amount": group.get("amount"),
+        }), group["orders"])
+    return summary
+
+
+async def _user_rows(
+    db, user_filter: Optional[Dict[str, Any]], id_type: str, batch_size: int
+) -> AsyncIterator[Dict[str, Any]]:
+    """Grouped rows whose user id has BSON type ``id_type``, in user id order."""
+    pipeline = _pipeline(user_filter) + [{"$match": {"_id": {"$type": id_type}}}, {"$sort": {"_id": 1}}]
+    async for row in db.orders.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        row["_id"] = binary_to_uuid(row["_id"])
+        yield row
+
+
+async def _merge_rows(*runs: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Merge runs sorted by user id, combining the rows of the same user."""
+    heads = {i: await anext(run, None) for i, run in enumerate(runs)}
+    while any(row is not None for row in heads.values()):
+        user_id = min(row["_id"] for row in heads.values() if row is not None)
+        merged = {"_id": user_id, "groups": [], "last_order_at": None}
+        for i, row in heads.items():
+            if row is not None and row["_id"] == user_id:
+                merged["groups"] += row["groups"]
+                times = [t for t in (merged["last_order_at"], row["last_order_at"]) if t is not None]
+                merged["last_order_at"] = max(times, default=None)
+                heads[i] = await anext(runs[i], None)
+        yield merged
+
+
+async def expected_summaries(
+    db, schema_mode: str = "legacy", user_id: Optional[str] = None, batch_size: int = BATCH_SIZE
+) -> AsyncIterator[Dict[str, Any]]:
+    """Summaries computed from the orders, streamed one user at a time."""
+    user_filter = codec_for("orders", schema_mode).query({"user_id": user_id}) if user_id else None
+    if schema_mode == "dual":
+        # Orders hold either form of a user's id, and the two group apart.
+        # Sorted, both runs come in the same order (a UUID string sorts like
+        # its bytes), so they merge like sorted lists.
+        rows = _merge_rows(
+            _user_rows(db, user_filter, "string", batch_size),
+            _user_rows(db, user_filter, "binData", batch_size),
+        )
+    else:
+        rows = db.orders.aggregate(_pipeline(user_filter), allowDiskUse=True, batchSize=batch_size)
+    async for row in rows:
+        yield summary_from_groups(binary_to_uuid(row["_id"]), row["groups"], row["last_order_at"])
+
+
+def differences(expected: Dict[str, Any], stored: Optional[Dict[str, Any]]) -> List[str]:
+    """Fields where a stored summary disagrees with the one computed from orders."""
+    if stored is None:
+        return ["missing"]
+    expected, stored = present_summary(expected), present_summary(stored)
+    fields = [
+        field for field in ("order_count", "last_order_at", *COUNT_FIELDS)
+        if expected[field] != stored[field]
+    ]
+    totals, stored_totals = expected["totals"], stored["totals"]
+    if set(totals) != set(stored_totals) or any(
+        not math.isclose(totals[k], stored_totals[k], abs_tol=0.01) for k in totals
+    ):
+        fields.append("totals")
+    return fields
+
+
+async def _stored_ids(db, schema_mode: str) -> List[str]:
+    codec = codec_for("user_summaries", schema_mode)
+    return [codec.decode(doc)["id"] async for doc in db.user_summaries.find({}, {"_id": 0, "id": 1})]
+
+
+async def rebuild(db, repository, schema_mode: str = "legacy", user_id: Optional[str] = None) -> Dict[str, int]:
+    produced = set()
+    batch: List[Dict[str, Any]] = []
+    async for summary in expected_summaries(db, schema_mode, user_id):
+        summary["updated_at"] = datetime.utcnow()
+        batch.append(summary)
+        produced.add(summary["id"])
+        if len(batch) >= BATCH_SIZE:
+            await repository.replace(batch)
+            batch = []
+    await repository.replace(batch)
+    candidates = [user_id] if user_id else await _stored_ids(db, schema_mode)
+    stale = [i for i in candidates if i not in produced]
+    removed = await repository.delete(stale) if stale else 0
+    return {"rebuilt": len(produced), "removed": removed}
+
+
+async def check(db, repository, schema_mode: str = "legacy", repair: bool = False) -> Dict[str, Any]:
+    checked = 0
+    mismatched: Dict[str, List[str]] = {}
+    produced = set()
+
+    async def compare(batch: List[Dict[str, Any]]) -> None:
+        stored = {doc["id"]: doc for doc in await repository.get_many([s["id"] for s in batch])}
+        for summary in batch:
+            fields = differences(summary, stored.get(summary["id"]))
+            if fields:
+                mismatched[summary["id"]] = fields
+
+    batch: List[Dict[str, Any]] = []
+    async for summary in expected_summaries(db, schema_mode):
+        checked += 1
+        produced.add(summary["id"])
+        batch.append(summary)
+        if len(batch) >= BATCH_SIZE:
+            await compare(batch)
+            batch = []
+    if batch:
+        await compare(batch)
+    for orphan in await _stored_ids(db, schema_mode):
+        if orphan not in produced:
+            mismatched[orphan] = ["orphaned"]
+
+    repaired = 0
+    if repair:
+        for user_id in mismatched:
+            result = await rebuild(db, repository, schema_mode, user_id)
+            repaired += result["rebuilt"] + result["removed"]
+    return {"checked": checked, "mismatched": mismatched, "repaired": repaired}
+
+
+def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from repositories import create_motor_repositories
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    check_parser = commands.add_parser("check", help="compare every summary with its user's orders")
+    check_parser.add_argument("--repair", action="store_true", help="rebuild the summaries that disagree")
+    rebuild_parser = commands.add_parser("rebuild", help="recompute summaries from the orders")
+    rebuild_parser.add_argument("--user", help="only this user id")
+    args = parser.parse_args()
+
+    async def run():
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        db = client[os.environ['DB_NAME']]
+        schema_mode = os.environ.get("SCHEMA_MODE", "legacy")
+        repos = create_motor_repositories(db, schema_mode)
+        try:
+            await repos.ensure_indexes()
+            if args.command == "rebuild":
+                result = await rebuild(db, repos.user_summaries, schema_mode, args.user)
+            else:
+                result = await check(db, repos.user_summaries, schema_mode, args.repair)
+            print(json.dumps(result))
+        finally:
+            client.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
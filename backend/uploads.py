@@ -0,0 +1,145 @@
+"""Temporary file handling for resumable document uploads.
+
+Each upload session owns one ``<session id>.part`` file in UPLOAD_TMP_DIR.
+Chunks are streamed from the request body straight to that file at their
+offset, and on completion the file is streamed into the blob store while its
+size and SHA-256 are computed, so no step holds the whole document in memory.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import weakref
+from pathlib import Path
+from typing import AsyncIterator, Dict
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+# Buffer this much of the request body before each (threaded) file write
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+class ChunkTooLarge(Exception):
+    pass
+
+
+def session_lock(session_id: str) -> asyncio.Lock:
+    """Serializes chunk writes to, and completion of, one session within this process."""
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _session_locks[session_id] = lock
+    return lock
+
+
+class UploadFiles:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def path(self, session_id: str) -> Path:
+        return self.directory / f"{session_id}.part"
+
+    def create(self, session_id: str) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path(session_id).touch()
+
+    def exists(self, session_id: str) -> bool:
+        return self.path(session_id).exists()
+
+    def read_head(self, session_id: str, size: int) -> bytes:
+        with open(self.path(session_id), "rb") as f:
+            return f.read(size)
+
+    def remove(self, session_id: str) -> None:
+        self.path(session_id).unlink(missing_ok=True)
+
+    async def write_chunk(self, session_id: str, offset: int, body: AsyncIterator[bytes], max_bytes: int) -> int:
+        """Write ``body`` at ``offset``; return the number of bytes written.
+
+        Anything past ``offset`` from an earlier, interrupted chunk is
+        discarded first, so a retried chunk always lands on a clean tail.
+        """
+        f = await asyncio.to_thread(open, self.path(session_id), "r+b")
+        try:
+            await asyncio.to_thread(self._truncate_at, f, offset)
+            written = 0
+            buffer = bytearray()
+            async for data in body:
+                written += len(data)
+                if written > max_bytes:
+                    raise ChunkTooLarge(f"chunk exceeds {max_bytes} bytes")
+                buffer += data
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await asyncio.to_thread(f.write, bytes(buffer))
+            # The session only advances past data that is on disk
+            await asyncio.to_thread(self._sync, f)
+            return written
+        except BaseException:
+            await asyncio.to_thread(self._truncate_at, f, offset)
+            raise
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @staticmethod
+    def _truncate_at(f, offset: int) -> None:
+        f.seek(offset)
+        f.truncate()
+
+    @staticmethod
+    def _sync(f) -> None:
+        f.flush()
+        os.fsync(f.fileno())
+
+    async def stream(
+        self, session_id: str, size: int, digest: "hashlib._Hash", stats: Dict[str, int]
+    ) -> AsyncIterator[bytes]:
+        """Yield the first ``size`` bytes of the file, updating ``digest`` and ``stats["size"]``.
+
+        Only what the session accepted is read: a chunk being written by
+        another request or worker can already be past that on disk.
+        """
+        f = await asyncio.to_thread(open, self.path(session_id), "rb")
+        try:
+            remaining = size
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(READ_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                digest.update(chunk)
+                stats["size"] += len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    def sweep(self, max_age_seconds: float) -> int:
+        """Delete part files nobody has written to for ``max_age_seconds``."""
+        if not self.directory.is_dir():
+            return 0
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for path in self.directory.glob("*.part"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    async def sweep_forever(self, max_age_seconds: float, interval_seconds: float) -> None:
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.sweep, max_age_seconds)
+                if removed:
+                    logger.info("Removed %d abandoned upload files", removed)
+            except Exception:
+                logger.exception("Upload sweep failed")
+            await asyncio.sleep(interval_seconds)
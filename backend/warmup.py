@@ -0,0 +1,139 @@
+"""Startup warmup and readiness.
+
+Everything the first requests after a deploy would otherwise pay for is done
+up front: opening a minimum pool of MongoDB connections, loading the
+password hashing backend and exercising the validators and serializers of
+every route's models. ``/readyz`` stays 503 until the database answers and
+the other steps have run, so a load balancer only sends traffic to warm
+workers; ``/healthz`` only says the process is up.
+"""
+import asyncio
+import logging
+import time
+import typing
+from typing import Any, Dict, Optional, Set, Type
+
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+OK = "ok"
+SKIPPED = "skipped"
+
+
+def _models_in(annotation: Any, found: Set[Type[BaseModel]]) -> None:
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        found.add(annotation)
+    for arg in typing.get_args(annotation):
+        _models_in(arg, found)
+
+
+def route_models(app: FastAPI) -> Set[Type[BaseModel]]:
+    found: Set[Type[BaseModel]] = set()
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            for field in (route.response_field, route.body_field):
+                if field is not None:
+                    _models_in(field.type_, found)
+    return found
+
+
+def warm_models(app: FastAPI) -> int:
+    """Build and exercise the schema of every request and response model."""
+    models = route_models(app)
+    for model in models:
+        if not model.__pydantic_complete__:
+            model.model_rebuild()
+        try:
+            model.model_validate({})
+        except ValidationError:
+            pass
+        model.model_construct().model_dump(mode="json", warnings=False)
+    # The OpenAPI document is otherwise generated by the first /docs visitor
+    app.openapi()
+    return len(models)
+
+
+async def open_pool(client, size: int) -> None:
+    """Ping with ``size`` concurrent commands so as many connections get opened."""
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, size))))
+
+
+class Warmup:
+    def __init__(self, app: FastAPI, client=None, passwords=None, pool_size: int = 1, retry_seconds: float = 2.0):
+        self.app = app
+        self.client = client
+        self.passwords = passwords
+        self.pool_size = pool_size
+        self.retry_seconds = retry_seconds
+        self.checks: Dict[str, str] = {"models": PENDING, "passwords": PENDING}
+        if client is not None:
+            self.checks["database"] = PENDING
+        self.timings_ms: Dict[str, float] = {}
+        self.draining = False
+
+    @property
+    def ready(self) -> bool:
+        # Only the database is required; the other steps are best effort
+        return (
+            not self.draining
+            and PENDING not in self.checks.values()
+            and self.checks.get("database", OK) in (OK, SKIPPED)
+        )
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "checks": self.checks, "warmup_ms": self.timings_ms}
+
+    async def _step(self, name: str, action) -> None:
+        started = time.perf_counter()
+        try:
+            await action()
+        except Exception as exc:
+            self.checks[name] = f"failed: {exc.__class__.__name__}"
+            logger.exception("Warmup step %s failed", name)
+            return
+        self.timings_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+        self.checks[name] = OK
+
+    async def _database(self) -> None:
+        while True:
+            await self._step("database", lambda: open_pool(self.client, self.pool_size))
+            if self.checks["database"] == OK:
+                return
+            await asyncio.sleep(self.retry_seconds)
+
+    async def run(self) -> None:
+        async def models():
+            count = warm_models(self.app)
+            logger.info("Warmed %d models", count)
+
+        async def password_backend():
+            if self.passwords is not None:
+                await asyncio.to_thread(self.passwords.load_backend)
+
+        steps = [self._step("models", models), self._step("passwords", password_backend)]
+        if self.client is not None:
+            steps.append(self._database())
+        await asyncio.gather(*steps)
+        logger.info("Warmup finished", extra={"warmup_ms": self.timings_ms})
+
+    def skip(self) -> None:
+        for name in self.checks:
+            self.checks[name] = SKIPPED
+
+    async def start(self, timeout: float) -> Optional[asyncio.Task]:
+        """Run the warmup, waiting at most ``timeout`` seconds for it.
+
+        Returns the still running task if it did not finish in time; readiness
+        then flips once it does.
+        """
+        task = asyncio.create_task(self.run())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+            return None
+        except asyncio.TimeoutError:
+            logger.warning("Warmup still running after %.0fs; starting unready", timeout)
+            return task
@@ -0,0 +1,51 @@
+// Writes .br and .gz variants next to every compressible file of a build so
+// the backend can serve them without compressing on each request.
+//
+//   node scripts/precompress.js [build]
+const fs = require('fs');
+const path = require('path');
+const zlib = require('zlib');
+
+const COMPRESSIBLE = /\.(js|css|html|json|map|svg|txt|ico|webmanifest|xml)$/;
+const MIN_SIZE = 1024;
+
+const encoders = [
+  {
+    ext: '.br',
+    encode: (data) =>
+      zlib.brotliCompressSync(data, {
+        params: {
+          [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+          [zlib.constants.BROTLI_PARAM_SIZE_HINT]: data.length,
+        },
+      }),
+  },
+  { ext: '.gz', encode: (data) => zlib.gzipSync(data, { level: zlib.constants.Z_BEST_COMPRESSION }) },
+];
+
+function* walk(dir) {
+  for (const entry of fs.readdirSync(dir, { withFileTypes: true })) {
+    const full = path.join(dir, entry.name);
+    if (entry.isDirectory()) {
+      yield* walk(full);
+    } else {
+      yield full;
+    }
+  }
+}
+
+const root = path.resolve(process.argv[2] || 'build');
+let written = 0;
+for (const file of walk(root)) {
+  if (!COMPRESSIBLE.test(file)) continue;
+  const data = fs.readFileSync(file);
+  if (data.length < MIN_SIZE) continue;
+  for (const { ext, encode } of encoders) {
+    const compressed = encode(data);
+    // Not worth a variant if it barely shrinks
+    if (compressed.length >= data.length * 0.9) continue;
+    fs.writeFileSync(file + ext, compressed);
+    written += 1;
+  }
+}
+console.log(`precompress: wrote ${written} files in ${path.relative(process.cwd(), root) || '.'}`);
@@ -0,0 +1,65 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# server.py reads its configuration at import
+os.environ.setdefault("STORAGE_ENGINE", "memory")
+os.environ.setdefault("WARMUP", "0")
+os.environ.setdefault("ANALYTICS_FLUSH_SECONDS", "0")
+os.environ.setdefault("PROCESSING_WORKERS", "0")
+os.environ.setdefault("ADMIN_EMAILS", "admin@example.com")
+# One above bcrypt's minimum, so tests can store a weaker hash
+os.environ.setdefault("PASSWORD_BCRYPT_ROUNDS", "5")
+
+
+@pytest.fixture
+def motor_repositories(monkeypatch):
+    """Factory for Motor repositories on mongomock, by schema mode."""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import repositories
+
+    # mongomock has no GridFS
+    monkeypatch.setattr(repositories, "GridFSBlobStore", lambda db: repositories.MemoryBlobStore())
+
+    def create(schema_mode: str = "legacy"):
+        db = mongomock_motor.AsyncMongoMockClient()["test"]
+        return repositories.create_motor_repositories(db, schema_mode)
+
+    return create
+
+
+@pytest.fixture
+def client():
+    """The API on fresh in-memory repositories, with its lifespan running."""
+    from fastapi.testclient import TestClient
+
+    import server
+    from repositories import create_memory_repositories
+
+    server.app.state.repositories = create_memory_repositories(server.TTL_SECONDS)
+    # Rebuilt on the next request, so no middleware caches carry over between tests
+    server.app.middleware_stack = None
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def register(client):
+    """Register a user and return their auth headers."""
+
+    def create(email: str = "buyer@example.com", password: str = "secret-password"):
+        client.post("/api/register", json={"name": "Buyer", "email": email, "company": "Acme", "password": password})
+        token = client.post("/api/login", json={"email": email, "password": password}).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+
+    return create
+
+
+@pytest.fixture
+def admin(register):
+    """Auth headers of a user listed in ADMIN_EMAILS."""
+    return register("admin@example.com")
@@ -0,0 +1,117 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from archive import Archive, Archiver, retention_from_env
+from repositories import create_memory_repositories
+
+
+def contact(created_at):
+    return {"id": str(uuid.uuid4()), "name": "A", "email": "a@example.com", "created_at": created_at}
+
+
+def test_retention_is_opt_in(monkeypatch):
+    monkeypatch.delenv("CONTACT_RETENTION_DAYS", raising=False)
+    monkeypatch.delenv("QUOTE_RETENTION_DAYS", raising=False)
+    archiver = Archiver(create_memory_repositories(), Archive("unused"), retention_from_env())
+    assert not archiver.enabled
+
+
+def test_only_the_lease_holder_archives(tmp_path):
+    repos = create_memory_repositories()
+    archive = Archive(tmp_path)
+    old = datetime.utcnow() - timedelta(days=10)
+
+    async def run():
+        for _ in range(3):
+            await repos.contacts.insert(contact(old))
+        first = Archiver(repos, archive, {"contacts": 5})
+        second = Archiver(repos, archive, {"contacts": 5})
+        moved = await first.run_if_leader(60)
+        skipped = await second.run_if_leader(60)
+        await first.release()
+        await repos.contacts.insert(contact(old))
+        taken_over = await second.run_if_leader(60)
+        return moved, skipped, taken_over
+
+    moved, skipped, taken_over = asyncio.run(run())
+    assert moved == {"contacts": 3, "quotes": 0}
+    assert skipped is None
+    assert taken_over == {"contacts": 1, "quotes": 0}
+    # One segment per run, never shared
+    assert len(list((tmp_path / "contacts").glob("*.ndjson.gz"))) == 2
+    assert len(archive.read("contacts")) == 4
+
+
+def test_expired_lease_is_taken_over():
+    repos = create_memory_repositories()
+    now = datetime.utcnow()
+
+    async def run():
+        assert await repos.leases.acquire("archiver", "a", now, now + timedelta(seconds=10))
+        assert not await repos.leases.acquire("archiver", "b", now, now + timedelta(seconds=10))
+        later = now + timedelta(seconds=11)
+        return await repos.leases.acquire("archiver", "b", later, later + timedelta(seconds=10))
+
+    assert asyncio.run(run())
+
+
+def test_motor_lease(motor_repositories):
+    repos = motor_repositories()
+    now = datetime.utcnow()
+
+    async def run():
+        await repos.ensure_indexes()
+        results = [
+            await repos.leases.acquire("archiver", "a", now, now + timedelta(seconds=10)),
+            await repos.leases.acquire("archiver", "b", now, now + timedelta(seconds=10)),
+            await repos.leases.acquire("archiver", "a", now, now + timedelta(seconds=20)),
+        ]
+        await repos.leases.release("archiver", "a")
+        results.append(await repos.leases.acquire("archiver", "b", now, now + timedelta(seconds=10)))
+        return results
+
+    assert asyncio.run(run()) == [True, False, True, True]
+
+
+def test_read_is_ordered_and_stops_at_the_limit(tmp_path, monkeypatch):
+    archive = Archive(tmp_path)
+    start = datetime(2025, 1, 1, 12)
+    docs = [contact(start + timedelta(days=day, minutes=minute)) for day in range(3) for minute in (30, 0)]
+    archive.write("contacts", docs[:3], "run1")
+    archive.write("contacts", docs[3:], "run2")
+    archive.write("contacts", docs[:1], "run3")  # a duplicate left by a crash
+
+    opened = []
+    read_file = archive._read_file
+    monkeypatch.setattr(archive, "_read_file", lambda path: opened.append(path.name) or read_file(path))
+
+    result = archive.read("contacts", limit=2)
+    assert [d["created_at"] for d in result] == sorted(d["created_at"] for d in docs)[:2]
+    assert all(name.startswith("2025-01-01") for name in opened)
+    assert len(archive.read("contacts")) == len(docs)
+    assert archive.read("contacts", start=start + timedelta(days=1), end=start + timedelta(days=2)) == sorted(
+        docs[2:4], key=lambda d: d["created_at"]
+    )
+
+
+def test_status_check_ttl_is_opt_in():
+    import server
+
+    # Unset in the tests, so this is the default
+    assert server.TTL_SECONDS["status_checks"] == 0
+
+
+def test_turning_retention_off_drops_the_ttl_index(motor_repositories):
+    repos = motor_repositories()
+
+    async def indexes(ttl_days: int):
+        repos.ttl_seconds = {"status_checks": ttl_days * 86400}
+        await repos.ensure_indexes()
+        info = await repos.db.status_checks.index_information()
+        return {name: index.get("expireAfterSeconds") for name, index in info.items() if name != "_id_"}
+
+    async def run():
+        return await indexes(30), await indexes(0)
+
+    assert asyncio.run(run()) == ({"id_1": None, "timestamp_1": 30 * 86400}, {"id_1": None, "timestamp_1": None})
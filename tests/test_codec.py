@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from bson.binary import Binary
+
+from codec import DocumentCodec, binary_to_uuid, codec_for, uuid_to_binary
+from repositories import MotorOrderRepository, MotorUserRepository
+
+ORDER_ID = str(uuid.uuid4())
+USER_ID = str(uuid.uuid4())
+
+
+def test_legacy_keeps_string_ids():
+    codec = codec_for("orders")
+    stored = codec.encode({"id": ORDER_ID, "user_id": USER_ID, "order_number": ORDER_ID})
+
+    assert stored["id"] == ORDER_ID
+    assert codec.query({"user_id": USER_ID}) == {"user_id": USER_ID}
+
+
+@pytest.mark.parametrize("schema_mode", ["dual", "compact"])
+def test_binary_ids_round_trip(schema_mode):
+    codec = codec_for("orders", schema_mode)
+    created_at = datetime(2025, 1, 15, 9, 30)
+    order = {"id": ORDER_ID, "user_id": USER_ID, "order_number": ORDER_ID, "created_at": created_at}
+    stored = codec.encode(order)
+
+    assert isinstance(stored["id"], Binary) and isinstance(stored["user_id"], Binary)
+    # Only id fields are converted
+    assert stored["order_number"] == ORDER_ID
+    assert stored["created_at"] == created_at.replace(tzinfo=timezone.utc)
+    assert codec.decode(stored) == order
+
+
+def test_nested_datetimes_are_normalized():
+    codec = codec_for("documents", "compact")
+    processed_at = datetime(2025, 1, 15, 9, 30)
+    document = {
+        "id": ORDER_ID,
+        "processing": {"processed_at": processed_at, "page_count": 2},
+        "history": [{"at": processed_at}, processed_at, "pending"],
+    }
+    stored = codec.encode(document)
+    utc = processed_at.replace(tzinfo=timezone.utc)
+
+    assert stored["processing"] == {"processed_at": utc, "page_count": 2}
+    assert stored["history"] == [{"at": utc}, utc, "pending"]
+    assert codec.decode(stored) == document
+    # The model's dict is left as it was
+    assert document["processing"]["processed_at"].tzinfo is None
+
+
+def test_queries_match_both_representations_in_dual_mode():
+    binary = uuid_to_binary(USER_ID)
+
+    assert codec_for("orders", "dual").query({"user_id": USER_ID}) == {"user_id": {"$in": [binary, USER_ID]}}
+    assert codec_for("orders", "compact").query({"user_id": USER_ID}) == {"user_id": binary}
+    assert codec_for("orders", "compact").query({"id": {"$in": [ORDER_ID]}}) == {"id": {"$in": [uuid_to_binary(ORDER_ID)]}}
+    # Values that aren't UUIDs are left as they are
+    assert codec_for("orders", "dual").query({"id": "not-a-uuid", "status": "pending"}) == {
+        "id": "not-a-uuid", "status": "pending",
+    }
+
+
+def test_conversions():
+    assert binary_to_uuid(uuid_to_binary(ORDER_ID)) == ORDER_ID
+    assert binary_to_uuid(uuid.UUID(ORDER_ID)) == ORDER_ID
+    assert uuid_to_binary(42) == 42
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        DocumentCodec(("id",), "binary")
+
+
+def test_repositories_read_legacy_documents_in_dual_mode(motor_repositories):
+    legacy = motor_repositories("legacy")
+    dual_users = MotorUserRepository(legacy.db.users, codec_for("users", "dual"))
+
+    async def run():
+        await legacy.users.insert({"id": USER_ID, "email": "buyer@example.com"})
+        await dual_users.insert({"id": str(uuid.uuid4()), "email": "other@example.com"})
+        return await dual_users.get_by_id(USER_ID), await legacy.db.users.count_documents({"id": {"$type": "binData"}})
+
+    found, binary_ids = asyncio.run(run())
+    assert found["email"] == "buyer@example.com"
+    assert binary_ids == 1
+
+
+def test_migration_converts_ids_and_resumes(motor_repositories):
+    migrate_compact = pytest.importorskip("migrate_compact")
+    repos = motor_repositories("legacy")
+    db = repos.db
+
+    async def run():
+        for n in range(5):
+            await repos.orders.insert({
+                "id": str(uuid.uuid4()), "user_id": USER_ID, "order_number": f"ORD-{n}", "created_at": datetime.utcnow(),
+            })
+        # An id that isn't a UUID stays a string; its user_id is still converted
+        await db.orders.insert_one({"id": "imported-1", "user_id": USER_ID})
+
+        first = await migrate_compact.migrate_collection(db, "orders", batch_size=2, reset=False)
+        again = await migrate_compact.migrate_collection(db, "orders", batch_size=2, reset=False)
+        stored = await db.orders.find({}, {"_id": 0, "id": 1, "user_id": 1}).to_list(None)
+        compact = MotorOrderRepository(db.orders, codec_for("orders", "compact"), codec_for("order_events", "compact"))
+        return first, again, stored, await compact.count_for_user(USER_ID)
+
+    first, again, stored, count = asyncio.run(run())
+    assert first == {"converted": 6, "skipped": 0, "resumed": False}
+    assert again == {"converted": 6, "skipped": 0, "resumed": True}
+    assert all(isinstance(doc["user_id"], Binary) for doc in stored)
+    assert sum(isinstance(doc["id"], Binary) for doc in stored) == 5
+    assert count == 6
@@ -0,0 +1,142 @@
+import asyncio
+import base64
+import gzip
+
+import pytest
+import zstandard
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import compression
+from compression import (
+    GZIP,
+    ZSTD,
+    CompressionMiddleware,
+    choose_codec,
+    compress_stream,
+    decompress_bytes,
+    decompress_stream,
+    pack_base64,
+    unpack_base64,
+)
+
+TEXT = b"order,product,quantity\n" + b"1234,Turmeric powder,10\n" * 400
+PAYLOAD = b'{"orders": [' + b'{"product": "Turmeric", "quantity": 10},' * 100 + b"{}]}"
+
+
+@pytest.fixture(params=[ZSTD, GZIP])
+def codec(request, monkeypatch):
+    if request.param == GZIP:
+        # Without zstandard installed gzip is the default
+        monkeypatch.setattr(compression, "zstandard", None)
+    return request.param
+
+
+def test_pack_and_unpack_round_trip(codec):
+    file_data = base64.b64encode(TEXT).decode()
+    stored, used, size = pack_base64(file_data, "text/csv")
+
+    assert used == codec
+    assert size == len(base64.b64decode(stored)) < len(TEXT)
+    assert unpack_base64(stored, used) == file_data
+
+
+def test_stream_round_trip(codec):
+    async def chunks(data, size=1000):
+        for start in range(0, len(data), size):
+            yield data[start:start + size]
+
+    async def collect(stream):
+        return b"".join([chunk async for chunk in stream])
+
+    async def run():
+        compressed = await collect(compress_stream(chunks(TEXT), codec))
+        restored = await collect(decompress_stream(chunks(compressed, 64), codec))
+        return compressed, restored
+
+    compressed, restored = asyncio.run(run())
+    assert restored == TEXT
+    assert decompress_bytes(compressed, codec) == TEXT
+
+
+def test_compressed_types_are_stored_raw():
+    assert choose_codec("text/csv", TEXT) is not None
+    assert choose_codec("image/png", TEXT) is None
+    assert choose_codec("application/vnd.openxmlformats-officedocument.wordprocessingml.document", TEXT) is None
+    # Already dense: compressing would not pay off
+    assert choose_codec("application/octet-stream", gzip.compress(TEXT)) is None
+
+    file_data = base64.b64encode(TEXT).decode()
+    assert pack_base64(file_data, "image/jpeg") == (file_data, None, len(TEXT))
+
+
+@pytest.fixture
+def responses():
+    async def orders(request):
+        return Response(PAYLOAD, media_type="application/json", headers={"ETag": '"v1"'})
+
+    async def small(request):
+        return Response(b'{"ok": true}', media_type="application/json")
+
+    async def photo(request):
+        return Response(TEXT, media_type="image/png")
+
+    app = Starlette(routes=[Route("/orders", orders), Route("/small", small), Route("/photo", photo)])
+    middleware = CompressionMiddleware(app, minimum_size=1024)
+    return TestClient(middleware), middleware
+
+
+def raw_get(client, path, accept):
+    """GET ``path`` without letting the client decode the body."""
+    with client.stream("GET", path, headers={"Accept-Encoding": accept}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+@pytest.mark.parametrize("accept, encoding", [
+    ("zstd, gzip", ZSTD),
+    ("gzip", GZIP),
+    ("zstd;q=0, gzip", GZIP),
+    ("identity", None),
+    ("br", None),
+])
+def test_encoding_is_negotiated(responses, accept, encoding):
+    client, _ = responses
+    response, raw = raw_get(client, "/orders", accept)
+
+    assert response.headers.get("content-encoding") == encoding
+    assert int(response.headers["content-length"]) == len(raw)
+    assert decompress_bytes(raw, encoding) == PAYLOAD
+    if encoding:
+        assert response.headers["vary"] == "Accept-Encoding"
+
+
+def test_small_and_compressed_responses_pass_through(responses):
+    client, _ = responses
+    for path, body in [("/small", b'{"ok": true}'), ("/photo", TEXT)]:
+        response, raw = raw_get(client, path, "gzip")
+        assert "content-encoding" not in response.headers
+        assert raw == body
+
+
+def test_tagged_responses_are_compressed_once(responses, monkeypatch):
+    client, middleware = responses
+    compressed = []
+    compress_bytes = compression.compress_bytes
+
+    def counting(data, codec):
+        compressed.append(codec)
+        return compress_bytes(data, codec)
+
+    monkeypatch.setattr(compression, "compress_bytes", counting)
+    _, first = raw_get(client, "/orders", "zstd")
+    _, second = raw_get(client, "/orders", "zstd")
+
+    assert first == second
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(first) == PAYLOAD
+    assert compressed == [ZSTD]
+    assert middleware.cache.get(("/orders", b"", b'"v1"', ZSTD)) == first
+    # Each encoding is its own entry
+    raw_get(client, "/orders", "gzip")
+    assert compressed == [ZSTD, GZIP]
@@ -0,0 +1,45 @@
+ORDER = {"product_category": "Spices", "product_description": "Turmeric", "quantity": "10", "destination_country": "India"}
+
+
+def test_unchanged_order_is_not_modified(client, register):
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    etag = client.get(f"/api/orders/{order_id}", headers=headers).headers["etag"]
+
+    assert client.get(f"/api/orders/{order_id}", headers={**headers, "If-None-Match": etag}).status_code == 304
+    # Any order write changes the version
+    client.post("/api/orders", json=ORDER, headers=headers)
+    assert client.get(f"/api/orders/{order_id}", headers={**headers, "If-None-Match": etag}).status_code == 200
+
+
+def test_order_tag_does_not_cover_other_ids(client, register):
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    etag = client.get(f"/api/orders/{order_id}", headers=headers).headers["etag"]
+    timeline_etag = client.get(f"/api/orders/{order_id}/timeline", headers=headers).headers["etag"]
+
+    assert client.get("/api/orders/missing", headers={**headers, "If-None-Match": etag}).status_code == 404
+    assert client.get(
+        "/api/orders/missing/timeline", headers={**headers, "If-None-Match": timeline_etag}
+    ).status_code == 404
+
+
+def test_embedded_events_have_their_own_tag(client, register):
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    plain = client.get(f"/api/orders/{order_id}", headers=headers)
+    with_events = client.get(f"/api/orders/{order_id}?events=5", headers=headers)
+
+    assert plain.headers["etag"] != with_events.headers["etag"]
+    assert "events" not in plain.json()
+    assert [event["type"] for event in with_events.json()["events"]] == ["created"]
+
+
+def test_list_and_profile_tags(client, register):
+    headers = register()
+    for path in ("/api/orders", "/api/profile", "/api/messages"):
+        etag = client.get(path, headers=headers).headers["etag"]
+        assert client.get(path, headers={**headers, "If-None-Match": etag}).status_code == 304
+    etag = client.get("/api/profile", headers=headers).headers["etag"]
+    client.put("/api/profile", json={"phone": "+91 22 5555 0100"}, headers=headers)
+    assert client.get("/api/profile", headers={**headers, "If-None-Match": etag}).status_code == 200
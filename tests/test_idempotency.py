@@ -0,0 +1,56 @@
+from idempotency import IdempotencyMiddleware
+
+ORDER = {"product_category": "Spices", "product_description": "Turmeric", "quantity": "10", "destination_country": "India"}
+
+
+def idempotency_middleware(app) -> IdempotencyMiddleware:
+    layer = app.middleware_stack
+    while not isinstance(layer, IdempotencyMiddleware):
+        layer = layer.app
+    return layer
+
+
+def test_retry_replays_the_first_response(client, register):
+    headers = {**register(), "Idempotency-Key": "order-1"}
+    first = client.post("/api/orders", json=ORDER, headers=headers)
+    retry = client.post("/api/orders", json=ORDER, headers=headers)
+
+    assert retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json()["id"] == first.json()["id"]
+    assert len(client.get("/api/orders", headers=headers).json()) == 1
+
+
+def test_key_reused_with_another_body_is_refused(client, register):
+    headers = {**register(), "Idempotency-Key": "order-1"}
+    client.post("/api/orders", json=ORDER, headers=headers)
+    response = client.post("/api/orders", json={**ORDER, "quantity": "20"}, headers=headers)
+
+    assert response.status_code == 422
+    assert len(client.get("/api/orders", headers=headers).json()) == 1
+
+
+def test_stored_key_is_checked_without_the_cache(client, register):
+    headers = {**register(), "Idempotency-Key": "order-1"}
+    client.post("/api/orders", json=ORDER, headers=headers)
+    # As another worker sees it: only the stored record
+    idempotency_middleware(client.app).cache._items.clear()
+
+    assert client.post("/api/orders", json={**ORDER, "quantity": "20"}, headers=headers).status_code == 422
+    assert client.post("/api/orders", json=ORDER, headers=headers).headers["idempotent-replayed"] == "true"
+
+
+def test_keys_are_scoped_to_the_user(client, register):
+    first = {**register("first@example.com"), "Idempotency-Key": "order-1"}
+    second = {**register("second@example.com"), "Idempotency-Key": "order-1"}
+    client.post("/api/orders", json=ORDER, headers=first)
+    response = client.post("/api/orders", json={**ORDER, "quantity": "20"}, headers=second)
+
+    assert response.status_code == 200
+    assert "idempotent-replayed" not in response.headers
+
+
+def test_failed_requests_are_not_stored(client, register):
+    headers = {**register(), "Idempotency-Key": "order-1"}
+    assert client.post("/api/orders", json={"quantity": "1"}, headers=headers).status_code == 422
+    assert client.post("/api/orders", json=ORDER, headers=headers).status_code == 200
@@ -0,0 +1,138 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.testclient import TestClient
+
+from logs import (
+    AccessLogMiddleware,
+    ContextQueueHandler,
+    JsonFormatter,
+    RequestContext,
+    RestartableQueueListener,
+    _context,
+    access_logger,
+    parse_sample_rates,
+)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_json_formatter():
+    record = logging.LogRecord("orders", logging.WARNING, __file__, 1, "order %s late", ("o-1",), None)
+    record.request_id = "req-1"
+    record.db_ms = None
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record.exc_info = sys.exc_info()
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["level"] == "WARNING"
+    assert entry["logger"] == "orders"
+    assert entry["message"] == "order o-1 late"
+    assert entry["request_id"] == "req-1"
+    # Unset extras are left out
+    assert "db_ms" not in entry
+    assert "ValueError: boom" in entry["exc_info"]
+    assert entry["ts"].endswith("+00:00")
+
+
+def test_queue_handler_attaches_the_request_and_drops_when_full():
+    handler = ContextQueueHandler(queue.Queue(1))
+    context = RequestContext("req-1")
+    context.user_id = "u-1"
+    token = _context.set(context)
+    try:
+        handler.handle(logging.LogRecord("orders", logging.INFO, __file__, 1, "%d orders", (3,), None))
+    finally:
+        _context.reset(token)
+    handler.handle(logging.LogRecord("orders", logging.INFO, __file__, 1, "dropped", (), None))
+
+    record = handler.queue.get_nowait()
+    assert (record.request_id, record.user_id, record.msg, record.args) == ("req-1", "u-1", "3 orders", None)
+    assert handler.dropped == 1
+
+
+@pytest.fixture
+def access_log():
+    # Routes are sampled by name, which only FastAPI's routes put in the scope
+    app = FastAPI()
+
+    @app.get("/noisy")
+    async def noisy():
+        return PlainTextResponse("ok")
+
+    @app.get("/broken")
+    async def broken():
+        return PlainTextResponse("no", status_code=503)
+
+    @app.get("/orders")
+    async def orders():
+        return PlainTextResponse("orders")
+
+    rates = parse_sample_rates("noisy=0,broken=0, orders=")
+    handler = ListHandler()
+    level = access_logger.level
+    access_logger.addHandler(handler)
+    access_logger.setLevel(logging.INFO)
+    try:
+        yield TestClient(AccessLogMiddleware(app, sample_rates=rates)), handler.records
+    finally:
+        access_logger.removeHandler(handler)
+        access_logger.setLevel(level)
+
+
+def test_sampled_routes_are_skipped_unless_they_fail(access_log):
+    client, records = access_log
+    assert client.get("/noisy").status_code == 200
+    assert records == []
+
+    client.get("/broken")
+    client.get("/orders", headers={"X-Request-ID": "req-1"})
+    assert [(r.path, r.status, r.sample_rate) for r in records] == [("/broken", 503, 0.0), ("/orders", 200, None)]
+    assert records[0].db_ms is None
+
+
+def test_request_id_is_echoed(access_log):
+    client, _ = access_log
+    assert client.get("/orders", headers={"X-Request-ID": "req-1"}).headers["x-request-id"] == "req-1"
+    assert len(client.get("/orders").headers["x-request-id"]) == 32
+
+
+def test_listener_start_and_stop_are_idempotent():
+    log_queue = queue.Queue()
+    sink = ListHandler()
+    listener = RestartableQueueListener(log_queue, sink)
+    listener.start()
+    listener.start()
+    listener.stop()
+    listener.stop()
+
+    listener.start()
+    log_queue.put(logging.LogRecord("orders", logging.INFO, __file__, 1, "after restart", (), None))
+    listener.stop()
+    assert [record.msg for record in sink.records] == ["after restart"]
+
+
+def test_listener_runs_in_every_lifespan():
+    import server
+    from repositories import create_memory_repositories
+
+    for _ in range(2):
+        server.app.state.repositories = create_memory_repositories(server.TTL_SECONDS)
+        with TestClient(server.app) as client:
+            assert server.log_listener._thread is not None
+            assert client.get("/healthz").status_code == 200
+        assert server.log_listener._thread is None
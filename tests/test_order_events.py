@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime, timedelta
+
+ORDER = {"product_category": "Spices", "product_description": "Turmeric", "quantity": "10", "destination_country": "India"}
+
+
+def test_timeline_records_every_change(client, register, admin):
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    client.put(f"/api/admin/orders/{order_id}", json={"tracking_number": "TRK-1"}, headers=admin)
+    client.put(f"/api/admin/orders/{order_id}", json={"status": "shipped"}, headers=admin)
+    # Nothing changed, so no event
+    client.put(f"/api/admin/orders/{order_id}", json={"status": "shipped"}, headers=admin)
+
+    timeline = client.get(f"/api/orders/{order_id}/timeline", headers=headers).json()
+    assert [(entry["type"], entry["status"]) for entry in timeline] == [
+        ("created", "pending"), ("updated", "pending"), ("status_changed", "shipped"),
+    ]
+
+
+def test_order_embeds_its_latest_events(client, register, admin):
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    for status in ("processing", "shipped", "delivered"):
+        client.put(f"/api/admin/orders/{order_id}", json={"status": status}, headers=admin)
+
+    order = client.get(f"/api/orders/{order_id}", params={"events": 2}, headers=headers).json()
+    assert order["status"] == "delivered"
+    assert [(e["from_status"], e["status"]) for e in order["events"]] == [
+        ("processing", "shipped"), ("shipped", "delivered"),
+    ]
+    assert order["events"][-1]["changes"] == {"status": "delivered"}
+    assert "events" not in client.get(f"/api/orders/{order_id}", headers=headers).json()
+
+
+def test_events_are_private_to_the_order_owner(client, register, admin):
+    order_id = client.post("/api/orders", json=ORDER, headers=register()).json()["id"]
+    other = register("other@example.com")
+
+    assert client.get(f"/api/orders/{order_id}/timeline", headers=other).status_code == 404
+    assert client.get(f"/api/orders/{order_id}", params={"events": 5}, headers=other).status_code == 404
+    assert client.put(f"/api/admin/orders/{order_id}", json={"status": "shipped"}, headers=other).status_code == 403
+    assert client.put("/api/admin/orders/missing", json={"status": "shipped"}, headers=admin).status_code == 404
+    assert client.put(f"/api/admin/orders/{order_id}", json={"status": None}, headers=admin).status_code == 400
+
+
+def test_long_timeline_keeps_the_latest_events(client, register, admin, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "ORDER_TIMELINE_LIMIT", 3)
+    headers = register()
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    for status in ("processing", "shipped", "delivered"):
+        client.put(f"/api/admin/orders/{order_id}", json={"status": status}, headers=admin)
+
+    timeline = client.get(f"/api/orders/{order_id}/timeline", headers=headers).json()
+    assert [entry["status"] for entry in timeline] == ["processing", "shipped", "delivered"]
+
+
+def test_motor_timeline_keeps_the_latest_events(motor_repositories):
+    repos = motor_repositories()
+    start = datetime(2025, 1, 15)
+
+    async def run():
+        for n, status in enumerate(["pending", "processing", "shipped", "delivered"]):
+            await repos.order_events.insert({
+                "id": str(n), "order_id": "o", "user_id": "u", "type": "status_changed",
+                "status": status, "ts": start + timedelta(hours=n),
+            })
+        return await repos.order_events.timeline("o", limit=2)
+
+    assert [entry["status"] for entry in asyncio.run(run())] == ["shipped", "delivered"]
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from passlib.context import CryptContext
+
+from passwords import BCRYPT, PasswordHasher
+
+
+def bcrypt_hash(rounds: int, password: str = "secret") -> str:
+    return CryptContext(schemes=[BCRYPT], bcrypt__rounds=rounds).hash(password)
+
+
+def test_hash_and_verify():
+    hasher = PasswordHasher(bcrypt_rounds=4)
+
+    async def run():
+        hashed = await hasher.hash("secret")
+        return hashed, await hasher.verify("secret", hashed), await hasher.verify("wrong", hashed)
+
+    hashed, valid, invalid = asyncio.run(run())
+    assert hashed.startswith("$2b$04$")
+    assert valid and not invalid
+    assert not hasher.needs_rehash(hashed)
+
+
+def test_only_weaker_hashes_need_rehash():
+    hasher = PasswordHasher(bcrypt_rounds=5)
+    assert hasher.needs_rehash(bcrypt_hash(4))
+    assert not hasher.needs_rehash(bcrypt_hash(5))
+    # Lowering the cost must not downgrade existing hashes
+    assert not hasher.needs_rehash(bcrypt_hash(6))
+
+
+def test_unknown_scheme_is_rejected():
+    with pytest.raises(ValueError):
+        PasswordHasher("md5")
+
+
+def test_login_rehashes_weaker_hashes(client, register):
+    register()
+    users = client.app.state.repositories.users
+    user_id = asyncio.run(users.get_by_email("buyer@example.com"))["id"]
+    credentials = {"email": "buyer@example.com", "password": "secret-password"}
+
+    # PASSWORD_BCRYPT_ROUNDS is 5 in the tests
+    for rounds, expected in ((4, "$2b$05$"), (6, "$2b$06$")):
+        asyncio.run(users.update(user_id, {"hashed_password": bcrypt_hash(rounds, "secret-password")}))
+        assert client.post("/api/login", json=credentials).status_code == 200
+        assert asyncio.run(users.get_by_id(user_id))["hashed_password"].startswith(expected)
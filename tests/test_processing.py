@@ -0,0 +1,201 @@
+import asyncio
+import base64
+import hashlib
+import io
+import zipfile
+from datetime import datetime, timedelta
+
+import pytest
+
+from processing import (
+    COMPLETED,
+    DONE,
+    FAILED,
+    PDF,
+    DocumentProcessor,
+    detect_mime_type,
+    inspect_base64,
+    mime_type_matches,
+    pdf_page_count,
+)
+from repositories import create_memory_repositories
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+PDF_BODY = (
+    b"%PDF-1.7\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n"
+    b"2 0 obj << /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 >> endobj\n"
+    b"3 0 obj << /Type /Page /Parent 2 0 R >> endobj\n"
+    b"4 0 obj << /Type /Page /Parent 2 0 R >> endobj\n%%EOF\n"
+)
+
+
+def docx() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+        archive.writestr("word/document.xml", "<document/>")
+    return buffer.getvalue()
+
+
+def test_detect_mime_type():
+    assert detect_mime_type(PNG) == "image/png"
+    assert detect_mime_type(PDF_BODY) == PDF
+    assert detect_mime_type("Packing list, 25kg bags\n".encode()) == "text/plain"
+    assert detect_mime_type(b'<?xml version="1.0"?><invoice/>') == "application/xml"
+    assert detect_mime_type(b"\x01\x02\x00\x03") == "application/octet-stream"
+    data = docx()
+    assert detect_mime_type(data) == "application/zip"
+    assert detect_mime_type(data, io.BytesIO(data)).endswith("wordprocessingml.document")
+
+
+def test_pdf_page_count():
+    assert pdf_page_count(PDF_BODY) == 2
+    # No page tree node: count the leaves
+    assert pdf_page_count(b"%PDF-1.4\n<< /Type /Page >>\n<< /Type /Page >>\n<< /Type /Page >>") == 3
+    assert pdf_page_count(b"%PDF-1.4\n<< /Type /Catalog >>") is None
+
+
+def test_mime_type_matches():
+    assert mime_type_matches("image/png", "image/png")
+    assert mime_type_matches("image/jpg", "image/jpeg")
+    assert mime_type_matches("text/csv; charset=utf-8", "text/plain")
+    assert not mime_type_matches("application/pdf", "image/png")
+
+
+def test_inspect_inline_document():
+    result = inspect_base64(base64.b64encode(PDF_BODY).decode(), None)
+    assert result == {
+        "verified_size": len(PDF_BODY),
+        "sha256": hashlib.sha256(PDF_BODY).hexdigest(),
+        "detected_mime_type": PDF,
+        "page_count": 2,
+    }
+
+
+def process(repos, processor, document_id: str, now: datetime):
+    """Queue, claim and run one job the way the worker loop does."""
+
+    async def run():
+        await repos.document_jobs.enqueue(document_id, now)
+        job = await repos.document_jobs.claim(now, now + timedelta(seconds=processor.lock_seconds))
+        await processor._run(repos, job)
+        return await repos.documents.get_by_id(document_id), job_status(repos, document_id)
+
+    return asyncio.run(run())
+
+
+def job_status(repos, job_id: str):
+    return repos.document_jobs._c.find_one({"id": job_id})
+
+
+def inline_document(data: bytes, **values):
+    return {
+        "id": values.pop("id", "doc-1"), "file_data": base64.b64encode(data).decode(), "file_size": len(data),
+        "mime_type": "application/pdf", "checksum": None, "compression": None, **values,
+    }
+
+
+@pytest.fixture
+def processor(tmp_path):
+    # No pool: _run falls back to the default thread pool
+    return DocumentProcessor(max_attempts=2, retry_seconds=10, lock_seconds=60, tmp_dir=tmp_path)
+
+
+def test_size_and_checksum_are_recorded(processor):
+    repos = create_memory_repositories()
+    asyncio.run(repos.documents.insert(inline_document(PDF_BODY, file_size=1)))
+
+    document, job = process(repos, processor, "doc-1", datetime.utcnow())
+    assert document["processing_status"] == COMPLETED
+    assert document["processing"]["size_matches"] is False
+    assert document["processing"]["mime_type_matches"] is True
+    assert document["processing"]["page_count"] == 2
+    assert document["checksum"] == hashlib.sha256(PDF_BODY).hexdigest()
+    assert job["status"] == DONE
+
+
+def test_checksum_mismatch_fails_the_document(processor):
+    repos = create_memory_repositories()
+
+    async def store():
+        async def chunks():
+            yield PNG
+
+        await repos.blobs.put("blob-1", chunks(), "scan.png", {})
+        await repos.documents.insert({
+            "id": "doc-1", "blob_id": "blob-1", "file_size": len(PNG), "mime_type": "image/png",
+            "checksum": hashlib.sha256(b"what was uploaded").hexdigest(), "compression": None,
+        })
+
+    asyncio.run(store())
+    document, job = process(repos, processor, "doc-1", datetime.utcnow())
+    assert document["processing_status"] == FAILED
+    assert "checksum" in document["processing"]["error"]
+    assert job["status"] == FAILED
+
+
+def test_expired_lock_is_claimed_again(processor):
+    repos = create_memory_repositories()
+    now = datetime.utcnow()
+
+    async def run():
+        await repos.document_jobs.enqueue("doc-1", now)
+        first = await repos.document_jobs.claim(now, now + timedelta(seconds=60))
+        # Its worker died; nobody may take it until the lock runs out
+        locked = await repos.document_jobs.claim(now + timedelta(seconds=30), now + timedelta(seconds=90))
+        second = await repos.document_jobs.claim(now + timedelta(seconds=61), now + timedelta(seconds=121))
+        return first, locked, second
+
+    first, locked, second = asyncio.run(run())
+    assert first["attempts"] == 1
+    assert locked is None
+    assert second["id"] == "doc-1" and second["attempts"] == 2
+
+
+def test_failures_are_retried_then_fail(processor, monkeypatch):
+    repos = create_memory_repositories()
+    asyncio.run(repos.documents.insert(inline_document(PDF_BODY)))
+
+    async def broken(repositories, job, document):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(processor, "_inspect", broken)
+    now = datetime.utcnow()
+    document, job = process(repos, processor, "doc-1", now)
+    assert job["status"] == "queued"
+    assert job["run_after"] >= now + timedelta(seconds=processor.retry_seconds)
+    assert "processing_status" not in document
+
+    async def retry():
+        later = job["run_after"]
+        claimed = await repos.document_jobs.claim(later, later + timedelta(seconds=60))
+        await processor._run(repos, claimed)
+        return await repos.documents.get_by_id("doc-1"), job_status(repos, "doc-1")
+
+    document, job = asyncio.run(retry())
+    assert job["status"] == FAILED
+    assert document["processing_status"] == FAILED
+    assert document["processing"] == {"error": "OSError: disk full", "attempts": 2, "processed_at": job["finished_at"]}
+
+
+def test_worker_runs_jobs_on_the_pool(tmp_path):
+    repos = create_memory_repositories()
+    processor = DocumentProcessor(workers=1, concurrency=1, poll_seconds=0.05, tmp_dir=tmp_path)
+
+    async def run():
+        await repos.documents.insert(inline_document(PDF_BODY))
+        worker = asyncio.create_task(processor.run_forever(repos))
+        await processor.enqueue(repos.document_jobs, "doc-1")
+        try:
+            for _ in range(600):
+                document = await repos.documents.get_by_id("doc-1")
+                if document.get("processing_status"):
+                    return document
+                await asyncio.sleep(0.05)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+    document = asyncio.run(run())
+    assert document["processing_status"] == COMPLETED
+    assert document["processing"]["verified_size"] == len(PDF_BODY)
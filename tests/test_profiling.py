@@ -0,0 +1,90 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+import pytest
+from fastapi import APIRouter, FastAPI
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+
+from profiling import (
+    _NO_PHASE,
+    ProfiledRoute,
+    ProfileWriter,
+    ProfilingMiddleware,
+    _InstrumentedRepository,
+    instrument_repositories,
+    phase,
+)
+from repositories import create_memory_repositories
+
+
+def test_disabled_by_default():
+    import server
+
+    assert not server.PROFILING_ENABLED and not server.LOG_DB_TIMING
+    assert ProfilingMiddleware not in [middleware.cls for middleware in server.app.user_middleware]
+    assert all(type(route) is APIRoute for route in server.api_router.routes)
+    assert not isinstance(server.app.state.repositories.orders, _InstrumentedRepository)
+    assert phase("db") is _NO_PHASE
+
+
+def test_instrumenting_wraps_each_repository_once():
+    repos = create_memory_repositories()
+    orders = repos.orders
+    instrument_repositories(repos)
+    instrument_repositories(repos)
+
+    assert isinstance(repos.orders, _InstrumentedRepository)
+    assert repos.orders._target is orders
+    assert asyncio.run(repos.orders.list_for_user("u")) == []
+
+
+@pytest.fixture
+def profiled(tmp_path):
+    def create(**options):
+        repos = instrument_repositories(create_memory_repositories())
+        router = APIRouter(route_class=ProfiledRoute)
+
+        @router.get("/orders")
+        async def orders():
+            with phase("hashing"):
+                time.sleep(0.005)
+            return {"orders": await repos.orders.list_for_user("u")}
+
+        app = FastAPI()
+        app.include_router(router)
+        middleware = ProfilingMiddleware(app, ProfileWriter(tmp_path, 1024 * 1024), interval=0.001, **options)
+        return TestClient(middleware)
+
+    return create
+
+
+def test_debug_token_writes_a_profile(profiled, tmp_path):
+    client = profiled(debug_token="let-me-in")
+    assert client.get("/orders").status_code == 200
+    assert client.get("/orders", headers={"X-Debug-Profile": "wrong"}).status_code == 200
+    assert list(tmp_path.iterdir()) == []
+
+    response = client.get("/orders", headers={"X-Debug-Profile": "let-me-in"})
+    name = response.headers["x-profile-id"]
+    summary = json.loads((tmp_path / f"{name}.json").read_text())
+    assert summary["path"] == "/orders" and summary["status"] == 200
+    assert {"db", "hashing", "models", "serialization", "other"} <= set(summary["phases_ms"])
+    assert summary["phases_ms"]["hashing"] >= 5
+    assert summary["samples"] > 0
+    assert "orders (test_profiling.py" in (tmp_path / f"{name}.folded").read_text()
+
+
+def test_sampled_requests_are_profiled(profiled, tmp_path):
+    client = profiled(sample_rate=1.0)
+    client.get("/orders")
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == [".folded", ".json"]
+
+
+def test_old_profiles_are_rotated_out(tmp_path):
+    writer = ProfileWriter(tmp_path, max_bytes=1)
+    writer.write(writer.name_for("GET", "/api/orders"), Counter(), {"total_ms": 1})
+    assert list(tmp_path.iterdir()) == []
+    assert writer.name_for("GET", "/").endswith("-GET-root")
@@ -0,0 +1,122 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from repositories import (
+    INDEXES,
+    MemoryCollection,
+    create_memory_repositories,
+    escape_key,
+    unescape_key,
+)
+
+
+def user(email: str = "buyer@example.com", **values):
+    return {"id": str(uuid.uuid4()), "email": email, "hashed_password": "hash", **values}
+
+
+def test_unique_indexes_are_enforced():
+    users = MemoryCollection("users", INDEXES["users"])
+    users.insert_one(user())
+    with pytest.raises(DuplicateKeyError):
+        users.insert_one(user())
+
+    other = user("other@example.com")
+    users.insert_one(other)
+    with pytest.raises(DuplicateKeyError):
+        users.update_one({"id": other["id"]}, {"email": "buyer@example.com"})
+    # The failed update left the document and its index entries alone
+    assert users.find_one({"email": "other@example.com"})["id"] == other["id"]
+
+
+def test_query_operators():
+    orders = MemoryCollection("orders", INDEXES["orders"])
+    now = datetime(2025, 1, 15)
+    for day, status in enumerate(["pending", "shipped", "delivered"]):
+        orders.insert_one({"id": str(day), "user_id": "u", "status": status, "created_at": now + timedelta(days=day)})
+
+    assert orders.count_documents({"user_id": "u", "status": {"$in": ["pending", "shipped"]}}) == 2
+    assert [o["id"] for o in orders.find({"created_at": {"$lt": now + timedelta(days=1)}})] == ["0"]
+    assert orders.count_documents({"created_at": {"$gte": now + timedelta(days=1), "$lte": now + timedelta(days=2)}}) == 2
+    assert orders.count_documents({"user_id": "u", "missing": {"$lt": 1}}) == 0
+    assert [o["id"] for o in orders.find({"user_id": "u"}, sort=("created_at", -1), limit=2)] == ["2", "1"]
+
+
+def test_documents_are_copied_in_and_out():
+    users = MemoryCollection("users", INDEXES["users"])
+    stored = user()
+    users.insert_one(stored)
+    stored["email"] = "changed@example.com"
+    users.find_one({"id": stored["id"]})["email"] = "changed@example.com"
+
+    assert users.find_one({"id": stored["id"]})["email"] == "buyer@example.com"
+
+
+def test_increment_creates_nested_paths():
+    summaries = MemoryCollection("user_summaries", INDEXES["user_summaries"])
+    summaries.insert_one({"id": "u"})
+    summaries.increment({"id": "u"}, {"order_count": 1, "totals.USD": 2.5})
+    summaries.increment({"id": "u"}, {"order_count": 1, "totals.USD": 1.0})
+
+    assert summaries.find_one({"id": "u"}) == {"id": "u", "order_count": 2, "totals": {"USD": 3.5}}
+    assert not summaries.increment({"id": "missing"}, {"order_count": 1})
+
+
+def test_ttl_expires_old_documents():
+    checks = MemoryCollection("status_checks", INDEXES["status_checks"], ttl_seconds=60)
+    checks.insert_one({"id": "old", "timestamp": datetime.utcnow() - timedelta(minutes=5)})
+    checks.insert_one({"id": "new", "timestamp": datetime.utcnow()})
+
+    assert [doc["id"] for doc in checks.find({})] == ["new"]
+
+
+def test_escaped_keys_round_trip():
+    for value in ("U.A.E", "$USD", "100%", "%2E"):
+        assert "." not in escape_key(value) and "$" not in escape_key(value)
+        assert unescape_key(escape_key(value)) == value
+
+
+def test_repositories():
+    repos = create_memory_repositories()
+
+    async def run():
+        stored = user()
+        await repos.users.insert(stored)
+        await repos.users.bump_versions(stored["id"], "orders", "profile")
+        await repos.users.bump_versions(stored["id"], "orders")
+        assert (await repos.users.get_by_id(stored["id"]))["data_versions"] == {"orders": 2, "profile": 1}
+
+        assert await repos.users.replace_password_hash(stored["id"], "hash", "new")
+        # Only replaces the hash that was read
+        assert not await repos.users.replace_password_hash(stored["id"], "hash", "newer")
+
+        for n in range(3):
+            await repos.messages.insert({"id": str(n), "user_id": stored["id"], "is_read": False, "created_at": datetime.utcnow()})
+        assert await repos.messages.mark_read("1", stored["id"])
+        assert not await repos.messages.mark_read("1", stored["id"])
+        assert not await repos.messages.mark_read("2", "someone-else")
+        assert await repos.messages.count_unread(stored["id"]) == 2
+
+        before = await repos.orders.update("missing", {"status": "shipped"})
+        assert before is None
+
+    asyncio.run(run())
+
+
+def test_lease_is_held_by_one_owner():
+    repos = create_memory_repositories()
+    now = datetime.utcnow()
+
+    async def run():
+        first = await repos.leases.acquire("archiver", "a", now, now + timedelta(minutes=1))
+        second = await repos.leases.acquire("archiver", "b", now, now + timedelta(minutes=1))
+        renewed = await repos.leases.acquire("archiver", "a", now, now + timedelta(minutes=2))
+        expired = await repos.leases.acquire("archiver", "b", now + timedelta(minutes=3), now + timedelta(minutes=4))
+        await repos.leases.release("archiver", "a")  # no longer the owner
+        after_release = await repos.leases.acquire("archiver", "a", now + timedelta(minutes=3), now)
+        return first, second, renewed, expired, after_release
+
+    assert asyncio.run(run()) == (True, False, True, True, False)
@@ -0,0 +1,80 @@
+import gzip
+
+import pytest
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from static_site import IMMUTABLE, REVALIDATE, StaticSite
+
+INDEX = b"<!doctype html><div id=root></div>"
+SCRIPT = b"console.log('portal');\n" * 200
+SCRIPT_GZ = gzip.compress(SCRIPT, mtime=0)
+
+
+@pytest.fixture
+def site(tmp_path):
+    (tmp_path / "index.html").write_bytes(INDEX)
+    scripts = tmp_path / "static" / "js"
+    scripts.mkdir(parents=True)
+    (scripts / "main.2b21e188.js").write_bytes(SCRIPT)
+    (scripts / "main.2b21e188.js.gz").write_bytes(SCRIPT_GZ)
+    (scripts / "main.2b21e188.js.br").write_bytes(b"brotli bytes")
+    (tmp_path / "robots.txt").write_bytes(b"User-agent: *\n")
+    return TestClient(StaticSite(tmp_path))
+
+
+def raw_get(client, path, **headers):
+    """GET ``path`` without letting the client decode the body."""
+    with client.stream("GET", path, headers=headers) as response:
+        return response, b"".join(response.iter_raw())
+
+
+@pytest.mark.parametrize("accept, encoding, body", [
+    ("br, gzip", "br", b"brotli bytes"),
+    ("gzip, br;q=0", "gzip", SCRIPT_GZ),
+    ("identity", None, SCRIPT),
+])
+def test_precompressed_variant_is_chosen(site, accept, encoding, body):
+    response, raw = raw_get(site, "/static/js/main.2b21e188.js", **{"Accept-Encoding": accept})
+
+    assert response.headers.get("content-encoding") == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["content-type"].startswith(("application/javascript", "text/javascript"))
+    assert raw == body
+
+
+def test_fingerprinted_files_are_immutable(site):
+    assert site.get("/static/js/main.2b21e188.js").headers["cache-control"] == IMMUTABLE
+    assert site.get("/").headers["cache-control"] == REVALIDATE
+    # No variants, so nothing to vary on
+    assert "vary" not in site.get("/robots.txt").headers
+
+
+def test_matching_etag_is_not_modified(site):
+    etag = site.get("/static/js/main.2b21e188.js").headers["etag"]
+
+    response = site.get("/static/js/main.2b21e188.js", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert site.get("/static/js/main.2b21e188.js", headers={"If-None-Match": 'W/"other"'}).status_code == 200
+
+
+def test_client_routes_fall_back_to_index(site):
+    response = site.get("/orders/1234")
+    assert response.status_code == 200
+    assert response.content == INDEX
+
+
+@pytest.mark.parametrize("path", ["/api/orders", "/static/js/missing.js"])
+def test_api_and_missing_files_are_json_404s(site, path):
+    response = site.get(path)
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Not Found"}
+
+
+def test_other_methods_and_websockets_are_refused(site):
+    assert site.post("/").status_code == 405
+    with pytest.raises(WebSocketDisconnect):
+        with site.websocket_connect("/ws"):
+            pass
@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import pytest
+
+from codec import binary_to_uuid, codec_for
+from repositories import MotorOrderRepository, MotorSummaryRepository
+from summaries import order_contribution, present_summary, summary_delta
+
+ORDER = {"product_category": "Spices", "product_description": "Turmeric", "quantity": "10"}
+
+
+@pytest.mark.parametrize("schema_mode", ["legacy", "dual", "compact"])
+def test_apply_upserts_with_the_user_id(motor_repositories, schema_mode):
+    repos = motor_repositories(schema_mode)
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+
+    async def run():
+        await repos.ensure_indexes()
+        now = datetime.utcnow()
+        # A second new user used to collide on a null id in dual mode
+        for user_id in (first, first, second):
+            await repos.user_summaries.apply(user_id, {"order_count": 1}, now, now)
+        stored = await repos.db.user_summaries.find({}, {"_id": 0}).to_list(None)
+        return {binary_to_uuid(doc["id"]): doc["order_count"] for doc in stored}
+
+    assert asyncio.run(run()) == {first: 2, second: 1}
+
+
+def test_delta_moves_an_order_between_statuses():
+    before = {"status": "pending", "destination_country": "U.A.E", "currency": "USD", "total_amount": 100}
+
+    assert summary_delta(before, {**before, "status": "shipped"}) == {
+        "status_counts.pending": -1, "status_counts.shipped": 1,
+    }
+    # Cancelled orders leave the totals
+    assert summary_delta(before, {**before, "status": "cancelled"}) == {
+        "status_counts.pending": -1, "status_counts.cancelled": 1, "totals.USD": -100.0,
+    }
+    assert summary_delta(before, dict(before)) == {}
+    assert order_contribution(before)["country_counts.U%2EA%2EE"] == 1
+
+
+def test_present_summary_drops_emptied_entries():
+    stored = {
+        "order_count": 2,
+        "status_counts": {"pending": 0, "processing": -1, "shipped": 2},
+        "totals": {"USD": 0.001, "EUR": 12.345},
+        "country_counts": {"U%2EA%2EE": 2},
+    }
+    assert present_summary(stored) == {
+        "order_count": 2,
+        "last_order_at": None,
+        "status_counts": {"shipped": 2},
+        "totals": {"EUR": 12.35},
+        "country_counts": {"U.A.E": 2},
+    }
+    assert present_summary(None)["order_count"] == 0
+
+
+def test_summary_follows_order_writes(client, register, admin):
+    headers = register()
+    orders = [client.post("/api/orders", json={**ORDER, "destination_country": country}, headers=headers).json()
+              for country in ("India", "India", "UAE")]
+    client.put(f"/api/admin/orders/{orders[0]['id']}", json={"status": "shipped", "total_amount": 250.0}, headers=admin)
+    client.put(f"/api/admin/orders/{orders[1]['id']}", json={"status": "cancelled", "total_amount": 99.0}, headers=admin)
+
+    summary = client.get("/api/dashboard/summary", headers=headers).json()
+    assert summary["order_count"] == 3
+    assert summary["status_counts"] == {"pending": 1, "shipped": 1, "cancelled": 1}
+    assert summary["totals"] == {"USD": 250.0}
+    assert summary["country_counts"] == {"India": 2, "UAE": 1}
+    assert summary["last_order_at"] is not None
+
+
+def test_missing_summary_is_rebuilt_from_the_orders(client, register, admin):
+    headers = register()
+    orders = [client.post("/api/orders", json={**ORDER, "destination_country": "India"}, headers=headers).json()
+              for _ in range(3)]
+    # As for a user whose orders predate the summaries
+    repos = client.app.state.repositories
+    asyncio.run(repos.user_summaries.delete([orders[0]["user_id"]]))
+    client.put(f"/api/admin/orders/{orders[0]['id']}", json={"status": "shipped"}, headers=admin)
+
+    summary = client.get("/api/dashboard/summary", headers=headers).json()
+    assert summary["order_count"] == 3
+    assert summary["status_counts"] == {"pending": 2, "shipped": 1}
+    assert summary["country_counts"] == {"India": 3}
+
+
+def test_dual_mode_rebuild_merges_both_id_forms(motor_repositories):
+    from summaries import rebuild
+
+    legacy, dual = motor_repositories("legacy"), motor_repositories("dual")
+    db = legacy.db
+    dual.orders = MotorOrderRepository(db.orders, codec_for("orders", "dual"), codec_for("order_events", "dual"))
+    users = sorted(str(uuid.uuid4()) for _ in range(3))
+
+    async def run():
+        now = datetime.utcnow()
+        # Orders written before the switch to dual mode, after it, or both
+        writers = {users[0]: [legacy.orders], users[1]: [legacy.orders, dual.orders], users[2]: [dual.orders]}
+        for user_id, repositories in writers.items():
+            for repository in repositories:
+                await repository.insert({
+                    "id": str(uuid.uuid4()), "user_id": user_id, "status": "pending",
+                    "destination_country": "India", "currency": "USD", "total_amount": 10.0, "created_at": now,
+                })
+        summaries = MotorSummaryRepository(db.user_summaries, codec_for("user_summaries", "dual"))
+        result = await rebuild(db, summaries, "dual")
+        return result, {s["id"]: s["order_count"] for s in await summaries.get_many(users)}
+
+    result, counts = asyncio.run(run())
+    assert result == {"rebuilt": 3, "removed": 0}
+    assert counts == {users[0]: 1, users[1]: 2, users[2]: 1}
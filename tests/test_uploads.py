@@ -0,0 +1,79 @@
+import pytest
+
+ORDER = {"product_category": "Spices", "product_description": "Turmeric", "quantity": "10", "destination_country": "India"}
+BODY = b"packing list line\n" * 5000
+
+
+def open_session(client, headers, total_size=None):
+    order_id = client.post("/api/orders", json=ORDER, headers=headers).json()["id"]
+    session = {
+        "order_id": order_id,
+        "document_type": "packing_list",
+        "filename": "packing.txt",
+        "mime_type": "text/plain",
+    }
+    if total_size is not None:
+        session["total_size"] = total_size
+    return client.post("/api/uploads", json=session, headers=headers).json()["id"]
+
+
+def test_chunked_upload_round_trip(client, register):
+    headers = register()
+    session_id = open_session(client, headers, len(BODY))
+    half = len(BODY) // 2
+    assert client.put(f"/api/uploads/{session_id}?offset=0", content=BODY[:half], headers=headers).status_code == 200
+    # A replayed or out-of-order chunk is refused
+    assert client.put(f"/api/uploads/{session_id}?offset=0", content=BODY[:half], headers=headers).status_code == 409
+    assert client.get(f"/api/uploads/{session_id}", headers=headers).json()["received"] == half
+    client.put(f"/api/uploads/{session_id}?offset={half}", content=BODY[half:], headers=headers)
+
+    document = client.post(f"/api/uploads/{session_id}/complete", headers=headers).json()
+    assert document["file_size"] == len(BODY)
+    # Completing again returns the same document
+    assert client.post(f"/api/uploads/{session_id}/complete", headers=headers).json()["id"] == document["id"]
+    content = client.get(f"/api/documents/{document['id']}/content", headers=headers)
+    assert content.content == BODY
+
+
+def test_incomplete_upload_cannot_complete(client, register):
+    headers = register()
+    session_id = open_session(client, headers, len(BODY))
+    client.put(f"/api/uploads/{session_id}?offset=0", content=BODY[:100], headers=headers)
+    assert client.post(f"/api/uploads/{session_id}/complete", headers=headers).status_code == 409
+
+
+def test_failed_completion_is_rolled_back(client, register, monkeypatch):
+    headers = register()
+    repos = client.app.state.repositories
+    session_id = open_session(client, headers)
+    client.put(f"/api/uploads/{session_id}?offset=0", content=BODY, headers=headers)
+
+    async def failing_insert(document):
+        raise RuntimeError("database unavailable")
+
+    insert = repos.documents.insert
+    monkeypatch.setattr(repos.documents, "insert", failing_insert)
+    with pytest.raises(RuntimeError):
+        client.post(f"/api/uploads/{session_id}/complete", headers=headers)
+    assert repos.blobs._blobs == {}
+    assert client.get(f"/api/uploads/{session_id}", headers=headers).json()["status"] == "open"
+
+    monkeypatch.setattr(repos.documents, "insert", insert)
+    response = client.post(f"/api/uploads/{session_id}/complete", headers=headers)
+    assert response.status_code == 200
+    assert len(repos.blobs._blobs) == 1
+
+
+def test_completion_reads_only_accepted_bytes(client, register):
+    import server
+
+    headers = register()
+    session_id = open_session(client, headers)
+    client.put(f"/api/uploads/{session_id}?offset=0", content=BODY, headers=headers)
+    # A chunk another worker is still writing, not yet accepted by the session
+    with open(server.upload_files.path(session_id), "ab") as f:
+        f.write(b"not accepted")
+
+    document = client.post(f"/api/uploads/{session_id}/complete", headers=headers).json()
+    assert document["file_size"] == len(BODY)
+    assert client.get(f"/api/documents/{document['id']}/content", headers=headers).content == BODY
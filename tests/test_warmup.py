@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from warmup import OK, PENDING, Warmup
+
+
+class SlowPasswords:
+    """A hashing backend that loads only once ``loaded`` is set."""
+
+    def __init__(self):
+        self.loaded = threading.Event()
+
+    def load_backend(self):
+        self.loaded.wait(10)
+
+
+def wait_until(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    import server
+    from repositories import create_memory_repositories
+
+    monkeypatch.setattr(server, "WARMUP", True)
+    monkeypatch.setattr(server, "WARMUP_TIMEOUT_SECONDS", 0.05)
+    server.app.state.repositories = create_memory_repositories(server.TTL_SECONDS)
+    server.app.middleware_stack = None
+    return server
+
+
+def test_not_ready_until_warmup_finishes(server, monkeypatch):
+    passwords = SlowPasswords()
+    monkeypatch.setattr(server, "passwords", passwords)
+
+    with TestClient(server.app) as client:
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["checks"]["passwords"] == PENDING
+        assert client.get("/healthz").status_code == 200
+
+        passwords.loaded.set()
+        wait_until(lambda: client.get("/readyz").status_code == 200)
+        assert client.get("/readyz").json()["checks"] == {"models": OK, "passwords": OK}
+        assert client.get("/healthz").json() == {"status": "ok"}
+    # Shutting down drains the worker out of rotation
+    assert not server.app.state.warmup.ready
+
+
+def test_skipped_warmup_is_ready(client):
+    assert client.get("/readyz").status_code == 200
+    assert client.get("/healthz").status_code == 200
+
+
+def test_ready_once_the_database_answers():
+    pings = []
+
+    class Admin:
+        async def command(self, name):
+            pings.append(name)
+            if len(pings) == 1:
+                raise ConnectionError("no primary")
+
+    class Client:
+        admin = Admin()
+
+    async def run():
+        warmup = Warmup(app=None, client=Client(), retry_seconds=0)
+        # A failed best-effort step does not keep the worker out of rotation
+        await warmup.run()
+        return warmup
+
+    warmup = asyncio.run(run())
+    assert pings == ["ping", "ping"]
+    assert warmup.checks["database"] == OK
+    assert warmup.checks["models"].startswith("failed")
+    assert warmup.ready